@@ -0,0 +1,354 @@
+"""Benchmarks of the denoising, MRIQC-group and tedana discovery paths.
+
+Synthetic datasets (see synthetic.py) are generated for every combination of
+subject count and run length, then each suite is timed on them:
+
+- ``denoising``: denoising.main per subject, with the per-stage breakdown
+  read back from the ``*_stages.jsonl`` records (see instrumentation.py)
+- ``mriqc_group``: mriqc_group.main on the synthetic group_bold.tsv
+- ``tedana_discovery``: the session/task/run/echo discovery of tedana_job.py
+
+Results are written as JSON together with the commit, host and library
+versions, so runs of different commits on the same machine can be compared.
+Keep runs above ~200 volumes: at a 0.8 s TR the passband regressors of
+shorter runs leave (almost) no degrees of freedom for the data.
+Suite modules are imported when their suite runs, and none needs nipype or
+AFNI with the default numpy backend. The denoising suite censors with its
+own ``_censoring`` in place of the lab's utils module (see
+denoising.utils_censoring), which is not part of this repository.
+"""
+import argparse
+import itertools
+import json
+import os
+import os.path as op
+import platform
+import shutil
+import subprocess
+import time
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import load_records
+from manifest import tool_versions
+from synthetic import SPACE, make_dataset
+
+SUITES = ["denoising", "mriqc_group", "tedana_discovery"]
+
+
+def _timed(func, *args, **kwargs):
+    cpu0, wall0 = time.process_time(), time.perf_counter()
+    func(*args, **kwargs)
+    return {
+        "wall_s": time.perf_counter() - wall0,
+        "cpu_s": time.process_time() - cpu0,
+    }
+
+
+def _subjects(preproc_dir):
+    return sorted(
+        name for name in os.listdir(preproc_dir) if name.startswith("sub-")
+    )
+
+
+def _censoring(confounds_file, fd_thresh, n_contig=0, n_before=0, n_after=0):
+    """FD censoring vector (1 = kept), standing in for the lab's utils.
+
+    Volumes with FD above ``fd_thresh`` are censored (the undefined FD of the
+    first volume is kept), with ``n_before``/``n_after`` volumes around each,
+    and so are kept stretches shorter than ``n_contig`` volumes.
+    """
+    fd = pd.read_csv(confounds_file, sep="\t", usecols=["framewise_displacement"])
+    fd = fd["framewise_displacement"].fillna(0).to_numpy()
+    censor = (fd <= fd_thresh).astype(int)
+    out = censor.copy()
+    for i in np.flatnonzero(censor == 0):
+        out[max(i - n_before, 0) : i + n_after + 1] = 0
+    if n_contig:
+        # Stretches of kept volumes, as (start, stop) pairs
+        edges = np.flatnonzero(np.diff(np.concatenate([[0], out, [0]])))
+        for start, stop in edges.reshape(-1, 2):
+            if stop - start < n_contig:
+                out[start:stop] = 0
+    return out
+
+
+def bench_denoising(preproc_dir, mriqc_dir, clean_dir, backend="numpy", n_jobs=1):
+    """Denoise every subject into a fresh ``clean_dir``; returns timings."""
+    from denoising import main as denoising_main
+
+    shutil.rmtree(clean_dir, ignore_errors=True)
+    timing = {"wall_s": 0.0, "cpu_s": 0.0}
+    for subject in _subjects(preproc_dir):
+        subject_timing = _timed(
+            denoising_main,
+            mriqc_dir,
+            preproc_dir,
+            clean_dir,
+            subject,
+            [None],
+            SPACE,
+            0.35,
+            0,
+            ["aCompCorCens", "aCompCorSM6Cens"],
+            n_jobs,
+            backend=backend,
+            censor_func=_censoring,
+        )
+        for key, value in subject_timing.items():
+            timing[key] += value
+
+    records = load_records(clean_dir)
+    if not records.empty:
+        per_stage = records.groupby(records["stage"].str.split(":").str[0])
+        timing["stages"] = {
+            stage: {
+                "wall_s": float(stage_records["wall_s"].sum()),
+                "cpu_s": float(
+                    (stage_records["cpu_s"] + stage_records["cpu_children_s"]).sum()
+                ),
+                "peak_rss_mb": float(stage_records["peak_rss_mb"].max()),
+                # "concurrent": the peak of the overlapping stages, not this one's
+                "peak_rss_scope": "concurrent"
+                if (stage_records["peak_rss_scope"] == "concurrent").any()
+                else "stage",
+            }
+            for stage, stage_records in per_stage
+        }
+        timing["n_runs"] = int(records["run"].nunique())
+    return timing
+
+
+def bench_mriqc_group(mriqc_dir):
+    """Run mriqc_group.main on a clean registry; returns timings."""
+    from mriqc_group import main as mriqc_group_main
+
+    shutil.rmtree(op.join(mriqc_dir, "exclusions"), ignore_errors=True)
+    timing = _timed(mriqc_group_main, mriqc_dir)
+    timing["n_rows"] = len(pd.read_csv(op.join(mriqc_dir, "group_bold.tsv"), sep="\t"))
+    return timing
+
+
+def bench_tedana_discovery(preproc_dir):
+    """Discover the sessions, tasks, runs and echo times of every subject."""
+    import tedana_job
+    from bids_index import subject_index
+
+    def _discover():
+        for subject in _subjects(preproc_dir):
+            index = subject_index(preproc_dir, subject)
+            sessions = tedana_job._get_sessions(index)
+            for task in tedana_job._get_tasks(index, sessions):
+                runs = tedana_job._get_runs_for_task(index, sessions, task)
+                for session, run in itertools.product(sessions, runs):
+                    echo_files = index.files(
+                        ses=tedana_job._ses_value(session),
+                        task=task,
+                        run=run,
+                        echo=True,
+                        desc="preproc",
+                        suffix="bold",
+                        extension=".nii.gz",
+                    )
+                    if echo_files:
+                        tedana_job._get_echos(echo_files)
+
+    return _timed(_discover)
+
+
+def _git_commit():
+    repo_dir = op.dirname(op.abspath(__file__))
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=repo_dir, capture_output=True, text=True
+        ).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=repo_dir,
+            capture_output=True,
+            text=True,
+        ).stdout
+    except OSError:
+        return {"commit": None, "dirty": None}
+    return {"commit": commit or None, "dirty": bool(status.strip())}
+
+
+def run_benchmarks(
+    work_dir,
+    n_subjects=(1, 2),
+    n_vols=(300, 600),
+    size="small",
+    n_runs=2,
+    n_echoes=3,
+    suites=SUITES,
+    backend="numpy",
+    n_jobs=1,
+    repeats=1,
+):
+    """Time every suite on every (subject count, run length) dataset."""
+    results = []
+    for n_sub, n_vol in itertools.product(n_subjects, n_vols):
+        data_dir = op.join(work_dir, f"synthetic-{size}-sub{n_sub}-vol{n_vol}")
+        print(f"Dataset {data_dir}", flush=True)
+        preproc_dir, mriqc_dir = make_dataset(
+            data_dir,
+            n_subjects=n_sub,
+            n_runs=n_runs,
+            n_vols=n_vol,
+            size=size,
+            n_echoes=n_echoes,
+            threads=n_jobs,
+        )
+        for suite, repeat in itertools.product(suites, range(int(repeats))):
+            print(f"\t{suite} (repeat {repeat + 1}/{repeats})", flush=True)
+            if suite == "denoising":
+                clean_dir = op.join(data_dir, "denoising")
+                timing = bench_denoising(
+                    preproc_dir, mriqc_dir, clean_dir, backend=backend, n_jobs=n_jobs
+                )
+            elif suite == "mriqc_group":
+                timing = bench_mriqc_group(mriqc_dir)
+            else:
+                timing = bench_tedana_discovery(preproc_dir)
+            print(f"\t\t{timing['wall_s']:.2f} s", flush=True)
+            results.append(
+                dict(
+                    {
+                        "suite": suite,
+                        "size": size,
+                        "n_subjects": n_sub,
+                        "n_vols": n_vol,
+                        "n_runs_per_subject": n_runs,
+                        "repeat": repeat,
+                    },
+                    **timing,
+                )
+            )
+    return results
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description="Benchmark denoising, MRIQC-group and tedana discovery"
+    )
+    parser.add_argument(
+        "--work_dir",
+        dest="work_dir",
+        required=True,
+        help="Directory for the synthetic datasets and their outputs",
+    )
+    parser.add_argument(
+        "--out_file",
+        dest="out_file",
+        required=True,
+        help="JSON file to write the results to",
+    )
+    parser.add_argument(
+        "--n_subjects",
+        dest="n_subjects",
+        default=[1, 2],
+        type=int,
+        required=False,
+        nargs="+",
+        help="Subject counts to benchmark",
+    )
+    parser.add_argument(
+        "--n_vols",
+        dest="n_vols",
+        default=[300, 600],
+        type=int,
+        required=False,
+        nargs="+",
+        help="Run lengths (volumes) to benchmark",
+    )
+    parser.add_argument(
+        "--size",
+        dest="size",
+        default="small",
+        required=False,
+        choices=["small", "realistic"],
+        help="Grid size of the synthetic runs (see synthetic.py)",
+    )
+    parser.add_argument(
+        "--n_runs",
+        dest="n_runs",
+        default=2,
+        type=int,
+        required=False,
+        help="Runs per subject",
+    )
+    parser.add_argument(
+        "--n_echoes",
+        dest="n_echoes",
+        default=3,
+        type=int,
+        required=False,
+        help="Echoes per run, for the tedana discovery suite",
+    )
+    parser.add_argument(
+        "--suites",
+        dest="suites",
+        default=SUITES,
+        required=False,
+        nargs="+",
+        choices=SUITES,
+        help="Suites to run",
+    )
+    parser.add_argument(
+        "--backend",
+        dest="backend",
+        default="numpy",
+        required=False,
+        choices=["afni", "numpy"],
+        help="Denoising backend",
+    )
+    parser.add_argument(
+        "--n_jobs",
+        dest="n_jobs",
+        default=1,
+        type=int,
+        required=False,
+        help="CPUs",
+    )
+    parser.add_argument(
+        "--repeats",
+        dest="repeats",
+        default=1,
+        type=int,
+        required=False,
+        help="Repetitions of each suite",
+    )
+    return parser
+
+
+def main(work_dir, out_file, **kwargs):
+    """Run the benchmarks and write them with the commit and machine details."""
+    started = time.time()
+    results = run_benchmarks(work_dir, **kwargs)
+    report = {
+        "meta": dict(
+            _git_commit(),
+            host=platform.node(),
+            platform=platform.platform(),
+            python=platform.python_version(),
+            cpu_count=os.cpu_count(),
+            versions=tool_versions(kwargs.get("backend", "numpy")),
+            started=started,
+            params=kwargs,
+        ),
+        "results": results,
+    }
+    with open(out_file, "w") as fo:
+        json.dump(report, fo, indent=4)
+    print(f"Wrote {len(results)} results to {out_file}", flush=True)
+
+
+def _main(argv=None):
+    option = _get_parser().parse_args(argv)
+    kwargs = vars(option)
+    main(**kwargs)
+
+
+if __name__ == "__main__":
+    _main()
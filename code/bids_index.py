@@ -0,0 +1,185 @@
+"""Index of a BIDS derivatives tree (e.g. fMRIPrep), built with one walk.
+
+Every file under the tree (or under some subjects only) is listed once with
+os.scandir and its name parsed into BIDS entities (sub, ses, task, run,
+echo, space, desc, ...), suffix and extension. Lookups are then filters on
+that table, so discovery does not glob the (network) filesystem again.
+
+The listing can be stored in a JSON cache. It is reused while none of the
+indexed directories' mtimes changed (creating, removing or renaming a file
+updates its directory's mtime), which costs one stat per directory instead
+of one listing per glob.
+"""
+import json
+import os
+import os.path as op
+
+import numpy as np
+import pandas as pd
+
+from manifest import atomic_output
+
+# Bumped when the cached listing's layout changes
+INDEX_VERSION = 1
+
+
+def parse_bids_name(name):
+    """Entities, suffix and extension of a BIDS file name; None if not BIDS.
+
+    ``sub-01_task-rest_run-01_echo-2_desc-preproc_bold.nii.gz`` gives
+    ``{"sub": "01", "task": "rest", "run": "01", "echo": "2",
+    "desc": "preproc", "suffix": "bold", "extension": ".nii.gz"}``.
+    """
+    stem = name.split(".")[0]
+    parts = stem.split("_")
+    if (len(parts) < 2) or ("-" in parts[-1]):
+        return None
+    entities = {}
+    for part in parts[:-1]:
+        key, sep, value = part.partition("-")
+        if not sep:
+            return None
+        entities[key] = value
+    if "sub" not in entities:
+        return None
+    return dict(entities, suffix=parts[-1], extension=name[len(stem) :])
+
+
+def _scan(root, subjects=None):
+    """Relative paths of the files under ``root`` and mtimes of their directories."""
+    files, dirs = [], {}
+    if subjects is None:
+        dirs["."] = os.stat(root).st_mtime_ns
+    stack = [root]
+    while stack:
+        path = stack.pop()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir():
+                    # Only subject directories hold the files we index
+                    if (path == root) and not entry.name.startswith("sub-"):
+                        continue
+                    if (path == root) and subjects and (entry.name not in subjects):
+                        continue
+                    dirs[op.relpath(entry.path, root)] = entry.stat().st_mtime_ns
+                    stack.append(entry.path)
+                elif path != root:
+                    files.append(op.relpath(entry.path, root))
+    return sorted(files), dirs
+
+
+class DerivativesIndex:
+    """Files of a derivatives tree as a table of BIDS entities.
+
+    Entity values are stored without their key (``ses`` is "01", not
+    "ses-01"); ``datatype`` is the name of the file's directory (func, anat).
+    With ``subjects`` only those subject directories are listed, and with
+    ``cache_file`` the listing is persisted (see the module docstring).
+    """
+
+    def __init__(self, root, subjects=None, cache_file=None):
+        self.root = op.abspath(root)
+        self.subjects = sorted(subjects) if subjects else None
+        listing = self._load(cache_file) if cache_file else None
+        if listing is None:
+            listing = _scan(self.root, self.subjects)
+            if cache_file:
+                self._save(cache_file, *listing)
+        files, self.dirs = listing
+
+        records = []
+        for rel_path in files:
+            entities = parse_bids_name(op.basename(rel_path))
+            if entities is None:
+                continue
+            entities["datatype"] = op.basename(op.dirname(rel_path))
+            entities["path"] = op.join(self.root, rel_path)
+            records.append(entities)
+        if records:
+            table = pd.DataFrame.from_records(records)
+        else:
+            table = pd.DataFrame(columns=["path"])
+        # Few distinct values per column, so categories keep the table compact
+        self.table = table.astype(
+            {column: "category" for column in table.columns if column != "path"}
+        )
+
+    def _load(self, cache_file):
+        try:
+            with open(cache_file, "r") as fo:
+                cached = json.load(fo)
+        except (OSError, ValueError):
+            return None
+        if (cached.get("version"), cached.get("root"), cached.get("subjects")) != (
+            INDEX_VERSION,
+            self.root,
+            self.subjects,
+        ):
+            return None
+        for rel_dir, mtime_ns in cached["dirs"].items():
+            try:
+                if os.stat(op.join(self.root, rel_dir)).st_mtime_ns != mtime_ns:
+                    return None
+            except OSError:
+                return None
+        return cached["files"], cached["dirs"]
+
+    def _save(self, cache_file, files, dirs):
+        os.makedirs(op.dirname(op.abspath(cache_file)), exist_ok=True)
+        with atomic_output(cache_file) as tmp_file:
+            with open(tmp_file, "w") as fo:
+                json.dump(
+                    {
+                        "version": INDEX_VERSION,
+                        "root": self.root,
+                        "subjects": self.subjects,
+                        "dirs": dirs,
+                        "files": files,
+                    },
+                    fo,
+                )
+
+    def _match(self, filters):
+        keep = np.ones(len(self.table), dtype=bool)
+        for entity, value in filters.items():
+            if entity not in self.table.columns:
+                # No file carries this entity
+                keep &= value is None
+                continue
+            column = self.table[entity]
+            if value is None:
+                keep &= column.isna().to_numpy()
+            elif value is True:
+                keep &= column.notna().to_numpy()
+            elif isinstance(value, (list, tuple, set)):
+                keep &= column.isin(list(value)).to_numpy()
+            else:
+                keep &= (column == value).to_numpy()
+        return keep
+
+    def files(self, **filters):
+        """Sorted paths of the files matching every filter.
+
+        A filter is a value, a list of accepted values, True (entity present)
+        or None (entity absent); entities not given are unconstrained. Pass
+        ``from`` as ``**{"from": "T1w"}``.
+        """
+        return sorted(self.table.loc[self._match(filters), "path"])
+
+    def values(self, entity, **filters):
+        """Sorted distinct values of ``entity`` among the files matching ``filters``."""
+        if entity not in self.table.columns:
+            return []
+        column = self.table.loc[self._match(filters), entity]
+        return sorted(column.dropna().unique())
+
+
+def subject_index(root, subject, cache_dir=None):
+    """Index of one subject's directory (``subject`` with the sub- prefix).
+
+    With ``cache_dir`` the listing is kept in ``{cache_dir}/{subject}_index.json``.
+    """
+    cache_file = op.join(cache_dir, f"{subject}_index.json") if cache_dir else None
+    return DerivativesIndex(root, subjects=[subject], cache_file=cache_file)
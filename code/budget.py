@@ -0,0 +1,66 @@
+"""Memory budget shared by jobs running concurrently in one process."""
+import os
+import threading
+from contextlib import contextmanager
+
+# Fraction of the granted memory handed out to jobs; the rest covers this process
+MEMORY_HEADROOM = 0.9
+
+
+def available_memory_gb():
+    """Memory granted to this job (SLURM's --mem or --mem-per-cpu), else MemAvailable.
+
+    Returns None when neither is known.
+    """
+    if os.environ.get("SLURM_MEM_PER_NODE"):
+        return MEMORY_HEADROOM * int(os.environ["SLURM_MEM_PER_NODE"]) / 1024
+    if os.environ.get("SLURM_MEM_PER_CPU") and os.environ.get("SLURM_CPUS_PER_TASK"):
+        mem_mb = int(os.environ["SLURM_MEM_PER_CPU"]) * int(
+            os.environ["SLURM_CPUS_PER_TASK"]
+        )
+        return MEMORY_HEADROOM * mem_mb / 1024
+    try:
+        with open("/proc/meminfo", "r") as fo:
+            for line in fo:
+                if line.startswith("MemAvailable:"):
+                    return MEMORY_HEADROOM * int(line.split()[1]) / 1024**2
+    except OSError:
+        pass
+    return None
+
+
+class MemoryBudget:
+    """Admit jobs while the sum of their memory estimates fits in ``total_gb``.
+
+    A job larger than the whole budget still runs, alone. With ``total_gb``
+    None every job is admitted.
+    """
+
+    def __init__(self, total_gb):
+        self.total_gb = total_gb
+        self.used_gb = 0.0
+        self.n_running = 0
+        self._condition = threading.Condition()
+
+    def _fits(self, gb):
+        if (self.total_gb is None) or (self.n_running == 0):
+            return True
+        return self.used_gb + gb <= self.total_gb
+
+    @contextmanager
+    def reserve(self, gb):
+        """Block until ``gb`` fits in the budget and hold it for the enclosed block."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._fits(gb))
+            self.used_gb += gb
+            self.n_running += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.used_gb -= gb
+                self.n_running -= 1
+                self._condition.notify_all()
+
+    def describe(self):
+        return "unlimited" if self.total_gb is None else f"{self.total_gb:.1f} GB"
@@ -0,0 +1,273 @@
+"""Out-of-core variant of the in-process denoising stages.
+
+The 4D input is decompressed once to an uncompressed scratch ``.nii`` and read
+through nibabel's memory map in slabs of z-planes. Every voxel-wise stage
+(regression, censoring, spectra) runs slab by slab and writes into
+memory-mapped scratch outputs, so peak memory is set by ``max_memory`` and
+not by the run length. Smoothing runs over batches of volumes, ReHo over
+slabs with a one-plane halo, and the outputs are then encoded without being
+loaded whole.
+"""
+import gzip
+import os
+import os.path as op
+import shutil
+
+import nibabel as nib
+import numpy as np
+
+from masked import MaskedData
+from metrics import kendall_w_reho, normalize_metrics, spectral_metrics
+from nifti_io import DEFAULT_CODECS, GZIP_BLOCK_SIZE, recode_nifti, write_header
+from nuisance import build_design, load_regressors, project_out, projection_basis
+from smoothing import blur_volumes
+
+# float32 copies of a slab alive at once: input grid, voxels, residuals,
+# filtered residuals, projection temporaries and the censored output grid
+SLAB_COPIES = 6
+
+
+def decompress_nifti(in_fn, scratch_fn):
+    """Decompress a .nii.gz once to ``scratch_fn`` and memory-map it."""
+    if not in_fn.endswith(".gz"):
+        return nib.load(in_fn, mmap=True)
+    with gzip.open(in_fn, "rb") as fi, open(scratch_fn, "wb") as fo:
+        shutil.copyfileobj(fi, fo, GZIP_BLOCK_SIZE)
+    return nib.load(scratch_fn, mmap=True)
+
+
+def create_memmap(ref_img, out_fn, n_vols):
+    """Create an all-zero float32 NIfTI of ``n_vols`` volumes and map its data."""
+    shape = ref_img.shape[:3] + (n_vols,)
+    header = ref_img.header.copy()
+    header.set_data_shape(shape)
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(1, 0)
+    dtype = header.get_data_dtype()
+    with open(out_fn, "wb") as fo:
+        offset = write_header(fo, header)
+        fo.truncate(offset + int(np.prod(shape)) * dtype.itemsize)
+    return np.memmap(
+        out_fn, dtype=dtype, mode="r+", offset=offset, shape=shape, order="F"
+    )
+
+
+def slab_planes(shape, n_vols, max_memory, n_copies=SLAB_COPIES):
+    """Number of z-planes per slab that keeps a stage under ``max_memory`` GB."""
+    plane_bytes = shape[0] * shape[1] * n_vols * 4 * n_copies
+    n_planes = int(float(max_memory) * 1024**3 // plane_bytes)
+    return min(max(n_planes, 1), shape[2])
+
+
+def _slabs(n_planes, slab_size):
+    for z0 in range(0, n_planes, slab_size):
+        yield z0, min(z0 + slab_size, n_planes)
+
+
+def _scratch_file(scratch_dir, in_fn, label):
+    name = op.basename(in_fn).split(".nii")[0]
+    return op.join(scratch_dir, f".chunked-{name}_{label}.nii")
+
+
+def chunked_nuisance_reg(
+    preproc_fn,
+    dummy_scans,
+    mask_fn,
+    tr_keep,
+    scratch_dir,
+    models,
+    spectral_files=None,
+    spectral_model=None,
+    max_memory=4,
+    polort=1,
+    codecs=None,
+    n_jobs=1,
+    keep_scratch=None,
+):
+    """Out-of-core counterpart of fused_nuisance_reg + write_spectral_metrics.
+
+    ``models`` is as in fused_nuisance_reg, with smoothing after denoising
+    only; every product is written censored to ``tr_keep``. The normalized
+    spectral metrics of the unfiltered residuals of ``spectral_model`` are
+    written to ``spectral_files`` (metric names to filenames). At most
+    ``max_memory`` GB of voxel data are kept in memory. Scratch files go to
+    ``scratch_dir`` and are removed on exit, except the uncompressed copy of
+    the product written to ``keep_scratch`` (an ``out_fn``), whose path is
+    returned for the caller to read (e.g. chunked_reho) and remove.
+    """
+    codecs = codecs or DEFAULT_CODECS
+    spectral_files = spectral_files or {}
+    products = [
+        product for _, model_products in models.values() for product in model_products
+    ]
+    for product in products:
+        if product["fwhm"] and (product["smoothing"] == "blur-then-project"):
+            raise ValueError(
+                "blur-then-project smoothing needs whole volumes and is not "
+                "available out-of-core"
+            )
+    scratch = {"input": _scratch_file(scratch_dir, preproc_fn, "input")}
+    kept = None
+    for i_product in range(len(products)):
+        for label in [f"product{i_product}", f"product{i_product}SM"]:
+            scratch[label] = _scratch_file(scratch_dir, preproc_fn, label)
+    try:
+        img = decompress_nifti(preproc_fn, scratch["input"])
+        mask = np.asanyarray(nib.load(mask_fn).dataobj) > 0
+        n_vols = img.shape[3] - dummy_scans
+        t_r = float(img.header.get_zooms()[3])
+
+        # Projection bases are shared by every slab
+        bases = {}
+        for name, (regressor_fn, model_products) in models.items():
+            regressors = load_regressors(regressor_fn)
+            if regressors.shape[0] != n_vols:
+                raise ValueError(
+                    f"{regressor_fn} has {regressors.shape[0]} rows, "
+                    f"expected {n_vols} volumes"
+                )
+            bases[name] = [
+                projection_basis(
+                    build_design(regressors, t_r, polort=polort, band_pass=band_pass)
+                )
+                for band_pass in [False, True]
+            ]
+
+        # MALFF/MRSFA need the whole-brain mean, so their base metric is kept
+        base_metrics = {"MALFF": "ALFF", "MRSFA": "RSFA"}
+        slab_metrics = sorted({base_metrics.get(m, m) for m in spectral_files})
+        metric_maps = {m: np.zeros(mask.shape, dtype=np.float32) for m in slab_metrics}
+
+        product_mm = [
+            create_memmap(img, scratch[f"product{i_product}"], len(tr_keep))
+            for i_product in range(len(products))
+        ]
+
+        slab_size = slab_planes(mask.shape, n_vols, max_memory)
+        print(f"\t\t\t{slab_size} z-plane(s) per slab", flush=True)
+        for z0, z1 in _slabs(mask.shape[2], slab_size):
+            slab_mask = mask[:, :, z0:z1]
+            if not slab_mask.any():
+                continue
+            slab = np.asarray(img.dataobj[:, :, z0:z1, dummy_scans:], dtype=np.float32)
+            # The slab's own container; its affine is only used for unmasking
+            masked = MaskedData(slab[slab_mask], slab_mask, img.affine, img.header)
+            del slab
+
+            i_product = 0
+            for name, (_, model_products) in models.items():
+                unfilt_basis, filt_basis = bases[name]
+                residuals = masked.with_data(
+                    project_out(masked.data, *unfilt_basis, overwrite=False)
+                )
+                filtered = None
+                if any(product["band_pass"] for product in model_products):
+                    filtered = project_out(residuals.data, *filt_basis, overwrite=False)
+                for product in model_products:
+                    source = filtered if product["band_pass"] else residuals.data
+                    product_mm[i_product][:, :, z0:z1, :] = residuals.unmask(
+                        source[:, tr_keep]
+                    )
+                    i_product += 1
+                if slab_metrics and (name == spectral_model):
+                    values = spectral_metrics(
+                        residuals, tr_keep, metrics=slab_metrics, n_jobs=n_jobs
+                    )
+                    for metric, value in values.items():
+                        metric_maps[metric][:, :, z0:z1] = value.unmask()
+                del residuals, filtered
+            del masked
+
+        for i_product, product in enumerate(products):
+            product_mm[i_product].flush()
+            if product["out_fn"] == keep_scratch:
+                kept = f"product{i_product}" + ("SM" if product["fwhm"] else "")
+            if product["fwhm"]:
+                sm_file = scratch[f"product{i_product}SM"]
+                _blur_memmap(
+                    product_mm[i_product],
+                    img,
+                    mask,
+                    sm_file,
+                    product["fwhm"],
+                    max_memory,
+                    n_jobs=n_jobs,
+                )
+                recode_nifti(sm_file, product["out_fn"], codecs["bold"])
+            else:
+                recode_nifti(
+                    scratch[f"product{i_product}"],
+                    product["out_fn"],
+                    codecs["bold"],
+                    remove_input=False,
+                )
+        del product_mm
+
+        if spectral_files:
+            for metric, base in base_metrics.items():
+                if metric in spectral_files:
+                    base_map = metric_maps[base]
+                    metric_maps[metric] = base_map / base_map[mask].mean()
+            normalize_metrics(
+                {out_fn: metric_maps[m] for m, out_fn in spectral_files.items()},
+                mask,
+                ref_img=img,
+                codec=codecs["map"],
+            )
+        kept = scratch.pop(kept, None)
+    finally:
+        for scratch_fn in scratch.values():
+            if op.exists(scratch_fn):
+                os.remove(scratch_fn)
+    return kept
+
+
+def _blur_memmap(data_mm, ref_img, mask, out_fn, fwhm, max_memory, n_jobs=1):
+    """Blur a memory-mapped 4D array within the mask, a batch of volumes at a time."""
+    n_vols = data_mm.shape[3]
+    out_mm = create_memmap(ref_img, out_fn, n_vols)
+    vol_bytes = int(np.prod(mask.shape)) * 4 * 3
+    batch = min(max(int(float(max_memory) * 1024**3 // vol_bytes), 1), n_vols)
+    zooms = ref_img.header.get_zooms()[:3]
+    for t0 in range(0, n_vols, batch):
+        t1 = min(t0 + batch, n_vols)
+        volumes = np.array(data_mm[..., t0:t1], dtype=np.float32)
+        volumes = blur_volumes(volumes, mask, fwhm, zooms, n_jobs=n_jobs)
+        volumes[~mask] = 0
+        out_mm[..., t0:t1] = volumes
+    out_mm.flush()
+    del out_mm
+
+
+def chunked_reho(
+    denoised_fn, reho_norm_fn, mask_fn, scratch_dir, max_memory=4, n_jobs=1, codec=None
+):
+    """Out-of-core counterpart of get_reho_numpy, over z-slabs with a one-plane halo.
+
+    Each slab is read together with its neighbouring planes, so every voxel
+    sees its full 27-voxel neighbourhood; only the inner planes are kept.
+    """
+    scratch_fn = _scratch_file(scratch_dir, denoised_fn, "reho")
+    try:
+        img = decompress_nifti(denoised_fn, scratch_fn)
+        mask = np.asanyarray(nib.load(mask_fn).dataobj) > 0
+        n_vols = img.shape[3]
+        reho = np.zeros(mask.shape, dtype=np.float32)
+        # Input slab, its in-mask voxels and their float32 ranks, plus the
+        # block-sized temporaries of kendall_w_reho
+        slab_size = slab_planes(mask.shape, n_vols, max_memory, n_copies=4)
+        nz = mask.shape[2]
+        for z0, z1 in _slabs(nz, slab_size):
+            lo, hi = max(z0 - 1, 0), min(z1 + 1, nz)
+            sub_mask = mask[:, :, lo:hi]
+            if not mask[:, :, z0:z1].any():
+                continue
+            slab = np.asarray(img.dataobj[:, :, lo:hi, :], dtype=np.float32)
+            masked = MaskedData(slab[sub_mask], sub_mask, img.affine, img.header)
+            del slab
+            sub_reho = kendall_w_reho(masked, n_jobs=n_jobs).unmask()
+            reho[:, :, z0:z1] = sub_reho[:, :, z0 - lo : z1 - lo]
+        normalize_metrics({reho_norm_fn: reho}, mask, ref_img=img, codec=codec)
+    finally:
+        if op.exists(scratch_fn):
+            os.remove(scratch_fn)
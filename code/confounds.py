@@ -0,0 +1,123 @@
+"""Column-projected, cached access to fMRIPrep confounds files."""
+import json
+import os
+import os.path as op
+
+import numpy as np
+import pandas as pd
+
+MOTION_LABELS = ["trans_x", "trans_y", "trans_z", "rot_x", "rot_y", "rot_z"]
+MOTION_DERIVATIVE_LABELS = [
+    "trans_x",
+    "trans_x_derivative1",
+    "trans_y",
+    "trans_y_derivative1",
+    "trans_z",
+    "trans_z_derivative1",
+    "rot_x",
+    "rot_x_derivative1",
+    "rot_y",
+    "rot_y_derivative1",
+    "rot_z",
+    "rot_z_derivative1",
+]
+MOTION_POWER2_LABELS = [f"{label}_power2" for label in MOTION_DERIVATIVE_LABELS]
+
+
+class ConfoundsLoader:
+    """Parse an fMRIPrep confounds TSV once, keeping only the denoising columns.
+
+    The sidecar JSON is read first to select the aCompCor components, and only
+    the motion, aCompCor, global signal and FD columns, plus ``extra_columns``,
+    are parsed (as float32).
+    When ``cache_file`` is given, the parsed columns are stored there as an
+    ``.npz`` keyed on the TSV size/mtime, so reruns and later stages skip the
+    text parsing.
+    """
+
+    def __init__(
+        self, confounds_file, cache_file=None, n_acompcor=3, extra_columns=()
+    ):
+        self.confounds_file = confounds_file
+        self.cache_file = cache_file
+        with open(confounds_file.replace(".tsv", ".json")) as json_file:
+            self.metadata = json.load(json_file)
+        self.acompcor_columns = self.select_acompcor(n_acompcor)
+        columns = (
+            MOTION_DERIVATIVE_LABELS
+            + self.acompcor_columns
+            + ["global_signal", "framewise_displacement"]
+            + list(extra_columns)
+        )
+        self.columns = list(dict.fromkeys(columns))
+        self._data = None
+
+    # Taken from Cody's pipeline
+    def select_acompcor(self, n_acompcor):
+        """The first ``n_acompcor`` CSF components followed by the first WM ones."""
+        metadata = self.metadata
+        w_comp_cor = sorted([x for x in metadata.keys() if "w_comp_cor" in x])
+        c_comp_cor = sorted([x for x in metadata.keys() if "c_comp_cor" in x])
+        # for muschelli 2014
+        acompcor_list_CSF = [x for x in c_comp_cor if metadata[x]["Mask"] == "CSF"]
+        acompcor_list_CSF = acompcor_list_CSF[0:n_acompcor]
+        acompcor_list_WM = [x for x in w_comp_cor if metadata[x]["Mask"] == "WM"]
+        acompcor_list_WM = acompcor_list_WM[0:n_acompcor]
+        return acompcor_list_CSF + acompcor_list_WM
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self._load_cache()
+        if self._data is None:
+            self._data = self._parse()
+            self._save_cache()
+        return self._data
+
+    def get(self, columns):
+        """Return the requested columns as a (time x columns) float32 array."""
+        return np.column_stack([self.data[col] for col in columns])
+
+    def _source_stamp(self):
+        stat = os.stat(self.confounds_file)
+        return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    def _parse(self):
+        wanted = set(self.columns)
+        confounds_df = pd.read_csv(
+            self.confounds_file,
+            sep="\t",
+            usecols=lambda col: col in wanted,
+            dtype=np.float32,
+        )
+        missing = wanted - set(confounds_df.columns)
+        if missing:
+            raise KeyError(
+                f"Columns {sorted(missing)} not found in {self.confounds_file}"
+            )
+        return {col: confounds_df[col].to_numpy() for col in self.columns}
+
+    def _load_cache(self):
+        if (self.cache_file is None) or (not op.exists(self.cache_file)):
+            return None
+        with np.load(self.cache_file) as cache:
+            if not np.array_equal(cache["source_stamp"], self._source_stamp()):
+                return None
+            cached_columns = cache["columns"].tolist()
+            if not set(self.columns).issubset(cached_columns):
+                return None
+            values = cache["values"]
+        return {col: values[:, cached_columns.index(col)] for col in self.columns}
+
+    def _save_cache(self):
+        if self.cache_file is None:
+            return
+        tmp_file = f"{self.cache_file}.tmp"
+        with open(tmp_file, "wb") as fo:
+            np.savez(
+                fo,
+                columns=np.array(self.columns),
+                values=self.get(self.columns),
+                source_stamp=self._source_stamp(),
+            )
+        os.replace(tmp_file, self.cache_file)
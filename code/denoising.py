@@ -1,14 +1,49 @@
 import argparse
+import asyncio
+import io
 import json
+import multiprocessing as mp
 import os
 import os.path as op
+import shlex
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, nullcontext, redirect_stdout
 from glob import glob
 from shutil import copyfile
 
 import numpy as np
 import pandas as pd
 
-from utils import enhance_censoring, fd_censoring, get_nvol, run_command
+from bids_index import subject_index
+from chunked import chunked_nuisance_reg, chunked_reho
+from confounds import ConfoundsLoader
+from exclusions import ExclusionRegistry
+from executor import THREAD_ENV_VARS, CommandExecutor
+from instrumentation import PROFILERS, StageRecorder
+from manifest import RunManifest, atomic_output, tool_versions
+from masked import MaskedData
+from metrics import (
+    SPECTRAL_METRICS,
+    get_reho_numpy,
+    normalize_metrics,
+    write_spectral_metrics,
+)
+from nifti_io import make_codecs, recode_nifti, scratch_ext
+from nuisance import fused_nuisance_reg, nuisance_reg_numpy
+from smoothing import SMOOTHING_MODES, blur_masked
+from strategies import (
+    MOTION_MODELS,
+    default_strategies,
+    describe,
+    extra_columns,
+    group_by_model,
+    load_strategies,
+    model_name,
+)
+
+# AFNI commands of one run that may run at once (projections, ALFF and ReHo)
+AFNI_CONCURRENCY = 2
 
 
 def _get_parser():
@@ -70,9 +105,23 @@ def _get_parser():
     parser.add_argument(
         "--desc_list",
         dest="desc_list",
-        required=True,
+        default=None,
+        required=False,
         nargs="+",
-        help="Name of the output files in the order [Clean, Clean + Smooth]",
+        help=(
+            "Name of the output files in the order [Clean, Clean + Smooth]; "
+            "required unless --strategies is given"
+        ),
+    )
+    parser.add_argument(
+        "--strategies",
+        dest="strategy_file",
+        default=None,
+        required=False,
+        help=(
+            "JSON list of denoising strategies (see strategies.py), solved over "
+            "one load of each run; used instead of --desc_list"
+        ),
     )
     parser.add_argument(
         "--n_jobs",
@@ -81,81 +130,134 @@ def _get_parser():
         required=False,
         help="CPUs",
     )
+    parser.add_argument(
+        "--backend",
+        dest="backend",
+        default="afni",
+        required=False,
+        choices=["afni", "numpy"],
+        help="Nuisance regression engine: AFNI 3dTproject or in-process NumPy",
+    )
+    parser.add_argument(
+        "--compress_level",
+        dest="compress_level",
+        default=6,
+        required=False,
+        help="Gzip level (0-9) of the final .nii.gz derivatives; 0 stores the data "
+        "in them without compression (fastest, full size)",
+    )
+    parser.add_argument(
+        "--bold_dtype",
+        dest="bold_dtype",
+        default="float32",
+        required=False,
+        choices=["float32", "int16"],
+        help="On-disk type of the denoised BOLD; int16 is stored with scl_slope",
+    )
+    parser.add_argument(
+        "--max_memory",
+        dest="max_memory",
+        default=None,
+        required=False,
+        help=(
+            "Memory ceiling (GB) per run for voxel data; streams memory-mapped "
+            "slabs instead of loading whole runs (numpy backend only)"
+        ),
+    )
+    parser.add_argument(
+        "--smoothing",
+        dest="smoothing",
+        default=None,
+        required=False,
+        choices=SMOOTHING_MODES,
+        help=(
+            "Smooth the denoised residuals, or blur the input before regressing "
+            "it (for validation); overrides the strategies' setting"
+        ),
+    )
+    parser.add_argument(
+        "--profile",
+        dest="profiler",
+        default=None,
+        required=False,
+        choices=PROFILERS,
+        help=(
+            "Profile the in-process stages into {clean_dir}/.../profiles; stage "
+            "timings are always written to *_stages.jsonl"
+        ),
+    )
+    parser.add_argument(
+        "--index_dir",
+        dest="index_dir",
+        default=None,
+        required=False,
+        help=(
+            "Directory to keep the listing of the subject's fMRIPrep files in, "
+            "reused until the directories change"
+        ),
+    )
     return parser
 
 
-def get_motionpar(confounds_file, derivatives=None):
-    confounds_df = pd.read_csv(confounds_file, sep="\t")
-    if derivatives:
-        motion_labels = [
-            "trans_x",
-            "trans_x_derivative1",
-            "trans_y",
-            "trans_y_derivative1",
-            "trans_z",
-            "trans_z_derivative1",
-            "rot_x",
-            "rot_x_derivative1",
-            "rot_y",
-            "rot_y_derivative1",
-            "rot_z",
-            "rot_z_derivative1",
-        ]
-    else:
-        motion_labels = ["trans_x", "trans_y", "trans_z", "rot_x", "rot_y", "rot_z"]
-    motion_regressors = confounds_df[motion_labels].values
+def get_motionpar(confounds, motion="12P"):
+    motion_regressors = confounds.get(MOTION_MODELS[motion])
     return motion_regressors
 
 
-# Taken from Cody's pipeline
-def get_acompcor(confounds_file):
+def get_acompcor(confounds, n_acompcor=None):
     print("\t\tGet aCompCor")
-    confounds_json_file = confounds_file.replace(".tsv", ".json")
-    confounds_df = pd.read_csv(confounds_file, sep="\t")
-    with open(confounds_json_file) as json_file:
-        data = json.load(json_file)
-    w_comp_cor = sorted([x for x in data.keys() if "w_comp_cor" in x])
-    c_comp_cor = sorted([x for x in data.keys() if "c_comp_cor" in x])
-    # for muschelli 2014
-    acompcor_list_CSF = [x for x in c_comp_cor if data[x]["Mask"] == "CSF"]
-    acompcor_list_CSF = acompcor_list_CSF[0:3]
-    acompcor_list_WM = [x for x in w_comp_cor if data[x]["Mask"] == "WM"]
-    acompcor_list_WM = acompcor_list_WM[0:3]
-    acompcor_list = []
-    acompcor_list.extend(acompcor_list_CSF)
-    acompcor_list.extend(acompcor_list_WM)
-
+    if n_acompcor is None:
+        acompcor_list = confounds.acompcor_columns
+    else:
+        acompcor_list = confounds.select_acompcor(n_acompcor)
     print(f"\t\t\tComponents: {acompcor_list}", flush=True)
-    acompcor_arr = confounds_df[acompcor_list].values
+    acompcor_arr = confounds.get(acompcor_list)
 
     return acompcor_arr
 
 
-def get_gsr(confounds_file):
-    confounds_df = pd.read_csv(confounds_file, sep="\t")
-
-    gsr_regressor = confounds_df["global_signal"].values
+def get_gsr(confounds):
+    gsr_regressor = confounds.get(["global_signal"])[:, 0]
     return gsr_regressor
 
 
-def add_outlier(mriqc_dir, prefix):
-    runs_to_exclude_df = pd.read_csv(
-        op.join(mriqc_dir, "runs_to_exclude.tsv"), sep="\t"
-    )
-    runs_to_exclude = runs_to_exclude_df["bids_name"].tolist()
+def get_regressors(confounds, strategy):
+    """Confound matrix of a strategy's model: motion, aCompCor and optionally GSR."""
+    regressors = [get_motionpar(confounds, strategy["motion"])]
+    if strategy["acompcor"]:
+        regressors.append(get_acompcor(confounds, strategy["acompcor"]))
+    if strategy["gsr"]:
+        regressors.append(get_gsr(confounds)[:, None])
+    return np.column_stack(regressors)
 
-    if prefix in runs_to_exclude:
-        print(f"\t\t\t{prefix} already in runs_to_exclude.tsv")
-    else:
-        runs_to_exclude.append(prefix)
-        new_runs_to_exclude_df = pd.DataFrame()
-        new_runs_to_exclude_df["bids_name"] = runs_to_exclude
-        new_runs_to_exclude_df.to_csv(
-            op.join(mriqc_dir, "runs_to_exclude.tsv"), sep="\t", index=False
-        )
+
+def add_outlier(mriqc_dir, prefix, **metrics):
+    registry = ExclusionRegistry(op.join(mriqc_dir, "exclusions"))
+    registry.add(prefix, "censored_volumes", "denoising", **metrics)
+
+
+def _remove_stale(*paths):
+    """Delete scratch outputs left by a killed run; AFNI refuses to overwrite them."""
+    for path in paths:
+        if op.lexists(path):
+            os.remove(path)
+
+
+def utils_censoring(confounds_file, fd_thresh, n_contig=0, n_before=0, n_after=0):
+    """FD censoring vector (1 = kept) from the lab's utils module.
+
+    utils is not part of this repository, so it is imported on first use.
+    """
+    from utils import enhance_censoring, fd_censoring
+
+    fd_cens = fd_censoring(confounds_file, fd_thresh)
+    return enhance_censoring(
+        fd_cens, n_contig=n_contig, n_before=n_before, n_after=n_after
+    )
 
 
-def nuisance_reg(
+async def nuisance_reg(
+    executor,
     preproc_fn,
     dummy_scans,
     denoised_fn,
@@ -163,7 +265,25 @@ def nuisance_reg(
     mask_fn,
     smooth=False,
     band_pass=False,
+    backend="afni",
+    fwhm=6,
 ):
+    if backend == "numpy":
+        print(f"\t\tnuisance_reg_numpy {preproc_fn} -> {denoised_fn}", flush=True)
+        await asyncio.to_thread(
+            nuisance_reg_numpy,
+            preproc_fn,
+            dummy_scans,
+            denoised_fn,
+            regressor_fn,
+            mask_fn,
+            smooth=smooth,
+            band_pass=band_pass,
+            fwhm=fwhm,
+        )
+        return
+
+    _remove_stale(denoised_fn)
     cmd = f"3dTproject \
                 -input {preproc_fn}[{dummy_scans}..$] \
                 -polort 1 \
@@ -171,78 +291,67 @@ def nuisance_reg(
                 -ort {regressor_fn} \
                 -mask {mask_fn}"
     if smooth:
-        cmd = cmd + " -blur 6"
+        cmd = cmd + f" -blur {fwhm}"
     if band_pass:
         cmd = cmd + " -passband 0.01 0.10"
-    print(f"\t\t{cmd}", flush=True)
-    os.system(cmd)
+    await executor.run_async(shlex.split(cmd))
 
 
-def afni2nifti(afni_fn, nifti_fn):
+async def afni2nifti(executor, afni_fn, nifti_fn):
+    _remove_stale(nifti_fn)
     cmd = f"3dAFNItoNIFTI \
                 -prefix {nifti_fn} \
                 {afni_fn}"
-    print(f"\t\t\t{cmd}", flush=True)
-    os.system(cmd)
+    await executor.run_async(shlex.split(cmd))
 
 
-def get_reho(denoised_fn, reho_fn, mask_fn):
+async def get_reho(executor, denoised_fn, reho_fn, mask_fn):
+    _remove_stale(*glob(f"{reho_fn}+*"))
     cmd = f"3dReHo \
                 -inset {denoised_fn} \
                 -prefix {reho_fn} \
                 -nneigh 27 \
                 -mask {mask_fn}"
-    print(f"\t\t\t{cmd}", flush=True)
-    os.system(cmd)
+    await executor.run_async(shlex.split(cmd))
 
 
-def power_spectrum(denoised_fn, rsfc_fn, censor_fn, mask_fn):
+async def power_spectrum(executor, denoised_fn, rsfc_fn, censor_fn, mask_fn):
+    # Also the metrics an interrupted 3dAmpToRSFC derived from a stale spectrum
+    _remove_stale(*glob(f"{rsfc_fn}_*.nii*"))
     cmd = f"3dLombScargle \
                 -inset {denoised_fn} \
                 -prefix {rsfc_fn} \
                 -censor_1D {censor_fn} \
                 -mask {mask_fn} \
                 -nifti"
-    print(f"\t\t\t{cmd}", flush=True)
-    os.system(cmd)
+    await executor.run_async(shlex.split(cmd))
 
 
-def rsfc_spectrum2metrics(rsfc_fn, mask_fn):
+async def rsfc_spectrum2metrics(executor, rsfc_fn, mask_fn):
+    _remove_stale(*(f"{rsfc_fn}_{metric}.nii.gz" for metric in SPECTRAL_METRICS))
     cmd = f"3dAmpToRSFC \
                 -in_amp {rsfc_fn}_amp.nii.gz \
                 -prefix {rsfc_fn} \
                 -band 0.01  0.1 \
                 -mask {mask_fn} \
                 -nifti"
-    print(f"\t\t\t{cmd}", flush=True)
-    os.system(cmd)
+    await executor.run_async(shlex.split(cmd))
 
 
-def normalize_metric(metric_nifti_file, metric_norm_file, mask_fn):
-    # Remove nans
-    cmd = f"fslmaths \
-                {metric_nifti_file} \
-                -nan \
-                {metric_nifti_file}"
-    print(f"\t\t\t\t{cmd}", flush=True)
-    os.system(cmd)
-
-    cmd = f"fslstats {metric_nifti_file} -M"
-    print(f"\t\t\t\t{cmd}", flush=True)
-    meanMetric = run_command(cmd)
+def _write_afni_product(censored_fn, out_fn, mask_fn, fwhm, codec, n_jobs=1):
+    """Encode a censored 3dTproject output, blurring it first if ``fwhm``."""
+    with atomic_output(out_fn) as tmp_file:
+        if fwhm:
+            print(f"\t\tblur_masked {censored_fn}", flush=True)
+            censored = MaskedData.from_nifti(censored_fn, mask_fn)
+            blur_masked(censored, fwhm, n_jobs=n_jobs).to_nifti(tmp_file, codec)
+        else:
+            recode_nifti(censored_fn, tmp_file, codec, remove_input=False)
 
-    cmd = f"fslstats {metric_nifti_file} -S"
-    print(f"\t\t\t\t{cmd}", flush=True)
-    stdMetric = run_command(cmd)
 
-    cmd = f"fslmaths \
-                {metric_nifti_file} \
-                -sub {meanMetric} \
-                -div {stdMetric} \
-                -mul {mask_fn} \
-                {metric_norm_file}"
-    print(f"\t\t\t\t{cmd}", flush=True)
-    os.system(cmd)
+def _normalize_afni_map(map_fn, out_fn, mask_fn, codec):
+    with atomic_output(out_fn) as tmp_file:
+        normalize_metrics({tmp_file: map_fn}, mask_fn, codec=codec)
 
 
 def run_3dtproject(
@@ -254,178 +363,451 @@ def run_3dtproject(
     fd_thresh,
     out_dir,
     desc_list,
+    backend="afni",
+    n_jobs=1,
+    compress_level=6,
+    bold_dtype="float32",
+    max_memory=None,
+    strategies=None,
+    profiler=None,
+    censor_func=None,
 ):
     preproc_name = op.basename(preproc_file)
     prefix = preproc_name.split("desc-")[0].rstrip("_")
     preproc_json_file = preproc_file.replace(".nii.gz", ".json")
+    # Scratch files are written uncompressed, final derivatives with these codecs
+    codecs = make_codecs(compress_level, bold_dtype, threads=n_jobs)
+    tmp_ext = scratch_ext(codecs)
+    # Strategies sharing a confound model are solved together; the first
+    # strategy's model feeds ALFF and its output feeds ReHo
+    strategies = strategies or default_strategies(desc_list)
+    models = group_by_model(strategies)
+    primary = model_name(strategies[0])
 
     # Determine output files
-    denoised_file = op.join(out_dir, f"{prefix}_desc-temp_bold.nii.gz")
-    # cens_file = op.join(out_dir, f"{prefix}_desc-tempCens_bold.nii.gz")
+    denoised_file = op.join(out_dir, f"{prefix}_desc-temp_bold{tmp_ext}")
+    censTcat_file = op.join(out_dir, f"{prefix}_desc-tempCens_bold{tmp_ext}")
     reho_file = op.join(out_dir, f"{prefix}_desc-REHO_REHO")
     reho_norm_file = op.join(out_dir, f"{prefix}_desc-REHOnorm_REHO.nii.gz")
     rsfc_file = op.join(out_dir, f"{prefix}_desc-RSFC")
     rsfc_norm_file = op.join(out_dir, f"{prefix}_desc-RSFCnorm")
-    denoisedFilt_file = op.join(out_dir, f"{prefix}_desc-tempFilt_bold.nii.gz")
-    denoisedFiltSM_file = op.join(out_dir, f"{prefix}_desc-tempFiltSM6_bold.nii.gz")
-    censFilt_file = op.join(out_dir, f"{prefix}_desc-{desc_list[0]}_bold.nii.gz")
-    censFiltSM_file = op.join(out_dir, f"{prefix}_desc-{desc_list[1]}_bold.nii.gz")
-
-    # Create regressor file
-    regressor_file = op.join(out_dir, f"{prefix}_regressors.1D")
-    if not op.exists(regressor_file):
-        # Create regressor matrix
-        motionpar = get_motionpar(confounds_file, derivatives=True)
-        acompcor = get_acompcor(confounds_file)
-        # gsr = get_gsr(confounds_file)
-        nuisance_regressors = np.column_stack((motionpar, acompcor))
-
-        # Some fMRIPrep nuisance regressors have NaN in the first row (e.g., derivatives)
-        nuisance_regressors = np.nan_to_num(nuisance_regressors, 0)
-        nuisance_regressors = np.delete(nuisance_regressors, range(dummy_scans), axis=0)
-        np.savetxt(regressor_file, nuisance_regressors, fmt="%.5f")
+    denoisedFilt_file = op.join(out_dir, f"{prefix}_desc-tempFilt_bold{tmp_ext}")
+    bold_files = {}
+    for strategy in strategies:
+        desc = strategy["desc"]
+        bold_files[desc] = op.join(out_dir, f"{prefix}_desc-{desc}_bold.nii.gz")
+    censFilt_file = bold_files[strategies[0]["desc"]]
+    fALFF_file = f"{rsfc_norm_file}_FALFF.nii.gz"
+    amp_file = f"{rsfc_file}_amp.nii.gz"
+
+    # Parsed lazily, once per run, and cached next to the regressor file
+    confounds = ConfoundsLoader(
+        confounds_file,
+        cache_file=op.join(out_dir, f"{prefix}_confounds.npz"),
+        n_acompcor=max(strategy["acompcor"] for strategy in strategies),
+        extra_columns=extra_columns(strategies),
+    )
+    # Stage fingerprints: only stages whose inputs or parameters changed rerun
+    manifest = RunManifest(op.join(out_dir, f"{prefix}_manifest.json"))
+    # Timing and resource use of the stages that do run
+    recorder = StageRecorder(
+        op.join(out_dir, f"{prefix}_stages.jsonl"),
+        prefix,
+        profiler=profiler,
+        profile_dir=op.join(out_dir, "profiles"),
+    )
+    versions = tool_versions(backend)
+
+    # Create one regressor file per confound model
+    regressor_files = {}
+    for name, model_strategies in models.items():
+        if name == primary:
+            regressor_file = op.join(out_dir, f"{prefix}_regressors.1D")
+        else:
+            model_desc = model_strategies[0]["desc"]
+            regressor_file = op.join(
+                out_dir, f"{prefix}_desc-{model_desc}_regressors.1D"
+            )
+        regressor_files[name] = regressor_file
+        regressor_key = manifest.fingerprint(
+            [confounds_file], {"dummy_scans": dummy_scans, "model": name}
+        )
+        stage = f"regressors:{name}"
+        if not manifest.is_current(stage, regressor_key, [regressor_file]):
+            with recorder.stage(stage):
+                # Create regressor matrix
+                nuisance_regressors = get_regressors(confounds, model_strategies[0])
+
+                # Some fMRIPrep regressors have NaN in the first row (e.g., derivatives)
+                nuisance_regressors = np.nan_to_num(nuisance_regressors, 0)
+                nuisance_regressors = np.delete(
+                    nuisance_regressors, range(dummy_scans), axis=0
+                )
+                with atomic_output(regressor_file) as tmp_file:
+                    np.savetxt(tmp_file, nuisance_regressors, fmt="%.5f")
+            manifest.record(stage, regressor_key, [regressor_file])
 
     # Create censoring file
     fd_before = 1
     fd_contig = 0
     fd_after = 1
     censor_file = op.join(out_dir, f"{prefix}_censoring{fd_thresh}.1D")
-    if not op.exists(censor_file):
-        fd_cens = fd_censoring(confounds_file, fd_thresh)
-        censor_data = enhance_censoring(
-            fd_cens, n_contig=fd_contig, n_before=fd_before, n_after=fd_after
-        )[dummy_scans:]
-        np.savetxt(censor_file, censor_data, fmt="%d")
+    censor_key = manifest.fingerprint(
+        [confounds_file],
+        {
+            "fd_thresh": fd_thresh,
+            "dummy_scans": dummy_scans,
+            "fd_before": fd_before,
+            "fd_contig": fd_contig,
+            "fd_after": fd_after,
+        },
+    )
+    if not manifest.is_current("censoring", censor_key, [censor_file]):
+        with recorder.stage("censoring"):
+            censor_data = (censor_func or utils_censoring)(
+                confounds_file,
+                fd_thresh,
+                n_contig=fd_contig,
+                n_before=fd_before,
+                n_after=fd_after,
+            )[dummy_scans:]
+            with atomic_output(censor_file) as tmp_file:
+                np.savetxt(tmp_file, censor_data, fmt="%d")
+        manifest.record("censoring", censor_key, [censor_file])
         tr_keep = np.where(censor_data == 1)[0].tolist()
     else:
         tr_censor = pd.read_csv(censor_file, header=None)
         tr_keep = tr_censor.index[tr_censor[0] == 1].tolist()
 
-    exclude = False
     # Add runs with < 100 volumes to outlier file
     if len(tr_keep) < 100:
-        exclude = True
         run_name = preproc_name.split("_space-")[0]
         print(
             f"\t\tVolumes={len(tr_keep)}, adding run {run_name} to outliers", flush=True
         )
-        add_outlier(mriqc_dir, run_name)
+        add_outlier(
+            mriqc_dir,
+            run_name,
+            n_volumes_kept=len(tr_keep),
+            fd_thresh=fd_thresh,
+            fd_mean=np.nanmean(confounds.data["framewise_displacement"]),
+        )
         return
 
-    # Denoise + band pass filter
-    if (
-        (not op.exists(denoisedFilt_file))
-        and (not op.exists(censFilt_file))
-        and (not exclude)
-    ):
-        nuisance_reg(
-            preproc_file,
-            dummy_scans,
-            denoisedFilt_file,
-            regressor_file,
-            mask_file,
-            smooth=False,
-            band_pass=True,
+    # The kept volumes rather than the censor file, whose name carries fd_thresh:
+    # a threshold that censors the same volumes reuses the outputs
+    regression_params = {
+        "tr_keep": tr_keep,
+        "dummy_scans": dummy_scans,
+        "backend": backend,
+        "versions": versions,
+    }
+    bold_keys, bold_current = {}, {}
+    for strategy in strategies:
+        desc = strategy["desc"]
+        regressor_file = regressor_files[model_name(strategy)]
+        bold_keys[desc] = manifest.fingerprint(
+            [preproc_file, mask_file, regressor_file],
+            dict(
+                regression_params,
+                band_pass=strategy["band_pass"],
+                fwhm=strategy["fwhm"],
+                smoothing=strategy["smoothing"],
+                bold_dtype=bold_dtype,
+            ),
         )
-    if (op.exists(denoisedFilt_file)) and (not op.exists(censFilt_file)):
-        cmd = f"3dTcat -prefix {censFilt_file} {denoisedFilt_file}'{tr_keep}'"
-        print(f"\t\t{cmd}", flush=True)
-        os.system(cmd)
-        os.remove(denoisedFilt_file)
-
-    # Denoise + band pass filter + smoothing
-    if (
-        (not op.exists(denoisedFiltSM_file))
-        and (not op.exists(censFiltSM_file))
-        and (not exclude)
-    ):
-        nuisance_reg(
-            preproc_file,
-            dummy_scans,
-            denoisedFiltSM_file,
-            regressor_file,
-            mask_file,
-            smooth=True,
-            band_pass=True,
+        bold_current[desc] = manifest.is_current(
+            f"bold:{desc}", bold_keys[desc], [bold_files[desc]]
         )
-    if (op.exists(denoisedFiltSM_file)) and (not op.exists(censFiltSM_file)):
-        cmd = f"3dTcat -prefix {censFiltSM_file} {denoisedFiltSM_file}'{tr_keep}'"
-        print(f"\t\t{cmd}", flush=True)
-        os.system(cmd)
-        os.remove(denoisedFiltSM_file)
-
-    # Calculate ReHo.
+    falff_key = manifest.fingerprint(
+        [preproc_file, mask_file, regressor_files[primary]],
+        regression_params,
+    )
+    falff_current = manifest.is_current("falff", falff_key, [fALFF_file])
+    stale = [s for s in strategies if not bold_current[s["desc"]]]
+    stale_descs = [strategy["desc"] for strategy in stale]
     reho_afniH_file = f"{reho_file}+tlrc.HEAD"
     reho_afniB_file = f"{reho_file}+tlrc.BRIK"
-    reho_nifti_file = f"{reho_file}.nii.gz"
-    if (not op.exists(reho_norm_file)) and (op.exists(censFilt_file)):
-        get_reho(censFilt_file, reho_file, mask_file)
-        afni2nifti(reho_afniH_file, reho_nifti_file)
-        os.remove(reho_afniH_file)
-        os.remove(reho_afniB_file)
-        # Add Normalization
-        normalize_metric(reho_nifti_file, reho_norm_file, mask_file)
-        os.remove(reho_nifti_file)
-
-    # Calculate ALFF, mALFF, fALFF, RSFA, etc.
-    metrics = ["ALFF", "FALFF", "FRSFA", "MALFF", "MRSFA", "RSFA"]
-    fALFF_file = f"{rsfc_norm_file}_FALFF.nii.gz"
-    if (not op.exists(denoised_file)) and (not op.exists(fALFF_file)) and (not exclude):
-        nuisance_reg(
-            preproc_file,
-            dummy_scans,
-            denoised_file,
-            regressor_file,
-            mask_file,
-            smooth=False,
-            band_pass=False,
+    reho_nifti_file = f"{reho_file}{tmp_ext}"
+
+    def _reho_key():
+        # ReHo reads the first strategy's output, so fingerprint it once written
+        return manifest.fingerprint(
+            [censFilt_file, mask_file], {"backend": backend, "versions": versions}
         )
-    amp_file = f"{rsfc_file}_amp.nii.gz"
-    if (
-        (not op.exists(amp_file))
-        and (not op.exists(fALFF_file))
-        and (op.exists(denoised_file))
-    ):
-        power_spectrum(denoised_file, rsfc_file, censor_file, mask_file)
-        os.remove(denoised_file)
-
-    if (not op.exists(fALFF_file)) and (op.exists(amp_file)):
-        rsfc_spectrum2metrics(rsfc_file, mask_file)
-        # Normalize metrics
-        for metric in metrics:
-            metric_file = f"{rsfc_file}_{metric}.nii.gz"
-            if metric == "FALFF":
-                metric_norm_file = f"{rsfc_norm_file}_{metric}.nii.gz"
-                normalize_metric(metric_file, metric_norm_file, mask_file)
-            os.remove(metric_file)
+
+    # Uncompressed copy of censFilt_file left by chunked_nuisance_reg for ReHo
+    reho_input = None
+    if (backend == "numpy") and (stale or not falff_current):
+        with ExitStack() as stack:
+            tmp_files = {
+                out_file: stack.enter_context(atomic_output(out_file))
+                for out_file in [bold_files[s["desc"]] for s in stale]
+                + ([] if falff_current else [fALFF_file])
+            }
+            model_products = _model_products(
+                models,
+                regressor_files,
+                stale,
+                {desc: tmp_files.get(fn) for desc, fn in bold_files.items()},
+                spectral_model=None if falff_current else primary,
+            )
+
+            if max_memory:
+                # Out-of-core: slabs of the memory-mapped run, one pass for all products
+                # Its scratch copy matches the output byte for byte unless stored
+                # as int16, and spares ReHo decompressing the output again
+                keep_scratch = None
+                if (strategies[0]["desc"] in stale_descs) and (
+                    codecs["bold"]["dtype"] is None
+                ):
+                    keep_scratch = tmp_files[censFilt_file]
+                with recorder.stage("regression", mode="chunked", products=stale_descs):
+                    print(f"\t\tchunked_nuisance_reg {preproc_file}", flush=True)
+                    reho_input = chunked_nuisance_reg(
+                        preproc_file,
+                        dummy_scans,
+                        mask_file,
+                        tr_keep,
+                        out_dir,
+                        model_products,
+                        spectral_files=None
+                        if falff_current
+                        else {"FALFF": tmp_files[fALFF_file]},
+                        spectral_model=primary,
+                        max_memory=max_memory,
+                        codecs=codecs,
+                        n_jobs=n_jobs,
+                        keep_scratch=keep_scratch,
+                    )
+            else:
+                # Single load; every model is solved against the same data matrix
+                with recorder.stage("regression", mode="fused", products=stale_descs):
+                    print(f"\t\tfused_nuisance_reg {preproc_file}", flush=True)
+                    residuals = fused_nuisance_reg(
+                        preproc_file,
+                        dummy_scans,
+                        mask_file,
+                        tr_keep,
+                        model_products,
+                        return_unfiltered=None if falff_current else primary,
+                        codec=codecs["bold"],
+                        n_jobs=n_jobs,
+                    )
+                if not falff_current:
+                    with recorder.stage("falff"):
+                        print(f"\t\t\twrite_spectral_metrics {censor_file}", flush=True)
+                        write_spectral_metrics(
+                            residuals,
+                            censor_file,
+                            {"FALFF": tmp_files[fALFF_file]},
+                            n_jobs=n_jobs,
+                            codec=codecs["map"],
+                        )
+                    del residuals
+        for strategy in stale:
+            desc = strategy["desc"]
+            manifest.record(f"bold:{desc}", bold_keys[desc], [bold_files[desc]])
+        if not falff_current:
+            manifest.record("falff", falff_key, [fALFF_file])
+    elif backend != "numpy":
+        # Denoise (+ band pass filter), one 3dTproject per model and passband;
+        # smoothed products blur the censored residuals in-process, unless
+        # they blur the input first (-blur) for validation
+        projections = {}
+        for strategy in stale:
+            blur_first = strategy["smoothing"] == "blur-then-project"
+            fwhm = strategy["fwhm"] if blur_first else 0
+            key = (model_name(strategy), strategy["band_pass"], fwhm)
+            projections.setdefault(key, []).append(strategy)
+        first_desc = strategies[0]["desc"]
+
+        async def _regression(first_output):
+            for (name, band_pass, fwhm), key_strategies in projections.items():
+                with recorder.stage(
+                    "regression", model=name, band_pass=band_pass, fwhm=fwhm
+                ):
+                    await nuisance_reg(
+                        executor,
+                        preproc_file,
+                        dummy_scans,
+                        denoisedFilt_file,
+                        regressor_files[name],
+                        mask_file,
+                        smooth=bool(fwhm),
+                        band_pass=band_pass,
+                        backend=backend,
+                        fwhm=fwhm,
+                    )
+                    selector = f"{denoisedFilt_file}'{tr_keep}'"
+                    _remove_stale(censTcat_file)
+                    cmd = f"3dTcat -prefix {censTcat_file} {selector}"
+                    await executor.run_async(shlex.split(cmd))
+                    os.remove(denoisedFilt_file)
+                for strategy in key_strategies:
+                    desc = strategy["desc"]
+                    blur_after = strategy["fwhm"] and not fwhm
+                    with recorder.stage(
+                        "smoothing" if blur_after else "encode", desc=desc
+                    ):
+                        await asyncio.to_thread(
+                            _write_afni_product,
+                            censTcat_file,
+                            bold_files[desc],
+                            mask_file,
+                            strategy["fwhm"] if blur_after else 0,
+                            codecs["bold"],
+                            n_jobs,
+                        )
+                    manifest.record(f"bold:{desc}", bold_keys[desc], [bold_files[desc]])
+                    if desc == first_desc:
+                        first_output.set()
+                os.remove(censTcat_file)
+
+        # Calculate ALFF, mALFF, fALFF, RSFA, etc.
+        async def _falff():
+            with recorder.stage("falff"):
+                await nuisance_reg(
+                    executor,
+                    preproc_file,
+                    dummy_scans,
+                    denoised_file,
+                    regressor_files[primary],
+                    mask_file,
+                    smooth=False,
+                    band_pass=False,
+                    backend=backend,
+                )
+                await power_spectrum(
+                    executor, denoised_file, rsfc_file, censor_file, mask_file
+                )
+                os.remove(denoised_file)
+                await rsfc_spectrum2metrics(executor, rsfc_file, mask_file)
+                # Normalize metrics
+                await asyncio.to_thread(
+                    _normalize_afni_map,
+                    f"{rsfc_file}_FALFF.nii.gz",
+                    fALFF_file,
+                    mask_file,
+                    codecs["map"],
+                )
+                for metric in SPECTRAL_METRICS:
+                    os.remove(f"{rsfc_file}_{metric}.nii.gz")
+                os.remove(amp_file)
+            manifest.record("falff", falff_key, [fALFF_file])
+
+        # Calculate ReHo, once the first strategy's output exists
+        async def _reho(first_output):
+            await first_output.wait()
+            reho_key = _reho_key()
+            if manifest.is_current("reho", reho_key, [reho_norm_file]):
+                return
+            with recorder.stage("reho"):
+                await get_reho(executor, censFilt_file, reho_file, mask_file)
+                await afni2nifti(executor, reho_afniH_file, reho_nifti_file)
+                os.remove(reho_afniH_file)
+                os.remove(reho_afniB_file)
+                # Add Normalization
+                await asyncio.to_thread(
+                    _normalize_afni_map,
+                    reho_nifti_file,
+                    reho_norm_file,
+                    mask_file,
+                    codecs["map"],
+                )
+                os.remove(reho_nifti_file)
+            manifest.record("reho", reho_key, [reho_norm_file])
+
+        # The ALFF branch only needs the regressors, so it runs alongside the
+        # projections; ReHo starts as soon as its input is written
+        executor = CommandExecutor(
+            op.join(out_dir, f"{prefix}_commands.log"),
+            max_procs=AFNI_CONCURRENCY,
+            threads=max(n_jobs // AFNI_CONCURRENCY, 1),
+            recorder=recorder,
+        )
+        first_output = asyncio.Event()
+        if bold_current[first_desc]:
+            first_output.set()
+        branches = [_regression(first_output), _reho(first_output)]
+        if not falff_current:
+            branches.append(_falff())
+        executor.gather(*branches)
+
+    # Calculate ReHo.
+    if backend == "numpy":
+        reho_key = _reho_key()
+        try:
+            if not manifest.is_current("reho", reho_key, [reho_norm_file]):
+                with recorder.stage("reho"):
+                    if max_memory:
+                        reho_in = reho_input or censFilt_file
+                        print(f"\t\t\tchunked_reho {reho_in}", flush=True)
+                        with atomic_output(reho_norm_file) as tmp_file:
+                            chunked_reho(
+                                reho_in,
+                                tmp_file,
+                                mask_file,
+                                out_dir,
+                                max_memory=max_memory,
+                                n_jobs=n_jobs,
+                                codec=codecs["map"],
+                            )
+                    else:
+                        print(f"\t\t\tget_reho_numpy {censFilt_file}", flush=True)
+                        with atomic_output(reho_norm_file) as tmp_file:
+                            get_reho_numpy(
+                                censFilt_file,
+                                tmp_file,
+                                mask_file,
+                                n_jobs=n_jobs,
+                                codec=codecs["map"],
+                            )
+                manifest.record("reho", reho_key, [reho_norm_file])
+        finally:
+            if reho_input:
+                os.remove(reho_input)
 
     # Create json files with Sources and Description fields
     # Load metadata for writing out later and TR now
-    if (op.exists(censFilt_file)) and (op.exists(censFiltSM_file)):
-        with open(preproc_json_file, "r") as fo:
-            json_info = json.load(fo)
-        json_info["Sources"] = [censFilt_file, mask_file, regressor_file]
-
-        SUFFIXES = {
-            "desc-aCompCorCens_bold": (
-                "Denoising with an aCompCor regression model including 5 PCA components from"
-                "WM and 5 from CSF deepest white matter, 6 motion parameters, GSR and first"
-                "temporal derivatives of motion parameters."
-            ),
-            "desc-aCompCorSM6Cens_bold": (
-                "Denoising with an aCompCor regression model including 5 PCA components from"
-                "WM and 5 from CSF deepest white matter, 6 motion parameters, GSR and first"
-                "temporal derivatives of motion parameters. Spatial smoothing was applied."
-            ),
-        }
-        for suffix, description in SUFFIXES.items():
-            nii_file = op.join(out_dir, f"{prefix}_{suffix}.nii.gz")
-            assert op.isfile(nii_file)
-
-            suff_json_file = op.join(out_dir, f"{prefix}_{suffix}.json")
-            json_info["Description"] = description
-            with open(suff_json_file, "w") as fo:
-                json.dump(json_info, fo, sort_keys=True, indent=4)
+    with open(preproc_json_file, "r") as fo:
+        json_info = json.load(fo)
+    for strategy in strategies:
+        desc = strategy["desc"]
+        if not op.isfile(bold_files[desc]):
+            continue
+        json_info["Sources"] = [
+            censFilt_file,
+            mask_file,
+            regressor_files[model_name(strategy)],
+        ]
+        json_info["Description"] = describe(strategy)
+        suff_json_file = op.join(out_dir, f"{prefix}_desc-{desc}_bold.json")
+        with open(suff_json_file, "w") as fo:
+            json.dump(json_info, fo, sort_keys=True, indent=4)
+
+
+def _model_products(models, regressor_files, stale, out_files, spectral_model=None):
+    """Regressor file and products still to write for each model.
+
+    Only models with stale products, or feeding the spectral metrics, are kept.
+    """
+    stale_descs = {strategy["desc"] for strategy in stale}
+    model_products = {}
+    for name, model_strategies in models.items():
+        products = [
+            {
+                "out_fn": out_files[strategy["desc"]],
+                "band_pass": strategy["band_pass"],
+                "fwhm": strategy["fwhm"],
+                "smoothing": strategy["smoothing"],
+            }
+            for strategy in model_strategies
+            if strategy["desc"] in stale_descs
+        ]
+        if products or (name == spectral_model):
+            model_products[name] = (regressor_files[name], products)
+    return model_products
 
 
 def main(
@@ -439,53 +821,72 @@ def main(
     dummy_scans,
     desc_list,
     n_jobs,
+    backend="afni",
+    compress_level=6,
+    bold_dtype="float32",
+    max_memory=None,
+    strategy_file=None,
+    smoothing=None,
+    profiler=None,
+    index_dir=None,
+    censor_func=None,
 ):
-    """Run denoising workflows on a given dataset."""
+    """Run denoising workflows on a given dataset.
+
+    ``censor_func`` replaces utils_censoring, e.g. where the lab's utils
+    module is not available (see benchmark.py).
+    """
     # Taken from Taylor's pipeline: https://github.com/ME-ICA/ddmra
     fd_thresh = float(fd_thresh)
     dummy_scans = int(dummy_scans)
-    os.system(f"export OMP_NUM_THREADS={n_jobs}")
+    if max_memory is not None:
+        max_memory = float(max_memory)
+        if backend != "numpy":
+            raise ValueError("--max_memory requires --backend numpy")
+    if strategy_file:
+        strategies = load_strategies(strategy_file)
+    else:
+        if not desc_list:
+            raise ValueError("desc_list is required unless strategy_file is given")
+        assert len(desc_list) == 2
+        strategies = default_strategies(desc_list)
+    if smoothing is not None:
+        strategies = [dict(strategy, smoothing=smoothing) for strategy in strategies]
+    if max_memory and any(
+        strategy["fwhm"] and (strategy["smoothing"] == "blur-then-project")
+        for strategy in strategies
+    ):
+        raise ValueError("blur-then-project smoothing is unavailable with --max_memory")
+    jobs = []
 
+    # One listing of the subject's fMRIPrep directory serves every lookup
+    index = subject_index(preproc_dir, subject, cache_dir=index_dir)
     if sessions[0] is None:
-        temp_ses = glob(op.join(preproc_dir, subject, "ses-*"))
-        if len(temp_ses) > 0:
-            sessions = [op.basename(x) for x in temp_ses]
+        found_ses = index.values("ses", datatype="func")
+        if len(found_ses) > 0:
+            sessions = [f"ses-{ses}" for ses in found_ses]
 
     for session in sessions:
         if session is not None:
-            preproc_subj_func_dir = op.join(preproc_dir, subject, session, "func")
             nuis_subj_dir = op.join(clean_dir, subject, session, "func")
+            ses = session.split("-", 1)[1]
         else:
-            preproc_subj_func_dir = op.join(preproc_dir, subject, "func")
             nuis_subj_dir = op.join(clean_dir, subject, "func")
+            ses = None
 
         # Collect important files
-        confounds_files = sorted(
-            glob(
-                op.join(
-                    preproc_subj_func_dir, "*task-rest*_desc-confounds_timeseries.tsv"
-                )
-            )
+        run_files = {"datatype": "func", "ses": ses, "task": "rest"}
+        confounds_files = index.files(
+            **run_files, desc="confounds", suffix="timeseries", extension=".tsv"
         )
-        preproc_files = sorted(
-            glob(
-                op.join(
-                    preproc_subj_func_dir,
-                    f"*task-rest*_space-{space}*_desc-preproc_bold.nii.gz",
-                )
-            )
+        preproc_files = index.files(
+            **run_files, space=space, desc="preproc", suffix="bold", extension=".nii.gz"
         )
-        mask_files = sorted(
-            glob(
-                op.join(
-                    preproc_subj_func_dir,
-                    f"*task-rest*_space-{space}*_desc-brain_mask.nii.gz",
-                )
-            )
+        mask_files = index.files(
+            **run_files, space=space, desc="brain", suffix="mask", extension=".nii.gz"
         )
         assert len(preproc_files) == len(confounds_files)
         assert len(preproc_files) == len(mask_files)
-        assert len(desc_list) == 2
 
         if len(preproc_files) > 0:
             os.makedirs(nuis_subj_dir, exist_ok=True)
@@ -502,24 +903,97 @@ def main(
             mask_file = op.join(nuis_subj_dir, mask_name)
             copyfile(mask_files[file], mask_file)
 
-            print(f"\tProcessing {subject} files:", flush=True)
-            print(f"\t\tDenoising: {preproc_file}", flush=True)
-            print(f"\t\tMask:      {mask_file}", flush=True)
-            print(f"\t\tConfound:  {confounds_files[file]}", flush=True)
-            run_3dtproject(
-                mriqc_dir,
-                preproc_file,
-                mask_file,
-                confounds_files[file],
-                dummy_scans,
-                fd_thresh,
-                nuis_subj_dir,
-                desc_list,
+            jobs.append(
+                {
+                    "mriqc_dir": mriqc_dir,
+                    "preproc_file": preproc_file,
+                    "mask_file": mask_file,
+                    "confounds_file": confounds_files[file],
+                    "dummy_scans": dummy_scans,
+                    "fd_thresh": fd_thresh,
+                    "out_dir": nuis_subj_dir,
+                    "desc_list": desc_list,
+                    "backend": backend,
+                    "compress_level": compress_level,
+                    "bold_dtype": bold_dtype,
+                    "max_memory": max_memory,
+                    "strategies": strategies,
+                    "profiler": profiler,
+                    "censor_func": censor_func,
+                }
             )
 
+    run_denoising_jobs(subject, jobs, n_jobs)
+
+
+def _run_denoising_job(subject, job, capture=True):
+    """Run one run_3dtproject call, returning its printed log and any traceback."""
+    log = io.StringIO()
+    error = None
+    with redirect_stdout(log) if capture else nullcontext():
+        print(f"\tProcessing {subject} files:", flush=True)
+        print(f"\t\tDenoising: {job['preproc_file']}", flush=True)
+        print(f"\t\tMask:      {job['mask_file']}", flush=True)
+        print(f"\t\tConfound:  {job['confounds_file']}", flush=True)
+        try:
+            run_3dtproject(**job)
+        except Exception:
+            error = traceback.format_exc()
+    return log.getvalue(), error
+
+
+def run_denoising_jobs(subject, jobs, n_jobs):
+    """Denoise runs on a process pool sized by n_jobs.
+
+    The CPUs are split between concurrent runs and the threads each run may
+    use (AFNI/BLAS through the environment, in-process stages through
+    run_3dtproject's n_jobs). Logs are printed in submission order and
+    failures are collected and raised together once every run has finished.
+    """
+    if not jobs:
+        return
+    n_jobs = int(n_jobs)
+    n_workers = max(min(n_jobs, len(jobs)), 1)
+    n_threads = max(n_jobs // n_workers, 1)
+    # Children inherit the environment, so this must be set before the pool starts
+    os.environ.update({var: str(n_threads) for var in THREAD_ENV_VARS})
+    for job in jobs:
+        job["n_jobs"] = n_threads
+
+    print(
+        f"\tDenoising {len(jobs)} run(s): "
+        f"{n_workers} worker(s) x {n_threads} thread(s)",
+        flush=True,
+    )
+    if n_workers == 1:
+        results = (_run_denoising_job(subject, job, capture=False) for job in jobs)
+        failed = _collect_results(jobs, results)
+    else:
+        with ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=mp.get_context("spawn")
+        ) as pool:
+            results = pool.map(_run_denoising_job, [subject] * len(jobs), jobs)
+            failed = _collect_results(jobs, results)
+
+    if failed:
+        raise RuntimeError(f"Denoising failed for {len(failed)} run(s): {failed}")
+
+
+def _collect_results(jobs, results):
+    failed = []
+    for job, (log, error) in zip(jobs, results):
+        print(log, end="", flush=True)
+        if error:
+            print(f"\t\tERROR in {job['preproc_file']}:\n{error}", flush=True)
+            failed.append(op.basename(job["preproc_file"]))
+    return failed
+
 
 def _main(argv=None):
-    option = _get_parser().parse_args(argv)
+    parser = _get_parser()
+    option = parser.parse_args(argv)
+    if (option.strategy_file is None) and not option.desc_list:
+        parser.error("--desc_list is required unless --strategies is given")
     kwargs = vars(option)
     main(**kwargs)
 
@@ -0,0 +1,152 @@
+"""Registry of excluded runs, safe for concurrent SLURM array tasks.
+
+Every writer process appends JSON lines to its own shard file under the
+registry directory, so writing never rewrites (or races on) a shared file.
+Readers merge all shards in time order. Entries are keyed by source, BIDS
+name and reason and carry the metrics behind the decision, so downstream
+steps can filter without re-parsing the MRIQC tables.
+
+Records are never edited in place; instead:
+
+- a source that recomputes all of its exclusions at once (mriqc_group) starts
+  a new generation, and only the entries of its latest generation count
+- ``revoke`` appends a tombstone that drops earlier matching entries
+"""
+import json
+import os
+import os.path as op
+import socket
+import time
+from glob import glob
+
+# Entities that identify a run; echo, space, desc and suffix are dropped
+RUN_ENTITIES = ["sub", "ses", "task", "acq", "run"]
+
+
+def run_key(bids_name):
+    """Reduce a BIDS name (e.g. ``..._run-01_echo-2_bold``) to its run-level key."""
+    parts = [
+        part
+        for part in bids_name.split("_")
+        if "-" in part and part.split("-")[0] in RUN_ENTITIES
+    ]
+    return "_".join(parts)
+
+
+class ExclusionRegistry:
+    """Sharded store of run exclusions under ``registry_dir``."""
+
+    def __init__(self, registry_dir):
+        self.registry_dir = registry_dir
+        self.shard_file = op.join(
+            registry_dir, f"{socket.gethostname()}-{os.getpid()}.jsonl"
+        )
+        self._generations = {}
+        self._index = None
+
+    def _append(self, record):
+        # Only this process writes its shard, so appends need no lock
+        os.makedirs(self.registry_dir, exist_ok=True)
+        record["time"] = time.time()
+        with open(self.shard_file, "a") as fo:
+            fo.write(json.dumps(record, sort_keys=True, default=float) + "\n")
+
+    def start_generation(self, source):
+        """Supersede every earlier entry of ``source`` by the ones added from now on."""
+        generation = f"{socket.gethostname()}-{os.getpid()}-{time.time_ns()}"
+        self._generations[source] = generation
+        self._append({"type": "generation", "source": source, "generation": generation})
+        return generation
+
+    def add(self, bids_name, reason, source, **metrics):
+        """Append one exclusion (O(1)), in the current generation of ``source``."""
+        self._append(
+            {
+                "type": "entry",
+                "bids_name": bids_name,
+                "run_key": run_key(bids_name),
+                "reason": reason,
+                "source": source,
+                "generation": self._generations.get(source),
+                "metrics": metrics,
+            }
+        )
+
+    def revoke(self, bids_name, source, reason=None):
+        """Drop the entries of ``source`` for ``bids_name`` (all reasons if None)."""
+        self._append(
+            {
+                "type": "revoke",
+                "bids_name": bids_name,
+                "reason": reason,
+                "source": source,
+            }
+        )
+
+    def _records(self):
+        records = []
+        for shard_file in sorted(glob(op.join(self.registry_dir, "*.jsonl"))):
+            with open(shard_file, "r") as fo:
+                for line in fo:
+                    # Skip a partially written trailing line from a killed task
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+        return sorted(records, key=lambda record: record["time"])
+
+    def entries(self):
+        """Entries in effect; the latest wins per (source, bids_name, reason)."""
+        merged, latest = {}, {}
+        for record in self._records():
+            kind = record.get("type", "entry")
+            if kind == "generation":
+                latest[record["source"]] = record["generation"]
+            elif kind == "revoke":
+                target = (record["source"], record["bids_name"], record["reason"])
+                for key in list(merged):
+                    if (key[:2] == target[:2]) and (target[2] in (None, key[2])):
+                        del merged[key]
+            else:
+                key = (record["source"], record["bids_name"], record["reason"])
+                merged[key] = record
+        current = [
+            entry
+            for entry in merged.values()
+            if (entry["source"] not in latest)
+            or (entry.get("generation") == latest[entry["source"]])
+        ]
+        return sorted(current, key=lambda e: (e["bids_name"], e["reason"], e["source"]))
+
+    def lookup(self, bids_names, sources=None, refresh=False):
+        """Map each name to the entries that exclude it.
+
+        A name matches entries recorded for the same BIDS name, plus run-level
+        entries (e.g. from denoising) for the same run, which apply to every
+        echo of that run. With ``sources`` only entries from those sources
+        count. The shards are read once and indexed; later calls reuse the
+        index unless ``refresh`` is set.
+        """
+        if refresh or (self._index is None):
+            by_name, by_run = {}, {}
+            for entry in self.entries():
+                by_name.setdefault(entry["bids_name"], []).append(entry)
+                if entry["bids_name"] == entry["run_key"]:
+                    by_run.setdefault(entry["run_key"], []).append(entry)
+            self._index = (by_name, by_run)
+        by_name, by_run = self._index
+
+        matches = {}
+        for name in bids_names:
+            found = list(by_name.get(name, []))
+            if name != run_key(name):
+                found += by_run.get(run_key(name), [])
+            if sources is not None:
+                found = [entry for entry in found if entry["source"] in sources]
+            matches[name] = found
+        return matches
+
+    def excluded(self, bids_names, sources=None, refresh=False):
+        """The subset of ``bids_names`` with at least one exclusion entry."""
+        matches = self.lookup(bids_names, sources=sources, refresh=refresh)
+        return {name for name, found in matches.items() if found}
@@ -0,0 +1,111 @@
+"""Run external tools (AFNI) as asyncio subprocesses.
+
+Commands are argument lists, run without a shell under a limit on how many
+run at once. Each gets its own thread budget through the environment, its
+output is appended to a per-run log, and a non-zero exit raises
+CommandError. Independent chains of commands of one run (e.g. ReHo and the
+ALFF branch) are scheduled together by awaiting them as concurrent tasks.
+"""
+import asyncio
+import os
+import shlex
+import time
+
+# Thread-count variables read by AFNI (OpenMP) and the BLAS behind NumPy
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]
+
+# Lines of output quoted in a CommandError
+ERROR_TAIL = 20
+
+
+class CommandError(RuntimeError):
+    """An external command exited with a non-zero status."""
+
+    def __init__(self, cmd, returncode, output):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.output = output
+        tail = "\n".join(output.splitlines()[-ERROR_TAIL:])
+        super().__init__(f"{shlex.join(cmd)} exited with {returncode}:\n{tail}")
+
+
+class CommandExecutor:
+    """Run commands with at most ``max_procs`` at once and ``threads`` each.
+
+    Output goes to ``log_file`` (if given) and, with a ``recorder`` (see
+    instrumentation.py), each command's wall time is added to the stage log.
+    Coroutines from run_async are run with gather (or run for a single one),
+    each call in a fresh event loop.
+    """
+
+    def __init__(self, log_file=None, max_procs=1, threads=1, env=None, recorder=None):
+        self.log_file = log_file
+        self.max_procs = max(int(max_procs), 1)
+        self.threads = max(int(threads), 1)
+        self.env = env or {}
+        self.recorder = recorder
+        self._semaphore = None
+
+    def _command_env(self, threads):
+        env = dict(os.environ)
+        env.update({var: str(threads) for var in THREAD_ENV_VARS})
+        env["AFNI_NIFTI_TYPE_WARN"] = "NO"
+        env.update(self.env)
+        return env
+
+    async def run_async(self, cmd, threads=None):
+        """Run ``cmd`` (a list of arguments) once a slot is free; returns its output."""
+        cmd = [str(arg) for arg in cmd]
+        async with self._semaphore:
+            print(f"\t\t{shlex.join(cmd)}", flush=True)
+            start, wall0 = time.time(), time.perf_counter()
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+                env=self._command_env(threads or self.threads),
+            )
+            try:
+                stdout, _ = await proc.communicate()
+            except asyncio.CancelledError:
+                # A sibling command failed; do not leave this one running
+                proc.kill()
+                await proc.wait()
+                raise
+            wall = time.perf_counter() - wall0
+
+        output = stdout.decode(errors="replace")
+        self._log(cmd, output, proc.returncode, wall)
+        if self.recorder is not None:
+            self.recorder.record_command(cmd, start, wall, proc.returncode)
+        if proc.returncode != 0:
+            raise CommandError(cmd, proc.returncode, output)
+        return output
+
+    def _log(self, cmd, output, returncode, wall):
+        if not self.log_file:
+            return
+        with open(self.log_file, "a") as fo:
+            fo.write(f"$ {shlex.join(cmd)}\n{output}")
+            if output and not output.endswith("\n"):
+                fo.write("\n")
+            fo.write(f"# exit {returncode} after {wall:.1f} s\n\n")
+
+    def gather(self, *coros):
+        """Run coroutines concurrently; the first failure cancels the others."""
+
+        async def _gather():
+            self._semaphore = asyncio.Semaphore(self.max_procs)
+            tasks = [asyncio.ensure_future(coro) for coro in coros]
+            try:
+                return await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+        return asyncio.run(_gather())
+
+    def run(self, cmd, threads=None):
+        """Run a single command and wait for it."""
+        return self.gather(self.run_async(cmd, threads=threads))[0]
@@ -0,0 +1,342 @@
+"""Per-stage timing and resource records, and their summary across runs.
+
+Each instrumented stage appends one JSON line to a per-run log next to the
+outputs (``{prefix}_stages.jsonl``) with:
+
+- ``wall_s``, ``cpu_s`` (this process) and ``cpu_children_s`` (waited-for
+  subprocesses, e.g. AFNI)
+- ``peak_rss_mb``: peak resident memory of this process during the stage;
+  ``peak_rss_scope`` is "process" where the peak cannot be reset, and
+  "concurrent" for stages that overlapped another one (the concurrent AFNI
+  branches), whose peak is the process's since the first of them started
+- ``peak_rss_children_mb``: largest subprocess started in the stage, None
+  when none outgrew an earlier one (a forked child counts its parent's pages
+  until it execs)
+- ``read_bytes``/``write_bytes``: I/O of this process and its waited-for
+  subprocesses
+
+Stages that overlap also share the CPU and I/O counters; each external
+command also gets a ``command:{tool}`` record with its wall time. Stages can
+also be profiled with cProfile or, if installed, pyinstrument. Run as a
+script to aggregate the logs of a denoising directory.
+"""
+import argparse
+import cProfile
+import json
+import os
+import os.path as op
+import resource
+import shlex
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from glob import glob
+
+import numpy as np
+import pandas as pd
+
+PROFILERS = ["cprofile", "pyinstrument"]
+
+# Runs whose stage wall time is this many robust z-scores above the median
+OUTLIER_Z = 3.5
+
+
+def _proc_io():
+    """Bytes read/written by this process and its reaped children (Linux only)."""
+    try:
+        with open("/proc/self/io", "r") as fo:
+            counters = dict(line.split(": ") for line in fo.read().splitlines())
+    except OSError:
+        return 0, 0
+    return int(counters["rchar"]), int(counters["wchar"])
+
+
+def _reset_peak_rss():
+    """Reset the kernel's high-water mark so VmHWM covers the next stage only."""
+    try:
+        with open("/proc/self/clear_refs", "w") as fo:
+            fo.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    try:
+        with open("/proc/self/status", "r") as fo:
+            for line in fo:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Lifetime peak where the high-water mark is unavailable
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _start_profiler(profiler):
+    if profiler == "cprofile":
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        raise ValueError("--profile pyinstrument requires the pyinstrument package")
+    profile = Profiler()
+    profile.start()
+    return profile
+
+
+def _stop_profiler(profile, profile_file):
+    if isinstance(profile, cProfile.Profile):
+        profile.disable()
+        profile.dump_stats(f"{profile_file}.prof")
+        return
+    profile.stop()
+    with open(f"{profile_file}.html", "w") as fo:
+        fo.write(profile.output_html())
+
+
+class StageRecorder:
+    """Append timing and resource records of a run's stages to ``log_file``.
+
+    With ``profiler`` ("cprofile" or "pyinstrument") each stage is also
+    profiled into ``profile_dir``.
+    """
+
+    def __init__(self, log_file, run, profiler=None, profile_dir=None):
+        if (profiler is not None) and (profiler not in PROFILERS):
+            raise ValueError(f"Unknown profiler {profiler}; expected {PROFILERS}")
+        self.log_file = log_file
+        self.run = run
+        self.profiler = profiler
+        self.profile_dir = profile_dir or op.dirname(log_file)
+        self._profiling = False
+        # Open stages; the peak is only reset when none is, so overlapping
+        # stages never reset each other's high-water mark
+        self._active = {}
+        self._lock = threading.Lock()
+        self._hwm = False
+
+    @contextmanager
+    def stage(self, name, **info):
+        """Time the enclosed block as stage ``name``; ``info`` is stored with it."""
+        state = {"overlapped": False}
+        with self._lock:
+            if self._active:
+                state["overlapped"] = True
+                for other in self._active.values():
+                    other["overlapped"] = True
+            else:
+                self._hwm = _reset_peak_rss()
+            hwm = self._hwm
+            self._active[id(state)] = state
+        children0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+        read0, write0 = _proc_io()
+        cpu0 = time.process_time()
+        start, wall0 = time.time(), time.perf_counter()
+        # One profiler at a time; a stage overlapping a profiled one is not profiled
+        profile = None
+        if self.profiler and not self._profiling:
+            profile = _start_profiler(self.profiler)
+            self._profiling = True
+        status = "error"
+        try:
+            yield
+            status = "ok"
+        finally:
+            wall = time.perf_counter() - wall0
+            cpu = time.process_time() - cpu0
+            if profile is not None:
+                self._profiling = False
+                os.makedirs(self.profile_dir, exist_ok=True)
+                stage_label = name.replace(":", "-").replace("/", "-")
+                _stop_profiler(
+                    profile, op.join(self.profile_dir, f"{self.run}_{stage_label}")
+                )
+            children1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu_children = (children1.ru_utime + children1.ru_stime) - (
+                children0.ru_utime + children0.ru_stime
+            )
+            # ru_maxrss of children is the largest reaped child so far
+            peak_children = None
+            if children1.ru_maxrss > children0.ru_maxrss:
+                peak_children = children1.ru_maxrss / 1024
+            read1, write1 = _proc_io()
+            with self._lock:
+                del self._active[id(state)]
+                peak_rss = _peak_rss_mb()
+            if not hwm:
+                scope = "process"
+            elif state["overlapped"]:
+                scope = "concurrent"
+            else:
+                scope = "stage"
+            self._write(
+                {
+                    "run": self.run,
+                    "stage": name,
+                    "status": status,
+                    "start": start,
+                    "wall_s": wall,
+                    "cpu_s": cpu,
+                    "cpu_children_s": cpu_children,
+                    "peak_rss_mb": peak_rss,
+                    "peak_rss_scope": scope,
+                    "peak_rss_children_mb": peak_children,
+                    "read_bytes": read1 - read0,
+                    "write_bytes": write1 - write0,
+                    "host": socket.gethostname(),
+                    "pid": os.getpid(),
+                    "info": info,
+                }
+            )
+
+    def record_command(self, cmd, start, wall, returncode):
+        """Log an external command's wall time as stage ``command:{tool}``.
+
+        Commands may run concurrently, so no per-command resource use is kept.
+        """
+        self._write(
+            {
+                "run": self.run,
+                "stage": f"command:{op.basename(cmd[0])}",
+                "status": "ok" if returncode == 0 else "error",
+                "start": start,
+                "wall_s": wall,
+                "host": socket.gethostname(),
+                "pid": os.getpid(),
+                "info": {"cmd": shlex.join(cmd), "returncode": returncode},
+            }
+        )
+
+    def _write(self, record):
+        with open(self.log_file, "a") as fo:
+            fo.write(json.dumps(record, default=str) + "\n")
+
+
+def load_records(log_dir):
+    """All stage records of the ``*_stages.jsonl`` logs under ``log_dir``."""
+    records = []
+    log_files = glob(op.join(log_dir, "**", "*_stages.jsonl"), recursive=True)
+    for log_file in sorted(log_files):
+        with open(log_file, "r") as fo:
+            for line in fo:
+                # Skip a partially written trailing line from a killed job
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    return pd.DataFrame.from_records(records)
+
+
+def summarize_stages(records):
+    """Per-stage totals and spread of wall time, CPU, memory and I/O."""
+    # Peaks shared by overlapping stages are kept apart from per-stage ones
+    concurrent = records["peak_rss_scope"] == "concurrent"
+    records = records.assign(
+        cpu_total_s=records["cpu_s"] + records["cpu_children_s"],
+        peak_rss_concurrent_mb=records["peak_rss_mb"].where(concurrent),
+        peak_rss_mb=records["peak_rss_mb"].mask(concurrent),
+    )
+    summary = records.groupby("stage").agg(
+        n_runs=("run", "nunique"),
+        n_calls=("wall_s", "size"),
+        wall_total_s=("wall_s", "sum"),
+        wall_median_s=("wall_s", "median"),
+        wall_max_s=("wall_s", "max"),
+        cpu_total_s=("cpu_total_s", "sum"),
+        peak_rss_max_mb=("peak_rss_mb", "max"),
+        peak_rss_concurrent_max_mb=("peak_rss_concurrent_mb", "max"),
+        peak_rss_children_max_mb=("peak_rss_children_mb", "max"),
+        read_total_gb=("read_bytes", lambda x: x.sum() / 1024**3),
+        write_total_gb=("write_bytes", lambda x: x.sum() / 1024**3),
+    )
+    # Commands run within stages, so shares are of the stages' total only
+    in_stages = summary.index.str.startswith("command:")
+    stage_total = summary.loc[~in_stages, "wall_total_s"].sum()
+    summary["wall_share"] = summary["wall_total_s"] / stage_total
+    return summary.sort_values("wall_total_s", ascending=False)
+
+
+def find_outliers(records, z_thresh=OUTLIER_Z):
+    """Runs whose wall time in a stage is far above that stage's median.
+
+    Uses the robust z-score 0.6745 * (x - median) / MAD of the per-run wall
+    time, summed over repeated calls of a stage within a run.
+    """
+    per_run = records.groupby(["stage", "run"], as_index=False)["wall_s"].sum()
+    outliers = []
+    for stage, stage_runs in per_run.groupby("stage"):
+        wall = stage_runs["wall_s"].to_numpy()
+        median = np.median(wall)
+        mad = np.median(np.abs(wall - median))
+        if mad == 0:
+            continue
+        robust_z = 0.6745 * (wall - median) / mad
+        flagged = stage_runs[robust_z > z_thresh].assign(
+            stage_median_s=median, robust_z=robust_z[robust_z > z_thresh]
+        )
+        outliers.append(flagged)
+    if not outliers:
+        return per_run.iloc[:0]
+    return pd.concat(outliers).sort_values("robust_z", ascending=False)
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description="Summarize per-stage timing records of denoising runs"
+    )
+    parser.add_argument(
+        "--clean_dir",
+        dest="clean_dir",
+        required=True,
+        help="Path to denoising directory",
+    )
+    parser.add_argument(
+        "--out_prefix",
+        dest="out_prefix",
+        default=None,
+        required=False,
+        help="Write {out_prefix}_stages.tsv and {out_prefix}_outliers.tsv",
+    )
+    parser.add_argument(
+        "--z_thresh",
+        dest="z_thresh",
+        default=OUTLIER_Z,
+        required=False,
+        help="Robust z-score above which a run is reported as an outlier",
+    )
+    return parser
+
+
+def main(clean_dir, out_prefix=None, z_thresh=OUTLIER_Z):
+    """Print the slowest stages and the outlier runs under clean_dir."""
+    records = load_records(clean_dir)
+    if records.empty:
+        print(f"No stage records found under {clean_dir}", flush=True)
+        return
+    records = records[records["status"] == "ok"]
+    summary = summarize_stages(records)
+    outliers = find_outliers(records, float(z_thresh))
+
+    with pd.option_context("display.width", 160, "display.max_columns", None):
+        print(f"{records['run'].nunique()} runs, {len(records)} stage records\n")
+        print(summary.round(3).to_string(), flush=True)
+        print(f"\nOutlier runs (robust z > {z_thresh}):")
+        print(outliers.round(3).to_string(index=False), flush=True)
+
+    if out_prefix:
+        summary.to_csv(f"{out_prefix}_stages.tsv", sep="\t")
+        outliers.to_csv(f"{out_prefix}_outliers.tsv", sep="\t", index=False)
+
+
+def _main(argv=None):
+    option = _get_parser().parse_args(argv)
+    kwargs = vars(option)
+    main(**kwargs)
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,110 @@
+"""Per-run manifest of stage fingerprints, used to rerun only stale stages."""
+import hashlib
+import json
+import os
+import os.path as op
+import subprocess
+from contextlib import contextmanager
+from functools import lru_cache
+from importlib import metadata
+
+# Files up to this size are fingerprinted by content, larger ones by size/mtime
+HASH_SIZE_LIMIT = 64 * 1024**2
+
+
+def file_fingerprint(path):
+    """Content hash for small files, size and mtime for large ones (e.g. 4D BOLD)."""
+    stat = os.stat(path)
+    if stat.st_size > HASH_SIZE_LIMIT:
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    sha = hashlib.sha256()
+    with open(path, "rb") as fo:
+        for block in iter(lambda: fo.read(1024**2), b""):
+            sha.update(block)
+    return {"sha256": sha.hexdigest()}
+
+
+@lru_cache(maxsize=None)
+def tool_versions(backend):
+    """Versions of the libraries (and AFNI or tedana backends) that shape outputs."""
+    versions = {}
+    for package in ["numpy", "scipy", "nibabel", "pandas"]:
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    if backend == "afni":
+        try:
+            afni = subprocess.run(["afni", "-ver"], capture_output=True, text=True)
+            versions["afni"] = afni.stdout.strip()
+        except OSError:
+            versions["afni"] = None
+    elif backend == "tedana":
+        try:
+            versions["tedana"] = metadata.version("tedana")
+        except metadata.PackageNotFoundError:
+            versions["tedana"] = None
+    return versions
+
+
+@contextmanager
+def atomic_output(path):
+    """Yield a temporary path next to ``path`` and move it into place on success.
+
+    A killed job therefore never leaves a truncated file under the final name.
+    The temporary name keeps the extension so NIfTI writers pick the format.
+    """
+    tmp_path = op.join(op.dirname(path), f".tmp-{op.basename(path)}")
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if op.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class RunManifest:
+    """JSON record of the fingerprint each stage's outputs were built from.
+
+    A stage is current when its stored fingerprint matches the one computed
+    from its present inputs and parameters, and all of its outputs still exist
+    with the recorded sizes.
+    """
+
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.stages = {}
+        if op.exists(manifest_file):
+            with open(manifest_file, "r") as fo:
+                self.stages = json.load(fo)
+
+    @staticmethod
+    def fingerprint(inputs, params):
+        key = {
+            "inputs": {path: file_fingerprint(path) for path in inputs},
+            "params": params,
+        }
+        key = json.dumps(key, sort_keys=True, default=str)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def is_current(self, stage, fingerprint, outputs):
+        record = self.stages.get(stage)
+        if (record is None) or (record["fingerprint"] != fingerprint):
+            return False
+        return all(
+            op.exists(out) and (op.getsize(out) == record["outputs"].get(out))
+            for out in outputs
+        )
+
+    def outputs(self, stage):
+        """Outputs recorded for ``stage``; empty if it never completed."""
+        return sorted(self.stages.get(stage, {}).get("outputs", {}))
+
+    def record(self, stage, fingerprint, outputs):
+        self.stages[stage] = {
+            "fingerprint": fingerprint,
+            "outputs": {out: op.getsize(out) for out in outputs},
+        }
+        with atomic_output(self.manifest_file) as tmp_file:
+            with open(tmp_file, "w") as fo:
+                json.dump(self.stages, fo, sort_keys=True, indent=4)
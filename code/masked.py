@@ -0,0 +1,158 @@
+"""Compact container for the in-mask voxels of a NIfTI image."""
+import itertools
+
+import nibabel as nib
+import numpy as np
+
+from nifti_io import DEFAULT_CODECS, ParallelGzipWriter, save_nifti, write_header
+
+# Volumes decoded at a time when masking a 4D image
+LOAD_BATCH = 64
+
+
+class MaskedData:
+    """In-mask voxels of a 3D/4D image as a 2D float32 (voxels x time) array.
+
+    Rows follow the C order of ``mask`` and ``indices`` maps each row to its
+    flat position in the grid. Only the mask, affine and header are kept next
+    to the data, so the out-of-mask part of the bounding box is allocated only
+    when the data are unmasked for writing.
+    """
+
+    def __init__(self, data, mask, affine, header=None):
+        data = np.asarray(data, dtype=np.float32)
+        if data.ndim == 1:
+            data = data[:, None]
+        if data.shape[0] != np.count_nonzero(mask):
+            raise ValueError(
+                f"Got {data.shape[0]} rows for a mask of "
+                f"{np.count_nonzero(mask)} voxels"
+            )
+        self.data = data
+        self.mask = mask
+        self.affine = affine
+        self.header = header
+        self._index_grid = None
+
+    @classmethod
+    def from_nifti(cls, img, mask, dummy_scans=0):
+        """Mask an image or filename with a mask image, filename or boolean array.
+
+        4D data are decoded a batch of volumes at a time, so the full grid is
+        never held in memory; the first ``dummy_scans`` volumes are dropped.
+        """
+        if isinstance(img, str):
+            img = nib.load(img, keep_file_open=True)
+        if isinstance(mask, str):
+            mask = nib.load(mask)
+        if not isinstance(mask, np.ndarray):
+            mask = np.asanyarray(mask.dataobj) > 0
+
+        if img.ndim == 3:
+            data = img.get_fdata(dtype=np.float32)[mask]
+        else:
+            n_vols = img.shape[3]
+            data = np.empty((np.count_nonzero(mask), n_vols - dummy_scans), np.float32)
+            for t0 in range(dummy_scans, n_vols, LOAD_BATCH):
+                t1 = min(t0 + LOAD_BATCH, n_vols)
+                batch = np.asarray(img.dataobj[..., t0:t1], dtype=np.float32)
+                data[:, t0 - dummy_scans : t1 - dummy_scans] = batch[mask]
+        return cls(data, mask, img.affine, img.header)
+
+    def with_data(self, data):
+        """A container for new data on the same mask (e.g. residuals, maps)."""
+        masked = MaskedData(data, self.mask, self.affine, self.header)
+        masked._index_grid = self._index_grid
+        return masked
+
+    @property
+    def n_voxels(self):
+        return self.data.shape[0]
+
+    @property
+    def n_vols(self):
+        return self.data.shape[1]
+
+    @property
+    def indices(self):
+        return np.flatnonzero(self.mask)
+
+    @property
+    def zooms(self):
+        return self.header.get_zooms()[:3]
+
+    @property
+    def t_r(self):
+        return float(self.header.get_zooms()[3])
+
+    def unmask(self, data=None):
+        """Dense grid for ``data`` (defaults to ``self.data``), zero outside the mask.
+
+        Single-column data give a 3D map, anything else a 4D series.
+        """
+        data = self.data if data is None else data
+        if data.ndim == 2 and data.shape[1] == 1:
+            data = data[:, 0]
+        dense = np.zeros(self.mask.shape + data.shape[1:], dtype=np.float32)
+        dense[self.mask] = data
+        return dense
+
+    def to_nifti(self, out_fn=None, codec=None):
+        """Unmask into a float32 image, also written to ``out_fn`` if given."""
+        img = nib.Nifti1Image(self.unmask(), self.affine, self.header)
+        img.set_data_dtype(np.float32)
+        img.header.set_slope_inter(1, 0)
+        if out_fn:
+            save_nifti(img, out_fn, codec)
+        return img
+
+    def write_volumes(self, out_fn, codec=None):
+        """Write a 4D float32 (or ``codec["dtype"]``) image one volume at a time.
+
+        Unlike to_nifti, the dense series is never held in memory, only one of
+        its volumes; for int16 the slope is set from the largest absolute value.
+        """
+        codec = codec or DEFAULT_CODECS["bold"]
+        header = self.header.copy()
+        header.set_data_shape(self.mask.shape + (self.n_vols,))
+        header.set_sform(self.affine)
+        header.set_qform(self.affine)
+        dtype = np.dtype(codec["dtype"] or np.float32)
+        slope = 1.0
+        if dtype.kind != "f":
+            max_abs = float(np.abs(self.data).max()) if self.data.size else 0.0
+            slope = max_abs / np.iinfo(dtype).max if max_abs > 0 else 1.0
+        header.set_data_dtype(dtype)
+        header.set_slope_inter(slope, 0)
+        out_dtype = header.get_data_dtype()
+
+        if out_fn.endswith(".gz"):
+            level, threads = codec["level"], codec["threads"]
+            fo = ParallelGzipWriter(out_fn, level=level, threads=threads)
+        else:
+            fo = open(out_fn, "wb")
+        with fo:
+            write_header(fo, header)
+            volume = np.zeros(self.mask.shape, dtype=np.float32)
+            for i_vol in range(self.n_vols):
+                volume[self.mask] = self.data[:, i_vol]
+                if slope != 1.0:
+                    volume = np.round(volume / slope)
+                fo.write(volume.astype(out_dtype).tobytes(order="F"))
+
+    def index_grid(self):
+        """Grid of row indices, -1 outside the mask."""
+        if self._index_grid is None:
+            grid = np.full(self.mask.shape, -1, dtype=np.int32)
+            grid[self.mask] = np.arange(self.n_voxels, dtype=np.int32)
+            self._index_grid = grid
+        return self._index_grid
+
+    def neighbours(self):
+        """(voxels x 27) rows of each voxel's 3x3x3 neighbourhood, -1 outside mask."""
+        padded = np.pad(self.index_grid(), 1, constant_values=-1)
+        x, y, z = np.nonzero(self.mask)
+        offsets = itertools.product(range(3), repeat=3)
+        return np.column_stack(
+            [padded[x + dx, y + dy, z + dz] for dx, dy, dz in offsets]
+        )
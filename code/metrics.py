@@ -0,0 +1,212 @@
+"""In-process ReHo and ALFF-family metrics, replacing the AFNI/FSL calls in denoising.py."""
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel as nib
+import numpy as np
+from scipy.stats import rankdata
+
+from masked import MaskedData
+from nifti_io import save_nifti
+from nuisance import HIGH_PASS, LOW_PASS
+
+SPECTRAL_METRICS = ["ALFF", "FALFF", "FRSFA", "MALFF", "MRSFA", "RSFA"]
+
+
+def kendall_w_reho(masked, n_jobs=1, block_size=4096):
+    """Kendall's W over the 27-voxel neighbourhood of every in-mask voxel.
+
+    ``masked`` is a MaskedData series. Ranks are computed once per time
+    series and the neighbourhood rank sums are gathered through the
+    container's neighbour index, so only in-mask voxels are touched.
+    Neighbours outside the mask are ignored, as in 3dReHo. Returns a
+    single-column MaskedData map.
+    """
+    n_vols = masked.n_vols
+    # A trailing zero row is picked up by the -1 index of out-of-mask neighbours
+    ranks = np.zeros((masked.n_voxels + 1, n_vols), dtype=np.float32)
+    neighbours = masked.neighbours()
+    n_neigh = (neighbours >= 0).sum(axis=1).astype(np.float64)
+    reho = np.zeros(masked.n_voxels, dtype=np.float32)
+    blocks = range(0, masked.n_voxels, block_size)
+
+    def _rank(start):
+        # rankdata returns float64, so only a block of it exists at a time
+        stop = min(start + block_size, masked.n_voxels)
+        ranks[start:stop] = rankdata(masked.data[start:stop], axis=1)
+
+    def _block(start):
+        stop = min(start + block_size, masked.n_voxels)
+        rank_sum = np.zeros((stop - start, n_vols), dtype=np.float32)
+        for i_neigh in range(neighbours.shape[1]):
+            rank_sum += ranks[neighbours[start:stop, i_neigh]]
+        rank_sum -= (n_neigh[start:stop] * (n_vols + 1) / 2)[:, None]
+        s = np.square(rank_sum).sum(axis=1, dtype=np.float64)
+        reho[start:stop] = 12 * s / (n_neigh[start:stop] ** 2 * (n_vols**3 - n_vols))
+
+    with ThreadPoolExecutor(max_workers=max(int(n_jobs), 1)) as pool:
+        list(pool.map(_rank, blocks))
+        list(pool.map(_block, blocks))
+
+    return masked.with_data(reho)
+
+
+def lomb_scargle_basis(tr_keep, n_vols, t_r):
+    """Precompute the Lomb-Scargle sin/cos basis for the kept TRs.
+
+    Frequencies are k / (n_vols * t_r) for k = 1..n_vols // 2, i.e. the grid
+    of the uncensored run, as in 3dLombScargle. The phase offset tau only
+    depends on the sampling times, so the basis is shared by every voxel and
+    each column is normalized so that the periodogram is a sum of squares.
+    """
+    t = np.asarray(tr_keep, dtype=np.float64) * t_r
+    freqs = np.arange(1, n_vols // 2 + 1) / (n_vols * t_r)
+    omega = 2 * np.pi * freqs
+    tau = np.arctan2(
+        np.sin(2 * np.outer(t, omega)).sum(axis=0),
+        np.cos(2 * np.outer(t, omega)).sum(axis=0),
+    ) / (2 * omega)
+    phase = np.outer(t, omega) - omega * tau
+
+    basis = []
+    for func in (np.cos, np.sin):
+        b = func(phase)
+        norm = np.sqrt(np.square(b).sum(axis=0))
+        # The sine term vanishes at the Nyquist frequency of regular sampling
+        b = np.divide(b, norm, out=np.zeros_like(b), where=norm > 1e-8)
+        basis.append(b.astype(np.float32))
+    return freqs, basis[0], basis[1]
+
+
+def spectral_metrics(
+    masked,
+    tr_keep,
+    metrics=("FALFF",),
+    low=HIGH_PASS,
+    high=LOW_PASS,
+    block_size=4096,
+    n_jobs=1,
+):
+    """Censored Lomb-Scargle amplitude metrics, as 3dLombScargle + 3dAmpToRSFC.
+
+    ``masked`` is the MaskedData series of uncensored residuals and
+    ``tr_keep`` the indices of the uncensored volumes. Amplitudes are scaled so
+    that, without censoring, the squared amplitudes sum to the variance.
+    Voxels are processed in blocks and only the band/total sums are kept, so
+    the full amplitude spectrum is never held for the whole brain. Returns a
+    dict with one single-column MaskedData map per requested metric.
+    """
+    unknown = set(metrics) - set(SPECTRAL_METRICS)
+    if unknown:
+        raise ValueError(f"Unknown spectral metrics: {sorted(unknown)}")
+
+    voxels = masked.data
+    n_vols = masked.n_vols
+    n_keep = len(tr_keep)
+    freqs, cos_basis, sin_basis = lomb_scargle_basis(tr_keep, n_vols, masked.t_r)
+    in_band = (freqs >= low) & (freqs <= high)
+
+    n_voxels = voxels.shape[0]
+    amp_band = np.zeros(n_voxels, dtype=np.float64)
+    amp_total = np.zeros(n_voxels, dtype=np.float64)
+    pow_band = np.zeros(n_voxels, dtype=np.float64)
+    pow_total = np.zeros(n_voxels, dtype=np.float64)
+
+    def _block(start):
+        stop = min(start + block_size, n_voxels)
+        y = voxels[start:stop][:, tr_keep]
+        y = y - y.mean(axis=1, keepdims=True)
+        power = (np.square(y @ cos_basis) + np.square(y @ sin_basis)) / n_keep
+        amp = np.sqrt(power)
+        amp_band[start:stop] = amp[:, in_band].sum(axis=1)
+        amp_total[start:stop] = amp.sum(axis=1)
+        pow_band[start:stop] = power[:, in_band].sum(axis=1)
+        pow_total[start:stop] = power.sum(axis=1)
+
+    with ThreadPoolExecutor(max_workers=max(int(n_jobs), 1)) as pool:
+        list(pool.map(_block, range(0, n_voxels, block_size)))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        alff = amp_band
+        rsfa = np.sqrt(pow_band)
+        derived = {
+            "ALFF": alff,
+            "FALFF": alff / amp_total,
+            "MALFF": alff / alff.mean(),
+            "RSFA": rsfa,
+            "FRSFA": rsfa / np.sqrt(pow_total),
+            "MRSFA": rsfa / rsfa.mean(),
+        }
+    return {metric: masked.with_data(derived[metric]) for metric in metrics}
+
+
+def write_spectral_metrics(masked, censor_fn, out_files, n_jobs=1, codec=None):
+    """Compute the requested spectral metrics and write them normalized.
+
+    ``out_files`` maps metric names (e.g. "FALFF") to output filenames; only
+    those metrics are computed. The kept TRs are read from ``censor_fn``.
+    """
+    censor_data = np.loadtxt(censor_fn, ndmin=1)
+    tr_keep = np.where(censor_data == 1)[0]
+    values = spectral_metrics(masked, tr_keep, metrics=list(out_files), n_jobs=n_jobs)
+    normalize_metrics(
+        {out_fn: values[metric] for metric, out_fn in out_files.items()}, codec=codec
+    )
+
+
+def zscore_map(metric, mask=None):
+    """Z-score a map over its non-zero voxels, as fslstats -M/-S, then mask.
+
+    NaNs are zeroed (fslmaths -nan) and the mean/std come from a single pass of
+    sums and sums of squares over the non-zero voxels.
+    """
+    metric = np.nan_to_num(metric, nan=0.0, posinf=0.0, neginf=0.0)
+    values = metric[metric != 0].astype(np.float64)
+    n = values.size
+    mean = values.sum() / n
+    std = np.sqrt((np.dot(values, values) - n * mean**2) / (n - 1))
+    zscored = (metric - mean) / std
+    if mask is not None:
+        zscored *= mask
+    return zscored.astype(np.float32)
+
+
+def normalize_metrics(metric_maps, mask=None, ref_img=None, codec=None):
+    """Z-score several metric maps against one brain mask, writing each once.
+
+    ``metric_maps`` maps output filenames to MaskedData maps, 3D arrays or
+    NIfTI paths. MaskedData maps are z-scored in their compact form and carry
+    their own mask; the others use ``mask``, a mask filename or boolean array
+    loaded once and shared by all maps. ``ref_img`` provides the
+    affine/header for in-memory arrays (defaults to the mask image). Maps are
+    written with ``codec``.
+    """
+    if isinstance(mask, str):
+        mask_img = nib.load(mask)
+        ref_img = ref_img if ref_img is not None else mask_img
+        mask = np.asanyarray(mask_img.dataobj) > 0
+
+    for out_fn, metric in metric_maps.items():
+        if isinstance(metric, MaskedData):
+            metric.with_data(zscore_map(metric.data)).to_nifti(out_fn, codec)
+            continue
+        out_ref = ref_img
+        if isinstance(metric, str):
+            out_ref = nib.load(metric)
+            metric = out_ref.get_fdata(dtype=np.float32)
+            if metric.ndim == 4:
+                metric = metric[..., 0]
+        _save_map(zscore_map(metric, mask), out_ref, out_fn, codec)
+
+
+def get_reho_numpy(denoised_fn, reho_norm_fn, mask_fn, n_jobs=1, codec=None):
+    """Compute ReHo (27 neighbours) and write the normalized map directly."""
+    masked = MaskedData.from_nifti(denoised_fn, mask_fn)
+    reho = kendall_w_reho(masked, n_jobs=n_jobs)
+    normalize_metrics({reho_norm_fn: reho}, codec=codec)
+
+
+def _save_map(metric_map, ref_img, out_fn, codec=None):
+    out_img = nib.Nifti1Image(metric_map, ref_img.affine, ref_img.header)
+    out_img.set_data_dtype(np.float32)
+    out_img.header.set_slope_inter(1, 0)
+    save_nifti(out_img, out_fn, codec)
@@ -4,6 +4,8 @@ import numpy as np
 import pandas as pd
 import re
 
+from exclusions import ExclusionRegistry
+
 
 def _get_parser():
     parser = argparse.ArgumentParser(description="Get outliers from QC metrics")
@@ -45,7 +47,7 @@ def parse_bids_name(bids_name):
         }
 
 
-def check_fd_mean_exclusions(data_dir):
+def check_fd_mean_exclusions(data_dir, registry=None):
     """Check fd_mean > 0.35 across all MRIQC files and return bids_name to exclude"""
     excluded_runs = set()
     files_to_check = ["group_bold.tsv", "group_T1w.tsv", "group_T2w.tsv"]
@@ -69,6 +71,9 @@ def check_fd_mean_exclusions(data_dir):
                 bids_name = row.get("bids_name", "")
                 excluded_runs.add(bids_name)
                 print(f"  Excluding {bids_name} (fd_mean={row['fd_mean']:.3f}) from {filename}")
+                if registry is not None:
+                    registry.add(bids_name, "fd_mean", "mriqc_group",
+                                 fd_mean=row["fd_mean"], threshold=0.35)
 
         except Exception as e:
             print(f"Error processing {filename}: {e}")
@@ -91,6 +96,9 @@ def main(data):
 
     qc_metrics = ["efc", "snr", "fd_mean", "tsnr"]
     percentile_excluded = set()
+    registry = ExclusionRegistry(op.join(data, "exclusions"))
+    # This run's entries replace those of earlier runs, as exclude-runs.tsv does
+    registry.start_generation("mriqc_group")
 
     # Process each task separately for percentile-based exclusions
     for task, runs in task_runs.items():
@@ -109,15 +117,20 @@ def main(data):
 
             if qc_metric in ["efc", "fd_mean"]:
                 run2exclude = task_df.loc[task_df[qc_metric] > upper]
+                threshold = upper
             elif qc_metric in ["snr", "tsnr"]:
                 run2exclude = task_df.loc[task_df[qc_metric] < lower]
+                threshold = lower
             else:
                 continue
 
             percentile_excluded.update(run2exclude["bids_name"].dropna().tolist())
+            for _, row in run2exclude.dropna(subset=["bids_name"]).iterrows():
+                registry.add(row["bids_name"], f"percentile_{qc_metric}", "mriqc_group",
+                             **{qc_metric: row[qc_metric], "threshold": threshold})
 
     # fd_mean > 0.35 exclusions
-    fd_excluded = check_fd_mean_exclusions(data)
+    fd_excluded = check_fd_mean_exclusions(data, registry=registry)
 
     # Merge both exclusion sets
     all_excluded = sorted(percentile_excluded.union(fd_excluded))
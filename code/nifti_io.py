@@ -0,0 +1,194 @@
+"""Output encoding for NIfTI derivatives: gzip level, parallel gzip, raw .nii, int16.
+
+A codec is a dict with:
+
+- ``level``: gzip level 0-9 of ``.nii.gz`` files, where 0 stores the data
+  in gzip members without compression; ``.nii`` files (the scratch files,
+  see scratch_ext) are written raw whatever the level
+- ``threads``: number of threads compressing gzip blocks in parallel
+- ``dtype``: on-disk data type, e.g. "int16" to store float32 data with
+  ``scl_slope``/``scl_inter``; None keeps float32
+
+Parallel compression writes the file as a series of concatenated gzip members
+(as bgzip/pigz --independent do), which standard gzip/zlib readers, nibabel,
+AFNI and FSL read as a single stream.
+"""
+import io
+import os
+import shutil
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel as nib
+import numpy as np
+
+GZIP_BLOCK_SIZE = 16 * 1024**2
+
+# Per-stage defaults: scratch files favour speed, archived derivatives size
+DEFAULT_CODECS = {
+    "scratch": {"level": 0, "threads": 1, "dtype": None},
+    "bold": {"level": 6, "threads": 1, "dtype": None},
+    "map": {"level": 6, "threads": 1, "dtype": None},
+}
+
+
+def make_codecs(compress_level=6, bold_dtype="float32", threads=1):
+    """Stage codecs for a compression level, final BOLD dtype and thread count."""
+    codecs = {stage: dict(codec) for stage, codec in DEFAULT_CODECS.items()}
+    for stage in ["bold", "map"]:
+        codecs[stage]["level"] = int(compress_level)
+        codecs[stage]["threads"] = int(threads)
+    codecs["bold"]["dtype"] = None if bold_dtype == "float32" else bold_dtype
+    return codecs
+
+
+def scratch_ext(codecs=None):
+    """Filename extension for intermediates deleted within the same run."""
+    codec = (codecs or DEFAULT_CODECS)["scratch"]
+    return ".nii.gz" if codec["level"] else ".nii"
+
+
+class ParallelGzipWriter(io.IOBase):
+    """Write-only file object compressing fixed-size blocks as gzip members.
+
+    Blocks are deflated on a thread pool (zlib releases the GIL) and written
+    in order; at most ``2 * threads`` blocks are in flight to bound memory.
+    """
+
+    def __init__(self, path, level=6, threads=1, block_size=GZIP_BLOCK_SIZE):
+        super().__init__()
+        self._fo = open(path, "wb")
+        self._level = level
+        self._block_size = block_size
+        self._buffer = bytearray()
+        self._pos = 0
+        self._max_pending = 2 * max(threads, 1)
+        self._pending = deque()
+        self._pool = ThreadPoolExecutor(max_workers=max(threads, 1))
+
+    def _compress(self, block):
+        compressor = zlib.compressobj(self._level, zlib.DEFLATED, 31)
+        return compressor.compress(block) + compressor.flush()
+
+    def _submit(self, block):
+        self._pending.append(self._pool.submit(self._compress, block))
+        while len(self._pending) >= self._max_pending:
+            self._fo.write(self._pending.popleft().result())
+
+    def write(self, data):
+        self._buffer += data
+        self._pos += len(data)
+        while len(self._buffer) >= self._block_size:
+            self._submit(bytes(self._buffer[: self._block_size]))
+            del self._buffer[: self._block_size]
+        return len(data)
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        if (whence != 0) or (offset != self._pos):
+            raise OSError("ParallelGzipWriter only supports writing forward")
+        return self._pos
+
+    def close(self):
+        if self._fo.closed:
+            return
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self._fo.write(self._pending.popleft().result())
+        self._pool.shutdown()
+        self._fo.close()
+        super().close()
+
+
+def save_nifti(img, out_fn, codec=None):
+    """Save ``img`` to ``out_fn`` with the given codec.
+
+    The data type and scaling follow ``codec["dtype"]`` (nibabel picks the
+    int16 slope/intercept). ``.nii`` filenames are written uncompressed and
+    ``.nii.gz`` ones with the codec's gzip level and threads.
+    """
+    codec = codec or DEFAULT_CODECS["bold"]
+    if codec["dtype"] is not None:
+        img = nib.Nifti1Image(img.dataobj, img.affine, img.header)
+        img.set_data_dtype(np.dtype(codec["dtype"]))
+        img.header.set_slope_inter(np.nan, np.nan)
+
+    if not out_fn.endswith(".gz"):
+        nib.save(img, out_fn)
+        return
+
+    with ParallelGzipWriter(
+        out_fn, level=codec["level"], threads=codec["threads"]
+    ) as writer:
+        img.to_file_map({"image": nib.FileHolder(fileobj=writer)})
+
+
+def write_header(fileobj, header):
+    """Write a single-file NIfTI header and pad to its data offset."""
+    header.write_to(fileobj)
+    offset = int(header.get_data_offset())
+    fileobj.write(b"\x00" * (offset - fileobj.tell()))
+    return offset
+
+
+def stream_nifti(in_fn, out_fn, codec=None):
+    """Encode an uncompressed NIfTI volume by volume, without loading it whole.
+
+    Without a codec dtype the file is copied byte for byte. For int16 the slope
+    is set from the largest absolute value, found in a first pass over the
+    memory-mapped data.
+    """
+    codec = codec or DEFAULT_CODECS["bold"]
+    if out_fn.endswith(".gz"):
+        fo = ParallelGzipWriter(out_fn, level=codec["level"], threads=codec["threads"])
+    else:
+        fo = open(out_fn, "wb")
+
+    with fo:
+        if codec["dtype"] is None:
+            with open(in_fn, "rb") as fi:
+                shutil.copyfileobj(fi, fo, GZIP_BLOCK_SIZE)
+            return
+
+        img = nib.load(in_fn, mmap=True)
+        data = img.dataobj
+        n_vols = img.shape[3] if img.ndim == 4 else 1
+        volumes = [(..., i_vol) for i_vol in range(n_vols)] if img.ndim == 4 else [...]
+        max_abs = max(np.abs(np.asarray(data[vol])).max() for vol in volumes)
+        dtype = np.dtype(codec["dtype"])
+        slope = float(max_abs) / np.iinfo(dtype).max if max_abs > 0 else 1.0
+
+        header = img.header.copy()
+        header.set_data_dtype(dtype)
+        header.set_slope_inter(slope, 0)
+        write_header(fo, header)
+        out_dtype = header.get_data_dtype()
+        for vol in volumes:
+            scaled = np.round(np.asarray(data[vol], dtype=np.float64) / slope)
+            fo.write(scaled.astype(out_dtype).tobytes(order="F"))
+
+
+def recode_nifti(in_fn, out_fn, codec=None, remove_input=True):
+    """Re-encode a NIfTI written by an external tool (AFNI, ANTs) with ``codec``.
+
+    Uncompressed inputs are streamed, so memory use does not grow with run length.
+    """
+    codec = codec or DEFAULT_CODECS["bold"]
+    raw_copy = not (in_fn.endswith(".gz") or out_fn.endswith(".gz"))
+    if raw_copy and (codec["dtype"] is None) and remove_input:
+        shutil.move(in_fn, out_fn)
+        return
+    if in_fn.endswith(".gz"):
+        save_nifti(nib.load(in_fn), out_fn, codec)
+    else:
+        stream_nifti(in_fn, out_fn, codec)
+    if remove_input:
+        os.remove(in_fn)
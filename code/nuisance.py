@@ -0,0 +1,209 @@
+"""In-process nuisance regression, equivalent to the 3dTproject call in denoising.py."""
+import numpy as np
+
+from masked import MaskedData
+from smoothing import blur_masked
+
+LOW_PASS = 0.10
+HIGH_PASS = 0.01
+
+
+def load_regressors(regressor_fn):
+    """Load a .1D regressor file written by run_3dtproject as a (time x regressors) array."""
+    return np.loadtxt(regressor_fn, ndmin=2)
+
+
+def legendre_trends(n_vols, polort=1):
+    """Legendre polynomials up to polort over [-1, 1], as in AFNI's -polort."""
+    x = np.linspace(-1, 1, n_vols)
+    return np.column_stack(
+        [np.polynomial.legendre.Legendre.basis(deg)(x) for deg in range(polort + 1)]
+    )
+
+
+def bandpass_regressors(n_vols, t_r, low=HIGH_PASS, high=LOW_PASS):
+    """Sine/cosine regressors for every frequency outside [low, high] Hz.
+
+    Follows 3dTproject -passband: frequencies are k / (n_vols * t_r) for
+    k = 1..n_vols // 2, the DC term is left to the polynomial trends, and the
+    Nyquist frequency only gets a cosine.
+    """
+    t = np.arange(n_vols)
+    regressors = []
+    for k in range(1, n_vols // 2 + 1):
+        freq = k / (n_vols * t_r)
+        if low <= freq <= high:
+            continue
+        regressors.append(np.cos(2 * np.pi * k * t / n_vols))
+        if 2 * k != n_vols:
+            regressors.append(np.sin(2 * np.pi * k * t / n_vols))
+    if not regressors:
+        return np.empty((n_vols, 0))
+    return np.column_stack(regressors)
+
+
+def build_design(regressors, t_r, polort=1, band_pass=False):
+    """Stack trends, nuisance regressors and (optionally) the passband terms."""
+    n_vols = regressors.shape[0]
+    design = [legendre_trends(n_vols, polort), regressors]
+    if band_pass:
+        design.append(bandpass_regressors(n_vols, t_r))
+    return np.column_stack(design)
+
+
+def projection_basis(design):
+    """Orthonormal basis for the least-squares projection of a design matrix.
+
+    Returns ``(basis, complement)``. When ``complement`` is False the residuals
+    are ``Y - (Y @ basis) @ basis.T``; when True ``basis`` spans the orthogonal
+    complement of the design and the residuals are ``(Y @ basis) @ basis.T``.
+    The smaller of the two is returned, which matters with a passband where
+    most of the spectrum is regressed out.
+    """
+    n_vols = design.shape[0]
+    u, s, _ = np.linalg.svd(design, full_matrices=True)
+    tol = s.max() * max(design.shape) * np.finfo(s.dtype).eps
+    rank = int((s > tol).sum())
+    if rank <= n_vols - rank:
+        return u[:, :rank].astype(np.float32), False
+    return u[:, rank:].astype(np.float32), True
+
+
+def project_out(data, basis, complement, overwrite=True):
+    """Residualize a (voxels x time) float32 matrix against a projection basis."""
+    fitted = (data @ basis) @ basis.T
+    if complement:
+        return fitted
+    if not overwrite:
+        return data - fitted
+    data -= fitted
+    return data
+
+
+def nuisance_reg_numpy(
+    preproc_fn,
+    dummy_scans,
+    denoised_fn,
+    regressor_fn,
+    mask_fn,
+    smooth=False,
+    band_pass=False,
+    polort=1,
+    fwhm=6,
+    codec=None,
+):
+    """Regress trends, nuisance regressors and out-of-band frequencies in-process."""
+    masked = MaskedData.from_nifti(preproc_fn, mask_fn, dummy_scans)
+
+    if smooth:
+        masked = blur_masked(masked, fwhm)
+
+    regressors = _check_regressors(load_regressors(regressor_fn), masked, regressor_fn)
+    design = build_design(regressors, masked.t_r, polort=polort, band_pass=band_pass)
+    residuals = project_out(masked.data, *projection_basis(design))
+    masked.with_data(residuals).to_nifti(denoised_fn, codec)
+
+
+def fused_nuisance_reg(
+    preproc_fn,
+    dummy_scans,
+    mask_fn,
+    tr_keep,
+    models,
+    return_unfiltered=None,
+    polort=1,
+    codec=None,
+    n_jobs=1,
+):
+    """Produce the regression products of several confound models from one load.
+
+    ``models`` maps model names to ``(regressor_fn, products)``, where each
+    product is a dict with "out_fn", "band_pass", "fwhm" (0 for none) and
+    "smoothing" (see smoothing.py). All models are solved against the same
+    data matrix. Per model, the unfiltered residuals are computed once; the
+    band-passed residuals are obtained by projecting those against the full
+    design (the trends and nuisance regressors are already removed, so the
+    result is identical to a separate regression). "smooth-after-denoise"
+    products blur the censored residuals; "blur-then-project" products
+    regress a blurred copy of the input instead. Every product is censored to
+    ``tr_keep`` and written with ``codec`` (see nifti_io).
+
+    Returns the unfiltered residuals of model ``return_unfiltered`` as
+    MaskedData (None if not requested), so the spectral metrics can be
+    computed without a round trip through disk.
+    """
+    masked = MaskedData.from_nifti(preproc_fn, mask_fn, dummy_scans)
+    t_r = masked.t_r
+    # Validation products regress blurred input, so blur before it is overwritten
+    blurred = {}
+    for _, products in models.values():
+        for product in products:
+            fwhm = product["fwhm"]
+            if _blur_first(product) and (fwhm not in blurred):
+                blurred[fwhm] = blur_masked(masked, fwhm, n_jobs=n_jobs)
+
+    unfiltered = None
+    for i_model, (name, (regressor_fn, products)) in enumerate(models.items()):
+        regressors = _check_regressors(
+            load_regressors(regressor_fn), masked, regressor_fn
+        )
+        design = build_design(regressors, t_r, polort=polort, band_pass=False)
+        # The input is only needed again by later models
+        last_model = i_model == len(models) - 1
+        residuals = masked.with_data(
+            project_out(masked.data, *projection_basis(design), overwrite=last_model)
+        )
+        after = [product for product in products if not _blur_first(product)]
+        keep_residuals = (name == return_unfiltered) or any(
+            not product["band_pass"] for product in after
+        )
+
+        filtered = None
+        if any(product["band_pass"] for product in after):
+            design = build_design(regressors, t_r, polort=polort, band_pass=True)
+            filtered = project_out(
+                residuals.data,
+                *projection_basis(design),
+                overwrite=not keep_residuals,
+            )
+
+        for product in after:
+            source = filtered if product["band_pass"] else residuals.data
+            censored = residuals.with_data(source[:, tr_keep])
+            if product["fwhm"]:
+                censored = blur_masked(censored, product["fwhm"], n_jobs=n_jobs)
+            censored.to_nifti(product["out_fn"], codec)
+        del filtered
+
+        for product in products:
+            if not _blur_first(product):
+                continue
+            design = build_design(
+                regressors, t_r, polort=polort, band_pass=product["band_pass"]
+            )
+            source = blurred[product["fwhm"]]
+            smoothed = project_out(
+                source.data, *projection_basis(design), overwrite=False
+            )
+            source.with_data(smoothed[:, tr_keep]).to_nifti(product["out_fn"], codec)
+            del smoothed
+
+        if name == return_unfiltered:
+            unfiltered = residuals
+
+    return unfiltered
+
+
+def _blur_first(product):
+    return bool(product["fwhm"]) and (
+        product.get("smoothing", "smooth-after-denoise") == "blur-then-project"
+    )
+
+
+def _check_regressors(regressors, masked, regressor_fn):
+    if regressors.shape[0] != masked.n_vols:
+        raise ValueError(
+            f"{regressor_fn} has {regressors.shape[0]} rows, "
+            f"expected {masked.n_vols} volumes"
+        )
+    return regressors
@@ -0,0 +1,132 @@
+"""In-process resampling of scan-space 4D series to MNI space.
+
+An alternative to antsApplyTransforms for the scan->MNI step of
+tedana_job.py. Every volume of a run shares the same geometry, so the
+sampling coordinates of the in-mask voxels of the MNI reference are composed
+once per run:
+
+    MNI voxel -> MNI mm -> T1w mm (displacement field, see transforms.py)
+              -> scanner mm (scanner->T1w affine) -> scan voxel
+
+and each volume is then interpolated at those coordinates only, on a thread
+pool (scipy.ndimage releases the GIL). Voxels outside the MNI brain mask, or
+mapped outside the scan's field of view, are zero.
+
+ANTs transforms map points in LPS physical space from the output (fixed)
+image to the input (moving) one, which is the order they are composed in.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel as nib
+import numpy as np
+from scipy import ndimage
+
+from masked import MaskedData
+
+# Interpolation kernel -> spline order of scipy.ndimage.map_coordinates
+KERNELS = {"nearest": 0, "linear": 1, "cubic": 3}
+
+# LPS <-> RAS (its own inverse)
+LPS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+
+def load_itk_affine(xfm_file):
+    """Point mapping of an ITK text transform file holding one affine, in RAS.
+
+    ITK stores the matrix, translation and center of rotation in LPS; the
+    mapping is ``A (x - c) + t + c``.
+    """
+    parameters, fixed = [], []
+    with open(xfm_file, "r") as fo:
+        for line in fo:
+            key, _, values = line.partition(":")
+            if key == "Parameters":
+                parameters.append(np.array(values.split(), dtype=float))
+            elif key == "FixedParameters":
+                fixed.append(np.array(values.split(), dtype=float))
+    if (len(parameters) != 1) or (parameters[0].size != 12):
+        raise ValueError(f"Expected one 3D affine transform in {xfm_file}")
+    matrix = parameters[0][:9].reshape(3, 3)
+    center = fixed[0] if fixed else np.zeros(3)
+    affine = np.eye(4)
+    affine[:3, :3] = matrix
+    affine[:3, 3] = parameters[0][9:] + center - matrix @ center
+    return LPS @ affine @ LPS
+
+
+def load_displacement_field(field_file):
+    """(x, y, z, 3) RAS displacements (mm) of an ITK field image, and its affine."""
+    img = nib.load(field_file)
+    field = np.asarray(img.dataobj, dtype=np.float32).reshape(img.shape[:3] + (3,))
+    # ITK vectors are LPS
+    field[..., :2] *= -1
+    return field, img.affine
+
+
+def sampling_coordinates(mask, reference_affine, field_file, scan2t1w, scan_affine):
+    """Scan voxel coordinates (3 x voxels) sampled by each MNI voxel in ``mask``.
+
+    The displacement field must lie on the reference grid, as written by
+    transforms.TransformCache, so it is read at the voxels themselves.
+    """
+    field, field_affine = load_displacement_field(field_file)
+    if (field.shape[:3] != mask.shape) or not np.allclose(
+        field_affine, reference_affine, atol=1e-4
+    ):
+        raise ValueError(f"{field_file} is not on the grid of the MNI reference")
+    voxels = np.vstack([np.nonzero(mask), np.ones(np.count_nonzero(mask))])
+    t1w = (reference_affine @ voxels)[:3] + field[mask].T
+    del field
+    to_scan = np.linalg.inv(scan_affine) @ load_itk_affine(scan2t1w)
+    coords = to_scan[:3, :3] @ t1w + to_scan[:3, 3:]
+    return coords.astype(np.float32)
+
+
+def resample_to_mni(
+    in_file,
+    reference,
+    mask,
+    field_file,
+    scan2t1w_file,
+    interpolation="linear",
+    n_threads=1,
+):
+    """Resample a scan-space 4D series onto the in-mask voxels of ``reference``.
+
+    Returns a MaskedData on the reference grid; write it with
+    ``MaskedData.write_volumes``.
+    """
+    if interpolation not in KERNELS:
+        raise ValueError(
+            f"Unknown interpolation {interpolation}; expected {list(KERNELS)}"
+        )
+    ref_img = nib.load(reference)
+    mask = np.asanyarray(nib.load(mask).dataobj) > 0
+    if mask.shape != ref_img.shape[:3]:
+        raise ValueError(f"Brain mask and MNI reference {reference} differ in shape")
+    img = nib.load(in_file)
+    coords = sampling_coordinates(
+        mask, ref_img.affine, field_file, scan2t1w_file, img.affine
+    )
+    data = img.get_fdata(dtype=np.float32)
+
+    out = np.empty((coords.shape[1], data.shape[3]), dtype=np.float32)
+
+    def _volume(i_vol):
+        # Splines (cubic) are prefiltered per volume, within this call
+        out[:, i_vol] = ndimage.map_coordinates(
+            data[..., i_vol],
+            coords,
+            order=KERNELS[interpolation],
+            mode="constant",
+            cval=0.0,
+        )
+
+    with ThreadPoolExecutor(max_workers=max(int(n_threads), 1)) as pool:
+        list(pool.map(_volume, range(data.shape[3])))
+
+    header = ref_img.header.copy()
+    header.set_data_shape(mask.shape + (data.shape[3],))
+    header.set_zooms(ref_img.header.get_zooms()[:3] + img.header.get_zooms()[3:4])
+    header.set_xyzt_units(*img.header.get_xyzt_units())
+    return MaskedData(out, mask, ref_img.affine, header)
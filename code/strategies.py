@@ -0,0 +1,122 @@
+"""Named denoising strategies: a confound model plus filtering and smoothing.
+
+A strategy is a dict with:
+
+- ``desc``: label of its output, ``{prefix}_desc-{desc}_bold.nii.gz``
+- ``motion``: motion model, "6P", "12P" (with derivatives) or "24P" (with
+  derivatives and squares)
+- ``acompcor``: number of aCompCor components from each of CSF and WM
+- ``gsr``: whether to regress the global signal
+- ``band_pass``: whether to band-pass filter to 0.01-0.10 Hz
+- ``fwhm``: smoothing kernel in mm, 0 for none
+- ``smoothing``: "smooth-after-denoise" or "blur-then-project" (see
+  smoothing.py)
+- ``description``: sidecar description; generated from the fields if None
+
+Strategies that share a confound model are solved together.
+"""
+import json
+
+from confounds import MOTION_DERIVATIVE_LABELS, MOTION_LABELS, MOTION_POWER2_LABELS
+from smoothing import SMOOTHING_MODES
+
+MOTION_MODELS = {
+    "6P": MOTION_LABELS,
+    "12P": MOTION_DERIVATIVE_LABELS,
+    "24P": MOTION_DERIVATIVE_LABELS + MOTION_POWER2_LABELS,
+}
+
+# Sidecar wording of each motion model
+MOTION_DESCRIPTIONS = {
+    "6P": "6 motion parameters",
+    "12P": "6 motion parameters and their temporal derivatives",
+    "24P": "6 motion parameters, their temporal derivatives and the squares of both",
+}
+
+STRATEGY_DEFAULTS = {
+    "motion": "12P",
+    "acompcor": 3,
+    "gsr": False,
+    "band_pass": True,
+    "fwhm": 0,
+    "smoothing": "smooth-after-denoise",
+    "description": None,
+}
+
+
+def default_strategies(desc_list):
+    """The [Clean, Clean + Smooth] pair named by --desc_list."""
+    # Sidecar descriptions are generated by describe() from the fitted model
+    return [
+        dict(STRATEGY_DEFAULTS, desc=desc_list[0]),
+        dict(STRATEGY_DEFAULTS, desc=desc_list[1], fwhm=6),
+    ]
+
+
+def load_strategies(strategy_file):
+    """Read a JSON list of strategies, filling unset fields with the defaults."""
+    with open(strategy_file, "r") as fo:
+        strategies = [dict(STRATEGY_DEFAULTS, **strategy) for strategy in json.load(fo)]
+    check_strategies(strategies)
+    return strategies
+
+
+def check_strategies(strategies):
+    descs = [strategy.get("desc") for strategy in strategies]
+    if (not strategies) or (None in descs):
+        raise ValueError("Every strategy needs a desc label")
+    if len(set(descs)) != len(descs):
+        raise ValueError(f"Strategy desc labels must be unique: {descs}")
+    for strategy in strategies:
+        if strategy["motion"] not in MOTION_MODELS:
+            raise ValueError(
+                f"Unknown motion model {strategy['motion']} in {strategy['desc']}; "
+                f"expected one of {sorted(MOTION_MODELS)}"
+            )
+        if strategy["smoothing"] not in SMOOTHING_MODES:
+            raise ValueError(
+                f"Unknown smoothing {strategy['smoothing']} in {strategy['desc']}; "
+                f"expected one of {SMOOTHING_MODES}"
+            )
+
+
+def model_name(strategy):
+    """Confound model label, e.g. "motion12+acompcor6"; equal for shared models."""
+    name = f"motion{strategy['motion'][:-1]}+acompcor{2 * int(strategy['acompcor'])}"
+    if strategy["gsr"]:
+        name += "+gsr"
+    return name
+
+
+def group_by_model(strategies):
+    """Map each confound model name to its strategies, in declaration order."""
+    groups = {}
+    for strategy in strategies:
+        groups.setdefault(model_name(strategy), []).append(strategy)
+    return groups
+
+
+def extra_columns(strategies):
+    """Confound columns beyond the ones ConfoundsLoader always reads."""
+    columns = []
+    for strategy in strategies:
+        columns += MOTION_MODELS[strategy["motion"]]
+    return list(dict.fromkeys(columns))
+
+
+def describe(strategy):
+    if strategy["description"]:
+        return strategy["description"]
+    parts = [MOTION_DESCRIPTIONS[strategy["motion"]]]
+    if strategy["acompcor"]:
+        parts.append(
+            f"{strategy['acompcor']} aCompCor components each from WM and CSF"
+        )
+    if strategy["gsr"]:
+        parts.append("the global signal")
+    description = f"Denoising with a regression model including {'; '.join(parts)}."
+    if strategy["band_pass"]:
+        description += " The data were band-pass filtered to 0.01-0.10 Hz."
+    if strategy["fwhm"]:
+        description += f" Spatial smoothing ({strategy['fwhm']} mm FWHM) was applied."
+    return description
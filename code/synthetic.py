@@ -0,0 +1,365 @@
+"""Synthetic fMRIPrep/MRIQC derivatives for benchmarking without cluster data.
+
+Writes, under ``out_dir``:
+
+- ``fmriprep/sub-*/ses-*/func``: ``desc-preproc_bold.nii.gz`` (+ .json),
+  ``desc-brain_mask.nii.gz`` and ``desc-confounds_timeseries.tsv`` (+ .json
+  with the c/w/a_comp_cor masks) per run; with ``n_echoes > 1`` also the
+  scan-space ``echo-*_desc-preproc_bold.nii.gz`` files read by tedana_job.py
+- ``mriqc/group_bold.tsv``: one row per run (and echo) with the QC metrics
+  read by mriqc_group.py
+
+The BOLD data are in-mask baselines plus a linear mix of the confounds and
+white noise, so the nuisance regression has something to remove, and a few
+motion spikes are censored. Volumes are generated and compressed one at a
+time, so realistic sizes do not need the whole run in memory.
+"""
+import argparse
+import json
+import os
+import os.path as op
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+from confounds import MOTION_DERIVATIVE_LABELS, MOTION_LABELS, MOTION_POWER2_LABELS
+from nifti_io import ParallelGzipWriter, write_header
+
+# Grid shape and voxel size (mm) of the generated runs
+SIZES = {
+    "small": ((20, 24, 20), 2.0),
+    "realistic": ((97, 115, 97), 2.0),
+}
+
+SPACE = "MNI152NLin2009cAsym"
+N_COMPCOR = 5
+ECHO_TIMES = [0.0142, 0.0385, 0.0628, 0.0871]
+
+DATASET_DESCRIPTION = {
+    "Name": "Synthetic derivatives",
+    "BIDSVersion": "1.8.0",
+    "DatasetType": "derivative",
+    "GeneratedBy": [{"Name": "synthetic.py"}],
+}
+
+
+def brain_mask(shape):
+    """Ellipsoid covering the central 80% of the grid."""
+    grid = np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing="ij")
+    return sum(np.square(axis / 0.8) for axis in grid) <= 1
+
+
+def make_confounds(n_vols, t_r, rng, n_spikes=3):
+    """fMRIPrep-like confounds table and sidecar for one run."""
+    motion = np.cumsum(rng.normal(0, 0.02, (n_vols, 6)), axis=0)
+    motion[:, 3:] /= 50  # rotations in radians
+    for t in rng.choice(np.arange(10, n_vols - 10), n_spikes, replace=False):
+        motion[t:] += rng.normal(0, 0.3, 6) * [1, 1, 1, 0.02, 0.02, 0.02]
+    derivatives = np.vstack([np.full(6, np.nan), np.diff(motion, axis=0)])
+    radius = np.array([1, 1, 1, 50, 50, 50])
+    fd = np.abs(derivatives * radius).sum(axis=1)
+    fd[0] = np.nan
+
+    columns = {}
+    for i_label, label in enumerate(MOTION_LABELS):
+        columns[label] = motion[:, i_label]
+        columns[f"{label}_derivative1"] = derivatives[:, i_label]
+    for label in MOTION_DERIVATIVE_LABELS:
+        columns[f"{label}_power2"] = np.square(columns[label])
+    columns["framewise_displacement"] = fd
+
+    # Slow, unit-variance component time series
+    metadata = {}
+    t = np.arange(n_vols) * t_r
+    for prefix, mask_label in [("c", "CSF"), ("w", "WM"), ("a", "combined")]:
+        for i_comp in range(N_COMPCOR):
+            freq = rng.uniform(0.005, 0.2)
+            series = np.sin(2 * np.pi * freq * t + rng.uniform(0, 2 * np.pi))
+            series += rng.normal(0, 0.5, n_vols)
+            name = f"{prefix}_comp_cor_{i_comp:02d}"
+            columns[name] = (series - series.mean()) / series.std()
+            metadata[name] = {
+                "Mask": mask_label,
+                "Method": "aCompCor",
+                "Retained": True,
+                "VarianceExplained": float(rng.uniform(0.01, 0.1)),
+            }
+    confounds = pd.DataFrame(columns)
+    confounds = confounds[
+        MOTION_DERIVATIVE_LABELS
+        + MOTION_POWER2_LABELS
+        + ["framewise_displacement"]
+        + list(metadata)
+    ]
+    return confounds, metadata
+
+
+def write_bold(out_fn, mask, zooms, t_r, confounds, rng, scale=1.0, codec=None):
+    """Stream a synthetic 4D run to ``out_fn``, one volume at a time.
+
+    Returns the global signal, which fMRIPrep reports with the confounds.
+    """
+    codec = codec or {"level": 1, "threads": 1}
+    n_vols = len(confounds)
+    shape = mask.shape + (n_vols,)
+    # Voxel loadings on the confounds that nuisance regression removes
+    regressors = np.nan_to_num(confounds.to_numpy(dtype=np.float32))
+    n_voxels = np.count_nonzero(mask)
+    loadings = rng.normal(0, 2, (n_voxels, regressors.shape[1])).astype(np.float32)
+    baseline = rng.uniform(400, 1000, n_voxels).astype(np.float32)
+
+    header = nib.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype(np.float32)
+    header.set_zooms(tuple(zooms) + (t_r,))
+    header.set_xyzt_units("mm", "sec")
+    affine = np.diag(list(zooms) + [1.0])
+    affine[:3, 3] = -np.array(mask.shape) * zooms / 2
+    header.set_qform(affine, code=1)
+    header.set_sform(affine, code=1)
+
+    global_signal = np.empty(n_vols)
+    volume = np.zeros(mask.shape, dtype=np.float32)
+    writer = ParallelGzipWriter(out_fn, level=codec["level"], threads=codec["threads"])
+    with writer as fo:
+        write_header(fo, header)
+        for t in range(n_vols):
+            noise = rng.standard_normal(n_voxels, dtype=np.float32) * 10
+            volume[mask] = scale * (baseline + loadings @ regressors[t] + noise)
+            global_signal[t] = volume[mask].mean()
+            fo.write(volume.tobytes(order="F"))
+    return global_signal, affine
+
+
+def make_run(
+    func_dir, prefix, shape, voxel_size, n_vols, t_r, rng, n_echoes=1, codec=None
+):
+    """Write the fMRIPrep outputs of one run; returns its mean FD."""
+    zooms = np.array([voxel_size] * 3)
+    mask = brain_mask(shape)
+    confounds, metadata = make_confounds(n_vols, t_r, rng)
+    regressor_columns = confounds.drop(columns=["framewise_displacement"])
+
+    bold_fn = op.join(func_dir, f"{prefix}_space-{SPACE}_desc-preproc_bold.nii.gz")
+    global_signal, affine = write_bold(
+        bold_fn, mask, zooms, t_r, regressor_columns, rng, codec=codec
+    )
+    with open(bold_fn.replace(".nii.gz", ".json"), "w") as fo:
+        json.dump({"RepetitionTime": t_r, "SkullStripped": False}, fo, indent=4)
+    mask_fn = op.join(func_dir, f"{prefix}_space-{SPACE}_desc-brain_mask.nii.gz")
+    nib.save(nib.Nifti1Image(mask.astype(np.uint8), affine), mask_fn)
+
+    if n_echoes > 1:
+        for i_echo, echo_time in enumerate(ECHO_TIMES[:n_echoes], start=1):
+            echo_fn = op.join(
+                func_dir, f"{prefix}_echo-{i_echo}_desc-preproc_bold.nii.gz"
+            )
+            write_bold(
+                echo_fn,
+                mask,
+                zooms,
+                t_r,
+                regressor_columns,
+                rng,
+                scale=np.exp(-echo_time / 0.03),
+                codec=codec,
+            )
+            with open(echo_fn.replace(".nii.gz", ".json"), "w") as fo:
+                json.dump({"RepetitionTime": t_r, "EchoTime": echo_time}, fo, indent=4)
+
+    confounds.insert(0, "global_signal", global_signal)
+    confounds_fn = op.join(func_dir, f"{prefix}_desc-confounds_timeseries.tsv")
+    confounds.to_csv(confounds_fn, sep="\t", index=False, na_rep="n/a")
+    with open(confounds_fn.replace(".tsv", ".json"), "w") as fo:
+        json.dump(metadata, fo, sort_keys=True, indent=4)
+    return float(np.nanmean(confounds["framewise_displacement"]))
+
+
+def make_dataset(
+    out_dir,
+    n_subjects=2,
+    n_sessions=1,
+    tasks=("rest",),
+    n_runs=2,
+    n_vols=300,
+    size="small",
+    n_echoes=1,
+    t_r=0.8,
+    seed=0,
+    threads=1,
+):
+    """Generate the fMRIPrep and MRIQC trees; returns their directories.
+
+    An existing dataset generated with the same parameters is reused.
+    """
+    params = {
+        "n_subjects": int(n_subjects),
+        "n_sessions": int(n_sessions),
+        "tasks": list(tasks),
+        "n_runs": int(n_runs),
+        "n_vols": int(n_vols),
+        "size": size,
+        "n_echoes": int(n_echoes),
+        "t_r": float(t_r),
+        "seed": int(seed),
+    }
+    preproc_dir = op.join(out_dir, "fmriprep")
+    mriqc_dir = op.join(out_dir, "mriqc")
+    params_file = op.join(out_dir, "synthetic.json")
+    if op.isfile(params_file):
+        with open(params_file, "r") as fo:
+            if json.load(fo) == params:
+                return preproc_dir, mriqc_dir
+
+    shape, voxel_size = SIZES[size]
+    codec = {"level": 1, "threads": int(threads)}
+    rng = np.random.default_rng(int(seed))
+    qc_rows = []
+    for i_sub in range(1, params["n_subjects"] + 1):
+        subject = f"sub-{i_sub:02d}"
+        for i_ses in range(1, params["n_sessions"] + 1):
+            session = f"ses-{i_ses:02d}"
+            func_dir = op.join(preproc_dir, subject, session, "func")
+            os.makedirs(func_dir, exist_ok=True)
+            for task in params["tasks"]:
+                for i_run in range(1, params["n_runs"] + 1):
+                    prefix = f"{subject}_{session}_task-{task}_run-{i_run:02d}"
+                    print(f"\tGenerating {prefix}", flush=True)
+                    fd_mean = make_run(
+                        func_dir,
+                        prefix,
+                        shape,
+                        voxel_size,
+                        params["n_vols"],
+                        params["t_r"],
+                        rng,
+                        n_echoes=params["n_echoes"],
+                        codec=codec,
+                    )
+                    echoes = [""]
+                    if params["n_echoes"] > 1:
+                        n_echoes = params["n_echoes"]
+                        echoes = [f"_echo-{e}" for e in range(1, n_echoes + 1)]
+                    for echo in echoes:
+                        qc_rows.append(
+                            {
+                                "bids_name": f"{prefix}{echo}_bold",
+                                "efc": rng.normal(0.5, 0.02),
+                                "snr": rng.normal(5, 0.5),
+                                "fd_mean": fd_mean,
+                                "tsnr": rng.normal(50, 5),
+                                "dvars_std": rng.normal(1.2, 0.1),
+                            }
+                        )
+
+    os.makedirs(mriqc_dir, exist_ok=True)
+    pd.DataFrame(qc_rows).to_csv(
+        op.join(mriqc_dir, "group_bold.tsv"), sep="\t", index=False
+    )
+    for derivs_dir in [preproc_dir, mriqc_dir]:
+        with open(op.join(derivs_dir, "dataset_description.json"), "w") as fo:
+            json.dump(DATASET_DESCRIPTION, fo, indent=4)
+    with open(params_file, "w") as fo:
+        json.dump(params, fo, indent=4)
+    return preproc_dir, mriqc_dir
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic fMRIPrep and MRIQC derivatives"
+    )
+    parser.add_argument(
+        "--out_dir",
+        dest="out_dir",
+        required=True,
+        help="Path to the synthetic dataset",
+    )
+    parser.add_argument(
+        "--n_subjects",
+        dest="n_subjects",
+        default=2,
+        type=int,
+        required=False,
+        help="Number of subjects",
+    )
+    parser.add_argument(
+        "--n_sessions",
+        dest="n_sessions",
+        default=1,
+        type=int,
+        required=False,
+        help="Sessions per subject",
+    )
+    parser.add_argument(
+        "--tasks",
+        dest="tasks",
+        default=["rest"],
+        required=False,
+        nargs="+",
+        help="Task labels; only task-rest is denoised",
+    )
+    parser.add_argument(
+        "--n_runs",
+        dest="n_runs",
+        default=2,
+        type=int,
+        required=False,
+        help="Runs per task",
+    )
+    parser.add_argument(
+        "--n_vols",
+        dest="n_vols",
+        default=300,
+        type=int,
+        required=False,
+        help="Volumes per run",
+    )
+    parser.add_argument(
+        "--size",
+        dest="size",
+        default="small",
+        required=False,
+        choices=list(SIZES),
+        help="Grid size: a small field of view or the 2 mm MNI152NLin2009cAsym grid",
+    )
+    parser.add_argument(
+        "--n_echoes",
+        dest="n_echoes",
+        default=1,
+        type=int,
+        required=False,
+        help="Echoes per run; >1 also writes the scan-space echoes for tedana",
+    )
+    parser.add_argument(
+        "--seed",
+        dest="seed",
+        default=0,
+        type=int,
+        required=False,
+        help="Random seed",
+    )
+    parser.add_argument(
+        "--threads",
+        dest="threads",
+        default=1,
+        type=int,
+        required=False,
+        help="Gzip threads",
+    )
+    return parser
+
+
+def main(**kwargs):
+    """Generate a synthetic dataset."""
+    make_dataset(**kwargs)
+
+
+def _main(argv=None):
+    option = _get_parser().parse_args(argv)
+    kwargs = vars(option)
+    main(**kwargs)
+
+
+if __name__ == "__main__":
+    _main()
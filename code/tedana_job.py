@@ -2,14 +2,60 @@
 import argparse
 import itertools
 import json
+import multiprocessing as mp
 import os
 import os.path as op
 import shutil
+import queue
 import subprocess
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import nullcontext, redirect_stderr, redirect_stdout
 from glob import glob
+import nibabel as nib
+import numpy as np
 import pandas as pd
 
-from nipype.interfaces.ants import ApplyTransforms #updated
+from bids_index import subject_index
+from budget import MemoryBudget, available_memory_gb
+from exclusions import ExclusionRegistry
+from executor import THREAD_ENV_VARS
+from manifest import RunManifest, atomic_output, tool_versions
+from nifti_io import DEFAULT_CODECS, make_codecs, recode_nifti
+from resample import KERNELS, resample_to_mni
+from transforms import TransformCache, mni_inputs, mni_mask
+
+# Peak memory of a tedana run: base + factor x the float64 size of its echoes
+TEDANA_BASE_MEMORY_GB = 1.0
+TEDANA_MEMORY_FACTOR = 3.0
+TRANSFORM_BASE_MEMORY_GB = 0.5
+
+# Runs finished by tedana that may wait for the transform stage (--pipeline)
+PIPELINE_DEPTH = 2
+# Seconds between checks that the transform thread is still draining the handoff queue
+HANDOFF_POLL_S = 1
+
+# "cli" starts the tedana CLI per run, "api" calls tedana_workflow in long-lived workers
+TEDANA_MODES = ["cli", "api"]
+
+# Outputs kept per run: "minimal" only what is used downstream, "qc" adds the
+# report, "full" keeps everything tedana writes
+OUTPUT_PROFILES = ["minimal", "qc", "full"]
+
+# Registry keys of the "minimal" tables, and their names where no registry exists
+MINIMAL_TABLES = {
+    "ICA mixing tsv": "*desc-ICA_mixing.tsv",
+    "ICA metrics tsv": "*desc-tedana_metrics.tsv",
+}
+
+# "ants" runs antsApplyTransforms (Lanczos over the whole MNI grid), "inprocess"
+# interpolates within the MNI brain mask with resample.py
+RESAMPLERS = ["ants", "inprocess"]
+
+DEFAULT_TEDANA_OPTS = {"fittype": "curvefit", "tedpca": "kic", "verbose": False, "mode": "cli",
+                       "profile": "full", "resampler": "ants", "interpolation": "linear", "adopt_existing": False}
 
 
 def _get_parser():
@@ -29,7 +75,26 @@ def _get_parser():
 
     parser.add_argument("--fmriprep_dir", required=True, help="Path to fMRIPrep derivatives")
     parser.add_argument("--output_dir", required=True, help="Path to tedana output base directory")
-    parser.add_argument("--n_cores", default=4, type=int, help="Threads for ANTs ApplyTransforms")
+    parser.add_argument("--n_cores", default=4, type=int,
+                        help="CPUs, split between concurrent tedana runs and their ANTs ApplyTransforms threads")
+    parser.add_argument("--mem_gb", default=None, type=float,
+                        help="Memory budget (GB) of concurrent runs; defaults to SLURM's --mem, else available memory.")
+    parser.add_argument("--max_parallel", default=None, type=int,
+                        help="Most runs processed at once; defaults to n_cores.")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Transform finished runs to MNI while the next runs' tedana is fitting.")
+    parser.add_argument("--tedana_mode", default="cli", choices=TEDANA_MODES,
+                        help="Run the tedana CLI per run, or its Python workflow in long-lived worker processes.")
+    parser.add_argument("--output_profile", default="full", choices=OUTPUT_PROFILES,
+                        help="Outputs kept per run: minimal (denoised BOLD, mixing matrix, component table), "
+                             "qc (plus the report) or full (everything tedana writes).")
+    parser.add_argument("--resampler", default="ants", choices=RESAMPLERS,
+                        help="Resample to MNI with antsApplyTransforms, or in-process within the MNI brain mask.")
+    parser.add_argument("--interpolation", default="linear", choices=list(KERNELS),
+                        help="Interpolation kernel of the in-process resampler (ANTs uses LanczosWindowedSinc).")
+    parser.add_argument("--adopt_existing", action="store_true",
+                        help="Reuse outputs written before runs kept a manifest instead of recomputing them. "
+                             "Only safe if no echo of those runs was excluded since they were built.")
 
     # Optional knobs (CLI-supported)
     parser.add_argument("--fittype", default="curvefit", choices=["curvefit", "loglin"],
@@ -37,49 +102,44 @@ def _get_parser():
     parser.add_argument("--tedpca", default="kic",
                         help="Dimensionality estimation for tedana (e.g., kic/mdl/aic/none).")
     parser.add_argument("--verbose", action="store_true", help="More tedana printouts.")
+    parser.add_argument("--compress_level", default=6, type=int,
+                        help="Gzip level (0-9) of the MNI-space .nii.gz output; 0 stores the data "
+                             "in it without compression (fastest, full size).")
+    parser.add_argument("--bold_dtype", default="float32", choices=["float32", "int16"],
+                        help="On-disk type of the MNI-space output; int16 is stored with scl_slope.")
+    parser.add_argument("--index_dir", default=None,
+                        help="Directory to keep the listing of the subject's fMRIPrep files in.")
     return parser
 
 
-def _get_sessions(preproc_dir, subject):
-    found = sorted(glob(op.join(preproc_dir, subject, "ses-*")))
-    return [op.basename(x) for x in found] if found else [None]
+def _ses_value(session):
+    """Index value of a ses-XX label (None without sessions)."""
+    return session.split("-", 1)[1] if session else None
+
+
+def _get_sessions(index):
+    found = index.values("ses")
+    return [f"ses-{x}" for x in found] if found else [None]
 
 
-def _get_tasks(preproc_dir, subject, sessions):
+def _get_tasks(index, sessions):
     # Discover tasks from confounds TSVs; if missing, fall back to preproc bolds
-    patt1 = (op.join(preproc_dir, subject, "ses-*", "func", "*_task-*_desc-confounds_timeseries.tsv")
-             if sessions[0] is not None else
-             op.join(preproc_dir, subject, "func", "*_task-*_desc-confounds_timeseries.tsv"))
-    files = sorted(glob(patt1))
-    if not files:
-        patt2 = (op.join(preproc_dir, subject, "ses-*", "func", "*_task-*_desc-preproc_bold.nii.gz")
-                 if sessions[0] is not None else
-                 op.join(preproc_dir, subject, "func", "*_task-*_desc-preproc_bold.nii.gz"))
-        files = sorted(glob(patt2))
-    return sorted({op.basename(x).split("_task-")[1].split("_")[0] for x in files}) if files else [None]
-
-
-def _get_runs_for_task(preproc_dir, subject, sessions, task):
-    # Runs per task; prefer ME, fall back to SE (allow tokens between run-XX and desc-…)
-    if sessions[0] is not None:
-        patt_me = op.join(preproc_dir, subject, "ses-*", "func",
-                          f"*task-{task}_run-*_echo-*_desc-preproc_bold.nii.gz")
-        patt_se = op.join(preproc_dir, subject, "ses-*", "func",
-                          f"*task-{task}_run-*_*_desc-preproc_bold.nii.gz")
-    else:
-        patt_me = op.join(preproc_dir, subject, "func",
-                          f"*task-{task}_run-*_echo-*_desc-preproc_bold.nii.gz")
-        patt_se = op.join(preproc_dir, subject, "func",
-                          f"*task-{task}_run-*_*_desc-preproc_bold.nii.gz")
+    ses = True if sessions[0] is not None else None
+    tasks = index.values("task", datatype="func", ses=ses, desc="confounds", suffix="timeseries", extension=".tsv")
+    if not tasks:
+        tasks = index.values("task", datatype="func", ses=ses, desc="preproc", suffix="bold", extension=".nii.gz")
+    return tasks if tasks else [None]
 
-    files = sorted(glob(patt_me))
-    if not files:
-        files = sorted(glob(patt_se))
-    if not files:
-        return [None]
 
-    runs = {op.basename(x).split("_run-")[1].split("_")[0] for x in files}
-    return sorted(runs)
+def _get_runs_for_task(index, sessions, task):
+    # Runs per task; prefer ME, fall back to SE
+    ses = True if sessions[0] is not None else None
+    preproc = {"datatype": "func", "ses": ses, "task": task, "desc": "preproc", "suffix": "bold",
+               "extension": ".nii.gz"}
+    runs = index.values("run", echo=True, **preproc)
+    if not runs:
+        runs = index.values("run", **preproc)
+    return runs if runs else [None]
 
 
 def _get_echos(preproc_files):
@@ -114,9 +174,13 @@ def _find_denoised_file(out_dir, prefix):
     return hits[0] if hits else None
 
 
-def _transform_scan2mni(sub, ses, task, run, denoised_img_scan, fmriprep_dir, tedana_dir, n_cores):
+def _transform_scan2mni(sub, ses, task, run, denoised_img_scan, fmriprep_dir, tedana_dir, n_cores,
+                        codec=None, index=None, transforms=None, resampler="ants", interpolation="linear",
+                        adopt_existing=False):
+    if transforms is None:
+        index = index if index is not None else subject_index(fmriprep_dir, sub)
+        transforms = TransformCache(index, tedana_dir, sub, n_threads=n_cores)
     func_dir = op.join(fmriprep_dir, sub, ses, "func") if ses else op.join(fmriprep_dir, sub, "func")
-    anat_dir = op.join(fmriprep_dir, sub, ses, "anat") if ses else op.join(fmriprep_dir, sub, "anat")
     out_func = op.join(tedana_dir, sub, ses, "func") if ses else op.join(tedana_dir, sub, "func")
 
     # Ensure destination directory exists now that we know we're transforming
@@ -133,17 +197,39 @@ def _transform_scan2mni(sub, ses, task, run, denoised_img_scan, fmriprep_dir, te
         func_dir,
         f"{sub}{ses_label}_task-{task}{run_label}_from-scanner_to-T1w_mode-image_xfm.txt",
     )
-    t1w2mni_files = glob(
-        op.join(anat_dir, f"{sub}{ses_label}*_from-T1w_to-MNI152NLin2009cAsym_mode-image_xfm.h5")
-    )
-    references = glob(
-        op.join(anat_dir, f"{sub}{ses_label}_*space-MNI152NLin2009cAsym_*desc-preproc_T1w.nii.gz")
-    )
-    assert len(references) == 1, f"Expected 1 MNI reference, found {len(references)}"
-    assert len(t1w2mni_files) == 1, f"Expected 1 T1w->MNI transform, found {len(t1w2mni_files)}"
-
-    reference = references[0]
-    t1w2mni = t1w2mni_files[0]
+    # fMRIPrep's T1w->MNI h5, collapsed once per session into a displacement field
+    t1w2mni, reference = transforms.get(ses)
+    inputs = [denoised_img_scan, scan2t1w, t1w2mni, reference]
+    if resampler == "inprocess":
+        mask = mni_mask(transforms.index, _ses_value(ses))
+        inputs.append(mask)
+
+    # Redone only when tedana's output, the transforms or the resampling options changed
+    codec = codec or DEFAULT_CODECS["bold"]
+    manifest = RunManifest(op.join(out_func, f"{sub}{ses_label}_task-{task}{run_label}_space-scan_manifest.json"))
+    mni_key = manifest.fingerprint(inputs, {
+        "resampler": resampler, "interpolation": interpolation if resampler == "inprocess" else "LanczosWindowedSinc",
+        "level": codec["level"], "dtype": codec["dtype"]})
+    if manifest.is_current("mni", mni_key, [denoised_img_mni]):
+        print(f"\t\t\t{denoised_img_mni} is up to date", flush=True)
+        return
+    if adopt_existing and not manifest.outputs("mni") and _is_newer(denoised_img_mni, [denoised_img_scan]):
+        # Written before runs kept a manifest; assumed to come from the current tedana output
+        print(f"\t\t\tAdopting existing {denoised_img_mni} (--adopt_existing, no manifest)", flush=True)
+        manifest.record("mni", mni_key, [denoised_img_mni])
+        return
+
+    if resampler == "inprocess":
+        print(f"\t\t\tResampling {denoised_img_scan} within {mask} ({interpolation})", flush=True)
+        resampled = resample_to_mni(denoised_img_scan, reference, mask, t1w2mni, scan2t1w,
+                                    interpolation=interpolation, n_threads=n_cores)
+        with atomic_output(denoised_img_mni) as tmp_file:
+            resampled.write_volumes(tmp_file, codec)
+        manifest.record("mni", mni_key, [denoised_img_mni])
+        return
+
+    # Imported here so that run discovery does not need nipype
+    from nipype.interfaces.ants import ApplyTransforms
 
     at = ApplyTransforms()
     at.inputs.dimension = 3
@@ -152,13 +238,16 @@ def _transform_scan2mni(sub, ses, task, run, denoised_img_scan, fmriprep_dir, te
     at.inputs.default_value = 0
     at.inputs.float = True
     at.inputs.interpolation = "LanczosWindowedSinc"
-    at.inputs.output_image = denoised_img_mni
+    # ANTs writes uncompressed; the result is then encoded with the output codec
+    at.inputs.output_image = denoised_img_mni.replace(".nii.gz", "_tmp.nii")
     at.inputs.reference_image = reference
     # antsApplyTransforms applies transforms in reverse order; this yields scan->T1w, then T1w->MNI
     at.inputs.transforms = [t1w2mni, scan2t1w]
     at.inputs.num_threads = int(n_cores)
     print(f"\t\t\t{at.cmdline}", flush=True)
     at.run()
+    recode_nifti(at.inputs.output_image, denoised_img_mni, codec)
+    manifest.record("mni", mni_key, [denoised_img_mni])
 
 
 def _organize_files(tedana_sub_func_dir, report_dir):
@@ -183,7 +272,9 @@ def _organize_files(tedana_sub_func_dir, report_dir):
 
 
 def main(subject, sessions, tasks, runs, fmriprep_dir, output_dir, n_cores,
-         fittype="curvefit", tedpca="kic", verbose=False):
+         fittype="curvefit", tedpca="kic", verbose=False, compress_level=6, bold_dtype="float32",
+         index_dir=None, mem_gb=None, max_parallel=None, pipeline=False, tedana_mode="cli",
+         output_profile="full", resampler="ants", interpolation="linear", adopt_existing=False):
 
     n_cores = int(n_cores)
 
@@ -191,6 +282,8 @@ def main(subject, sessions, tasks, runs, fmriprep_dir, output_dir, n_cores,
     # Load echo/run exclusions from MRIQC
     # --------------------------------------------------
     exclude_file = "/home/data/nbc/Laird_CASA/dset/derivatives/mriqc-24.0.2/exclude-runs.tsv"
+    # Registry entries of MRIQC outliers carry reasons and metrics
+    registry = ExclusionRegistry(op.join(op.dirname(exclude_file), "exclusions"))
     if op.exists(exclude_file):
         excl_df = pd.read_csv(exclude_file, sep="\t")
         excl_bids = set(excl_df["bids_name"].tolist())
@@ -201,38 +294,41 @@ def main(subject, sessions, tasks, runs, fmriprep_dir, output_dir, n_cores,
     # --------------------------------------------------
     # Discover sessions, tasks, runs-per-task
     # --------------------------------------------------
+    # One listing of the subject's fMRIPrep directory serves every lookup below
+    index = subject_index(fmriprep_dir, subject, cache_dir=index_dir)
     if sessions[0] is None:
-        sessions = _get_sessions(fmriprep_dir, subject)
+        sessions = _get_sessions(index)
     if tasks[0] is None:
-        tasks = _get_tasks(fmriprep_dir, subject, sessions)
+        tasks = _get_tasks(index, sessions)
 
-    runs_by_task = {t: _get_runs_for_task(fmriprep_dir, subject, sessions, t) for t in tasks}
+    runs_by_task = {t: _get_runs_for_task(index, sessions, t) for t in tasks}
     print(f"Sessions: {sessions}")
     print(f"Tasks:    {tasks}")
     print(f"Runs by task: {runs_by_task}")
 
+    # Runs are planned here and run concurrently by run_tedana_jobs
+    jobs = []
     for session in sessions:
         for task in tasks:
             task_runs = runs_by_task.get(task, [None])
             for run in task_runs:
-                print(f"Processing {subject}, session: {session}, task: {task}, run: {run}...", flush=True)
+                print(f"Planning {subject}, session: {session}, task: {task}, run: {run}...", flush=True)
 
-                fprep_func = op.join(fmriprep_dir, subject, session, "func") if session else op.join(fmriprep_dir, subject, "func")
                 out_func = op.join(output_dir, subject, session, "func") if session else op.join(output_dir, subject, "func")
 
                 run_label = f"_run-{run}" if run else ""
                 ses_label = f"_{session}" if session else ""
                 prefix = f"{subject}{ses_label}_task-{task}{run_label}_space-scan"
 
-                # Get ME echoes first; if none, try SE (allow tokens between run-XX and desc-…)
-                preproc_files = sorted(
-                    glob(op.join(fprep_func, f"*task-{task}*{run_label}_echo-*_desc-preproc_bold.nii.gz"))
-                )
+                # Get ME echoes first; if none, try SE
+                run_files = {"datatype": "func", "ses": _ses_value(session), "task": task, "desc": "preproc",
+                             "suffix": "bold", "extension": ".nii.gz"}
+                if run:
+                    run_files["run"] = run
+                preproc_files = index.files(echo=True, **run_files)
                 is_me = True
                 if not preproc_files:
-                    preproc_files = sorted(
-                        glob(op.join(fprep_func, f"*task-{task}*{run_label}*_desc-preproc_bold.nii.gz"))
-                    )
+                    preproc_files = index.files(**run_files)
                     is_me = False
 
                 if not preproc_files:
@@ -247,13 +343,21 @@ def main(subject, sessions, tasks, runs, fmriprep_dir, output_dir, n_cores,
                 # Filter out excluded echoes from QC table
                 # --------------------------------------------------
                 good_echo_files = []
-                for f in preproc_files:
-                    # Build QC-style key (…_bold) to match bids_name in exclude-runs.tsv
-                    qc_key = op.basename(f).replace("_desc-preproc_bold.nii.gz", "") + "_bold"
-                    if qc_key not in excl_bids:
-                        good_echo_files.append(f)
-                    else:
+                # Build QC-style keys (…_bold) to match bids_name in exclude-runs.tsv
+                qc_keys = [
+                    op.basename(f).replace("_desc-preproc_bold.nii.gz", "") + "_bold"
+                    for f in preproc_files
+                ]
+                # Only MRIQC's QC decisions; denoising's run-level censoring does not drop echoes
+                registry_hits = registry.lookup(qc_keys, sources=["mriqc_group"])
+                for f, qc_key in zip(preproc_files, qc_keys):
+                    if qc_key in excl_bids:
                         print(f"\tExcluding {qc_key} from tedana input (failed QC).", flush=True)
+                    elif registry_hits[qc_key]:
+                        reasons = sorted({e["reason"] for e in registry_hits[qc_key]})
+                        print(f"\tExcluding {qc_key} from tedana input ({', '.join(reasons)}).", flush=True)
+                    else:
+                        good_echo_files.append(f)
 
                 if not good_echo_files:
                     print(f"\tAll echoes excluded for {task} run-{run} — skipping tedana for this run (no directories created).", flush=True)
@@ -266,41 +370,387 @@ def main(subject, sessions, tasks, runs, fmriprep_dir, output_dir, n_cores,
                 echo_times = _get_echos(preproc_files)
                 assert len(preproc_files) == len(echo_times), "Mismatch N echoes vs files after exclusions."
 
-                # --- Run tedana CLI: full pipeline including denoising ---
-                denoised_img_scan = _find_denoised_file(out_func, prefix)
-                if not denoised_img_scan:
-                    cmd = (["tedana", "-d"] + preproc_files +
-                           ["-e"] + [str(e) for e in echo_times] +
-                           ["--out-dir", out_func,
-                            "--prefix", prefix,
-                            "--fittype", fittype,
-                            "--tedpca", tedpca])
-                    if verbose:
-                        cmd.append("--verbose")
-
-                    print("\t\tRunning:", " ".join(cmd), flush=True)
-                    subprocess.run(cmd, check=True)
-
-                    # Move report & figures out of the func dir into a dedicated report folder
-                    report_dir = op.join(out_func, f"{subject}{ses_label}_task-{task}{run_label}_report")
-                    _organize_files(out_func, report_dir)
-
-                    # Try to find the denoised file now
-                    denoised_img_scan = _find_denoised_file(out_func, prefix)
-
-                if not denoised_img_scan:
-                    # Fall back to optcom if denoised not found (warn)
-                    fallback = op.join(out_func, f"{prefix}_desc-optcom_bold.nii.gz")
-                    if op.isfile(fallback):
-                        print("\tWARNING: could not find a denoised file; using optcom bold as fallback.", flush=True)
-                        denoised_img_scan = fallback
-                    else:
-                        print("\tERROR: no denoised or optcom file found; skipping transform.", flush=True)
-                        continue
+                jobs.append({
+                    "session": session, "task": task, "run": run, "out_func": out_func, "prefix": prefix,
+                    "report_dir": op.join(out_func, f"{subject}{ses_label}_task-{task}{run_label}_report"),
+                    "preproc_files": preproc_files, "echo_times": echo_times,
+                    "mem_gb": _estimate_memory_gb(preproc_files),
+                })
+
+    tedana_opts = {"fittype": fittype, "tedpca": tedpca, "verbose": verbose, "mode": tedana_mode,
+                   "profile": output_profile, "resampler": resampler, "interpolation": interpolation,
+                   "adopt_existing": adopt_existing}
+    run_jobs = run_tedana_pipeline if pipeline else run_tedana_jobs
+    run_jobs(subject, jobs, fmriprep_dir, output_dir, index, n_cores, mem_gb, max_parallel, tedana_opts,
+             compress_level, bold_dtype)
+
+
+def _estimate_memory_gb(echo_files):
+    """Rough peak memory (GB) of tedana on these echoes, from their headers only."""
+    n_values = sum(int(np.prod(nib.load(f).shape)) for f in echo_files)
+    # tedana holds the echoes as float64, plus masked copies through PCA/ICA
+    return TEDANA_BASE_MEMORY_GB + TEDANA_MEMORY_FACTOR * n_values * 8 / 1024**3
+
+
+def _minimal_outputs(work_dir, prefix, registry):
+    """Names of the outputs kept by the "minimal" profile in a run's work dir."""
+    # Same choice as _tedana_stage: the denoised series, else optcom
+    optcom = op.join(work_dir, f"{prefix}_desc-optcom_bold.nii.gz")
+    kept = [_registered_output(registry, work_dir, "denoised ts img") or _find_denoised_file(work_dir, prefix)
+            or (optcom if op.isfile(optcom) else None)]
+    for key, pattern in MINIMAL_TABLES.items():
+        hits = glob(op.join(work_dir, pattern))
+        kept.append(_registered_output(registry, work_dir, key) or (hits[0] if hits else None))
+    return {op.basename(path) for path in kept if path}
+
+
+def _collect_outputs(work_dir, out_func, report_dir, prefix, registry, profile="full"):
+    """Move a run's tedana outputs from its own work dir into the shared func dir.
 
-                # --- Transform to MNI ---
-                print("\tTransforming denoised/optcom to MNI…", flush=True)
-                _transform_scan2mni(subject, session, task, run, denoised_img_scan, fmriprep_dir, output_dir, n_cores)
+    Outputs outside the run's profile are deleted with the work dir.
+    """
+    # Reports, logs and figures are not prefixed, so each run writes them apart
+    if profile != "minimal":
+        _organize_files(work_dir, report_dir)
+    keep = _minimal_outputs(work_dir, prefix, registry) if profile != "full" else None
+    for name in os.listdir(work_dir):
+        if (keep is None) or (name in keep):
+            os.replace(op.join(work_dir, name), op.join(out_func, name))
+    shutil.rmtree(work_dir)
+
+
+def _remove_run_outputs(out_func, prefix, report_dir):
+    """Delete a run's tedana outputs (scan and MNI space) and report, keeping its manifest.
+
+    Returns the deleted paths.
+    """
+    run_name = prefix[:-len("_space-scan")]
+    removed = []
+    for path in glob(op.join(out_func, f"{run_name}_space-*")) + [report_dir]:
+        if path == op.join(out_func, f"{prefix}_manifest.json") or not op.exists(path):
+            continue
+        if op.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        removed.append(path)
+    return removed
+
+
+def _is_newer(output, inputs):
+    """Whether ``output`` exists and was written after every file in ``inputs``."""
+    return op.isfile(output) and op.getmtime(output) > max(op.getmtime(f) for f in inputs)
+
+
+def _init_tedana_worker(n_threads):
+    """Set the worker's thread counts and import tedana once, so runs start warm."""
+    os.environ.update({var: str(n_threads) for var in THREAD_ENV_VARS})
+    # BLAS was loaded with the parent's environment, so limit it directly too
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(int(n_threads))
+    import tedana.workflows  # noqa: F401
+
+
+def _tedana_api(preproc_files, echo_times, work_dir, prefix, tedana_opts, log_file):
+    """Run tedana_workflow (in a worker process); returns its output registry."""
+    from tedana.workflows import tedana_workflow
+
+    with open(log_file, "w") as fo, redirect_stdout(fo), redirect_stderr(fo):
+        tedana_workflow(data=preproc_files, tes=echo_times, out_dir=work_dir, prefix=prefix,
+                        fittype=tedana_opts["fittype"], tedpca=tedana_opts["tedpca"],
+                        verbose=tedana_opts["verbose"], no_reports=tedana_opts["profile"] == "minimal")
+    return _read_registry(work_dir)
+
+
+def _read_registry(work_dir):
+    """Output key -> file name, as written by tedana's OutputGenerator; {} if absent."""
+    registries = glob(op.join(work_dir, "*desc-tedana_registry.json"))
+    if not registries:
+        return {}
+    with open(registries[0], "r") as fo:
+        return json.load(fo)
+
+
+def _registered_output(registry, out_dir, key):
+    """Path of a registry output after it was moved into out_dir, if present."""
+    if key not in registry:
+        return None
+    path = op.join(out_dir, op.basename(registry[key]))
+    return path if op.isfile(path) else None
+
+
+def _start_tedana_workers(tedana_mode, n_workers, n_threads):
+    """Long-lived worker processes for tedana_mode "api"; None runs the CLI."""
+    if tedana_mode == "cli":
+        return None
+    return ProcessPoolExecutor(max_workers=n_workers, mp_context=mp.get_context("spawn"),
+                               initializer=_init_tedana_worker, initargs=(n_threads,))
+
+
+def _tedana_stage(subject, job, n_threads, tedana_opts, workers=None):
+    """Run tedana for one run unless its outputs are current; returns the file to transform (or None) and a log."""
+    out_func, prefix = job["out_func"], job["prefix"]
+    log = [f"Processing {subject}, session: {job['session']}, task: {job['task']}, run: {job['run']}..."]
+
+    # Outputs are reused only if built from these exact echoes (after exclusions) and options,
+    # including the output profile and verbosity that decide which files exist
+    manifest = RunManifest(op.join(out_func, f"{prefix}_manifest.json"))
+    tedana_key = manifest.fingerprint(job["preproc_files"], {
+        "echo_times": job["echo_times"], "fittype": tedana_opts["fittype"], "tedpca": tedana_opts["tedpca"],
+        "profile": tedana_opts["profile"], "verbose": tedana_opts["verbose"], "versions": tool_versions("tedana")})
+    previous = manifest.outputs("tedana")
+    if previous and manifest.is_current("tedana", tedana_key, previous):
+        log.append("\tEchoes and options unchanged since the last tedana run; reusing its outputs.")
+        return previous[0], log
+    if not previous and tedana_opts["adopt_existing"]:
+        # Outputs written before runs kept a manifest do not say which echoes they were built
+        # from (an exclusion changes no mtime), so they are only reused on request
+        existing = _find_denoised_file(out_func, prefix)
+        if existing and _is_newer(existing, job["preproc_files"]):
+            log.append(f"\tAdopting existing tedana outputs (--adopt_existing, no manifest): {existing}")
+            manifest.record("tedana", tedana_key, [existing])
+            return existing, log
+
+    # --- Run tedana (CLI, or its workflow in a worker): full pipeline including denoising ---
+    # Whatever an earlier echo set or tedana left behind is stale now
+    removed = _remove_run_outputs(out_func, prefix, job["report_dir"])
+    if removed:
+        why = ("echoes, options or tedana changed since the existing outputs were built" if previous else
+               "no manifest records which echoes the existing outputs were built from (see --adopt_existing)")
+        log.append(f"\tWARNING: {why}; discarding {len(removed)} output(s) and rerunning tedana.")
+    work_dir = op.join(out_func, f"{prefix}_work")
+    os.makedirs(job["report_dir"], exist_ok=True)
+    # Concurrent runs would interleave on stdout, so each keeps its own log
+    log_file = op.join(job["report_dir"], "tedana_stdout.log")
+    if workers is not None:
+        log.append(f"\t\tRunning tedana_workflow in a worker process -> {work_dir}")
+        registry = workers.submit(_tedana_api, job["preproc_files"], job["echo_times"], work_dir, prefix,
+                                  tedana_opts, log_file).result()
+    else:
+        cmd = (["tedana", "-d"] + job["preproc_files"] +
+               ["-e"] + [str(e) for e in job["echo_times"]] +
+               ["--out-dir", work_dir,
+                "--prefix", prefix,
+                "--fittype", tedana_opts["fittype"],
+                "--tedpca", tedana_opts["tedpca"]])
+        if tedana_opts["verbose"]:
+            cmd.append("--verbose")
+        if tedana_opts["profile"] == "minimal":
+            # Figures and the HTML report are most of a run's files
+            cmd.append("--no-reports")
+
+        log.append(f"\t\tRunning: {' '.join(cmd)}")
+        env = dict(os.environ, **{var: str(n_threads) for var in THREAD_ENV_VARS})
+        with open(log_file, "w") as fo:
+            result = subprocess.run(cmd, env=env, stdout=fo, stderr=subprocess.STDOUT)
+        if result.returncode != 0:
+            raise RuntimeError(f"tedana exited with {result.returncode}; see {log_file}")
+        registry = _read_registry(work_dir)
+
+    # Keep the profile's outputs, with report & figures in a dedicated report folder
+    _collect_outputs(work_dir, out_func, job["report_dir"], prefix, registry, tedana_opts["profile"])
+
+    # The workflow's registry names its outputs; otherwise probe the known patterns
+    denoised_img_scan = _registered_output(registry, out_func, "denoised ts img") or _find_denoised_file(
+        out_func, prefix)
+
+    if not denoised_img_scan:
+        # Fall back to optcom if denoised not found (warn)
+        fallback = op.join(out_func, f"{prefix}_desc-optcom_bold.nii.gz")
+        if op.isfile(fallback):
+            log.append("\tWARNING: could not find a denoised file; using optcom bold as fallback.")
+            denoised_img_scan = fallback
+        else:
+            log.append("\tERROR: no denoised or optcom file found; skipping transform.")
+    if denoised_img_scan:
+        manifest.record("tedana", tedana_key, [denoised_img_scan])
+    return denoised_img_scan, log
+
+
+def _run_tedana_job(subject, job, fmriprep_dir, output_dir, transforms, n_threads, tedana_opts, codec,
+                    workers=None):
+    """tedana, then the MNI transform, for one run; returns the run's log."""
+    denoised_img_scan, log = _tedana_stage(subject, job, n_threads, tedana_opts, workers)
+    if denoised_img_scan:
+        # --- Transform to MNI ---
+        log.append("\tTransforming denoised/optcom to MNI…")
+        _transform_scan2mni(subject, job["session"], job["task"], job["run"], denoised_img_scan, fmriprep_dir,
+                            output_dir, n_threads, codec=codec, transforms=transforms,
+                            resampler=tedana_opts["resampler"], interpolation=tedana_opts["interpolation"],
+                            adopt_existing=tedana_opts["adopt_existing"])
+    return "\n".join(log)
+
+
+def _estimate_transform_memory_gb(index, job, denoised_img_scan):
+    """Rough peak memory (GB) of ApplyTransforms: the float32 input and MNI output series."""
+    in_shape = nib.load(denoised_img_scan).shape
+    out_shape = nib.load(mni_inputs(index, _ses_value(job["session"]))[1]).shape[:3]
+    n_values = int(np.prod(in_shape)) + int(np.prod(out_shape)) * in_shape[-1]
+    return TRANSFORM_BASE_MEMORY_GB + n_values * 4 / 1024**3
+
+
+def _plan_workers(jobs, n_cores, max_parallel):
+    n_workers = max(min(int(max_parallel or n_cores), int(n_cores), len(jobs)), 1)
+    return n_workers, max(int(n_cores) // n_workers, 1)
+
+
+def run_tedana_jobs(subject, jobs, fmriprep_dir, output_dir, index, n_cores, mem_gb=None, max_parallel=None,
+                    tedana_opts=None, compress_level=6, bold_dtype="float32"):
+    """Run tedana (and the MNI transform) for several runs at once.
+
+    n_cores is split between concurrent runs, each getting the same number of
+    threads for tedana (BLAS) and ApplyTransforms; a run only starts while the
+    memory estimates of the running ones fit in mem_gb (default: SLURM's --mem,
+    else the memory available). Largest runs start first. With tedana_opts
+    mode "api", tedana_workflow runs in one long-lived process per worker.
+    Failures are collected and raised together once every run has finished.
+    """
+    if not jobs:
+        return
+    tedana_opts = dict(DEFAULT_TEDANA_OPTS, **(tedana_opts or {}))
+    n_workers, n_threads = _plan_workers(jobs, n_cores, max_parallel)
+    codec = make_codecs(compress_level, bold_dtype, threads=n_threads)["bold"]
+    transforms = TransformCache(index, output_dir, subject, n_threads=n_threads)
+    budget = MemoryBudget(float(mem_gb) if mem_gb else available_memory_gb())
+    jobs = sorted(jobs, key=lambda job: job["mem_gb"], reverse=True)
+    print(f"Running tedana for {len(jobs)} run(s): {n_workers} worker(s) x {n_threads} thread(s), "
+          f"memory budget {budget.describe()}", flush=True)
+
+    def _job(job):
+        with budget.reserve(job["mem_gb"]):
+            return _run_tedana_job(subject, job, fmriprep_dir, output_dir, transforms, n_threads, tedana_opts,
+                                   codec, workers)
+
+    failed = []
+    workers = _start_tedana_workers(tedana_opts["mode"], n_workers, n_threads)
+    with workers or nullcontext(), ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = {pool.submit(_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                print(future.result(), flush=True)
+            except Exception:
+                print(f"\tERROR in {job['prefix']}:\n{traceback.format_exc()}", flush=True)
+                failed.append(job["prefix"])
+
+    if failed:
+        raise RuntimeError(f"tedana failed for {len(failed)} run(s): {failed}")
+
+
+def run_tedana_pipeline(subject, jobs, fmriprep_dir, output_dir, index, n_cores, mem_gb=None, max_parallel=None,
+                        tedana_opts=None, compress_level=6, bold_dtype="float32"):
+    """Run tedana and the MNI transforms as overlapping stages.
+
+    tedana workers (mostly single-threaded) hand finished runs to a transform
+    worker through a queue of at most PIPELINE_DEPTH runs, so run k is
+    resampled while run k+1 is fitted. Half of n_cores (at least one) go to
+    ApplyTransforms, the rest to the tedana workers. Both stages reserve
+    their memory estimate in one budget. Failures of either stage are
+    collected and raised together once every run has finished.
+    """
+    if not jobs:
+        return
+    tedana_opts = dict(DEFAULT_TEDANA_OPTS, **(tedana_opts or {}))
+    transform_threads = max(int(n_cores) // 2, 1)
+    n_workers, n_threads = _plan_workers(jobs, max(int(n_cores) - transform_threads, 1), max_parallel)
+    codec = make_codecs(compress_level, bold_dtype, threads=transform_threads)["bold"]
+    transforms = TransformCache(index, output_dir, subject, n_threads=transform_threads)
+    budget = MemoryBudget(float(mem_gb) if mem_gb else available_memory_gb())
+    jobs = sorted(jobs, key=lambda job: job["mem_gb"], reverse=True)
+    print(f"Pipelining {len(jobs)} run(s): {n_workers} tedana worker(s) x {n_threads} thread(s), "
+          f"ApplyTransforms x {transform_threads} thread(s), memory budget {budget.describe()}", flush=True)
+
+    handoff = queue.Queue(maxsize=PIPELINE_DEPTH)
+    consumer_failed = threading.Event()
+    consumer_error = []
+    failed = []
+    lock = threading.Lock()
+    progress = {"tedana": 0, "transform": 0}
+
+    def _report(stage, job, start, error=None):
+        with lock:
+            progress[stage] += 1
+            status = "failed" if error else "done"
+            print(f"[{stage} {progress[stage]}/{len(jobs)}] {job['prefix']} {status} "
+                  f"after {time.time() - start:.0f} s", flush=True)
+            if error:
+                print(f"\tERROR in {job['prefix']} ({stage}):\n{error}", flush=True)
+                failed.append(f"{job['prefix']} ({stage})")
+
+    def _produce(job):
+        start = time.time()
+        try:
+            with budget.reserve(job["mem_gb"]):
+                denoised_img_scan, log = _tedana_stage(subject, job, n_threads, tedana_opts, workers)
+        except Exception:
+            _report("tedana", job, start, traceback.format_exc())
+            return
+        print("\n".join(log), flush=True)
+        _report("tedana", job, start)
+        if denoised_img_scan and not _handoff((job, denoised_img_scan)):
+            _report("transform", job, time.time(), "Transform thread died before this run was handed off")
+
+    def _handoff(item):
+        # Blocks while PIPELINE_DEPTH runs wait, holding back further tedana runs,
+        # but gives up once the transform thread has died, as nothing drains the queue
+        while not consumer_failed.is_set():
+            try:
+                handoff.put(item, timeout=HANDOFF_POLL_S)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _consume():
+        job = None
+        try:
+            while True:
+                item = handoff.get()
+                if item is None:
+                    return
+                job, denoised_img_scan = item
+                start = time.time()
+                try:
+                    with budget.reserve(_estimate_transform_memory_gb(index, job, denoised_img_scan)):
+                        _transform_scan2mni(subject, job["session"], job["task"], job["run"], denoised_img_scan,
+                                            fmriprep_dir, output_dir, transform_threads, codec=codec,
+                                            transforms=transforms, resampler=tedana_opts["resampler"],
+                                            interpolation=tedana_opts["interpolation"],
+                                            adopt_existing=tedana_opts["adopt_existing"])
+                except Exception:
+                    _report("transform", job, start, traceback.format_exc())
+                else:
+                    _report("transform", job, start)
+                job = None
+        except BaseException:
+            # Whatever was in flight is lost along with the thread
+            consumer_error.append((job, traceback.format_exc()))
+            consumer_failed.set()
+
+    workers = _start_tedana_workers(tedana_opts["mode"], n_workers, n_threads)
+    consumer = threading.Thread(target=_consume, name="transform")
+    consumer.start()
+    try:
+        with workers or nullcontext(), ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="tedana") as pool:
+            list(pool.map(_produce, jobs))
+    finally:
+        _handoff(None)
+        consumer.join()
+
+    if consumer_error:
+        job, error = consumer_error[0]
+        print(f"\tERROR in the transform thread:\n{error}", flush=True)
+        lost = [job] if job else []
+        # Runs handed off but never picked up
+        while not handoff.empty():
+            item = handoff.get_nowait()
+            if item is not None:
+                lost.append(item[0])
+        failed.extend(f"{job['prefix']} (transform)" for job in lost)
+        failed.append("transform thread")
+
+    if failed:
+        raise RuntimeError(f"tedana failed for {len(failed)} run(s): {failed}")
 
 
 def _main(argv=None):
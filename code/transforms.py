@@ -0,0 +1,116 @@
+"""Per-subject cache of the T1w->MNI transform that resamples each run.
+
+fMRIPrep's T1w->MNI transform is a composite h5 (affine + nonlinear warp)
+that antsApplyTransforms would otherwise read and evaluate again for every
+run. The cache resolves it and the MNI reference once per session and
+collapses it into a displacement field on the reference grid. Each run then
+chains that field with its own scanner->T1w affine. The output voxels are
+the field's grid points, so the field is never interpolated and runs are
+resampled as with the h5 itself.
+"""
+import os
+import os.path as op
+import threading
+
+from manifest import RunManifest, atomic_output
+
+SPACE = "MNI152NLin2009cAsym"
+
+
+def mni_inputs(index, ses=None):
+    """The T1w->MNI transform and MNI reference of a session (``ses`` without ses-)."""
+    anat = {"datatype": "anat", "ses": ses}
+    t1w2mni_files = index.files(
+        **anat,
+        **{"from": "T1w"},
+        to=SPACE,
+        mode="image",
+        suffix="xfm",
+        extension=".h5",
+    )
+    references = index.files(
+        **anat, space=SPACE, desc="preproc", suffix="T1w", extension=".nii.gz"
+    )
+    assert len(references) == 1, f"Expected 1 MNI reference, found {len(references)}"
+    assert (
+        len(t1w2mni_files) == 1
+    ), f"Expected 1 T1w->MNI transform, found {len(t1w2mni_files)}"
+    return t1w2mni_files[0], references[0]
+
+
+def mni_mask(index, ses=None):
+    """The MNI brain mask of a session, on the grid of its MNI reference."""
+    masks = index.files(
+        datatype="anat",
+        ses=ses,
+        space=SPACE,
+        desc="brain",
+        suffix="mask",
+        extension=".nii.gz",
+    )
+    assert len(masks) == 1, f"Expected 1 MNI brain mask, found {len(masks)}"
+    return masks[0]
+
+
+def collapse_transform(transform, reference, out_file, n_threads=1):
+    """Write ``transform`` as one displacement field on the grid of ``reference``."""
+    # Imported here so that planning and discovery do not need nipype
+    from nipype.interfaces.ants import ApplyTransforms
+
+    at = ApplyTransforms()
+    at.inputs.dimension = 3
+    at.inputs.input_image = reference
+    at.inputs.reference_image = reference
+    at.inputs.transforms = [transform]
+    at.inputs.float = True
+    at.inputs.print_out_composite_warp_file = True
+    at.inputs.output_image = out_file
+    at.inputs.num_threads = int(n_threads)
+    print(f"\t\t\t{at.cmdline}", flush=True)
+    at.run()
+
+
+class TransformCache:
+    """T1w->MNI displacement fields of one subject, built once per session.
+
+    Fields are written under ``{out_dir}/{subject}[/{ses}]/anat`` and rebuilt
+    only when fMRIPrep's transform or reference change (see manifest.py).
+    Safe to share between threads: a session's field is built by the first
+    caller while the others wait for it.
+    """
+
+    def __init__(self, index, out_dir, subject, n_threads=1):
+        self.index = index
+        self.out_dir = out_dir
+        self.subject = subject
+        self.n_threads = n_threads
+        self._resolved = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, ses=None):
+        """Displacement field and reference of session ``ses`` (e.g. "ses-01")."""
+        with self._lock:
+            session_lock = self._locks.setdefault(ses, threading.Lock())
+        with session_lock:
+            if ses not in self._resolved:
+                self._resolved[ses] = self._build(ses)
+        return self._resolved[ses]
+
+    def _build(self, ses):
+        transform, reference = mni_inputs(
+            self.index, ses.split("-", 1)[1] if ses else None
+        )
+        anat_dir = op.join(self.out_dir, self.subject, ses or "", "anat")
+        name = f"{self.subject}_{ses}" if ses else self.subject
+        field = op.join(
+            anat_dir, f"{name}_from-T1w_to-{SPACE}_mode-image_desc-field_xfm.nii.gz"
+        )
+        os.makedirs(anat_dir, exist_ok=True)
+        manifest = RunManifest(op.join(anat_dir, f"{name}_manifest.json"))
+        key = manifest.fingerprint([transform, reference], {"space": SPACE})
+        if not manifest.is_current("field", key, [field]):
+            with atomic_output(field) as tmp_file:
+                collapse_transform(transform, reference, tmp_file, self.n_threads)
+            manifest.record("field", key, [field])
+        return field, reference